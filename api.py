@@ -1,61 +1,360 @@
-from pattern import parse_str, parse_stmt_str, parse_expr_str, Program
+from pattern import parse_str, parse_stmt_fragment, parse_expr_fragment, Program
 from pattern_ast import get_accesses
-from populator import PopulateParameters, populate_stmt, populate_expr, populate_op
+from populator import (PopulateParameters, populate_stmt, populate_expr, populate_op,
+                       populate_name, FixedChoice, SpaceRecorder, space_to_strides,
+                       int_to_point, point_to_int, CanonicalFilter)
 from constant_assignment import VariableMap
-from random import choice
+from random import choice, Random
+from hashlib import sha256
+from randomstate import derive_seed
 from instance import try_create_instance
 from type_assignment import TypeAssignment
 from codegen.c_generator import generate_code
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from pattern_ast import PrintContext
+from pattern_serialization import write_varint, read_varint
 from dependence_analysis import analyze_dependence, calculate_distance_vectors
 
+# weights, when given, make some choices more likely than others (see
+# populator.AliasTable). Enumerations ignore them. swap_remove makes
+# picks from a finite family O(1), but gives other fills for the same
+# seed (see populator.ChoicePool).
 class Mapping:
-    def __init__(self, family_name, choices, is_finite=False, choice_function=choice):
+    def __init__(self, family_name, choices, is_finite=False, choice_function=choice,
+                 weights=None, swap_remove=False):
         self.family_name = family_name
         self.choices = choices
         self.is_finite = is_finite
-        self.choice_function = choice
+        self.choice_function = choice_function
+        self.weights = weights
+        self.swap_remove = swap_remove
     def __str__(self):
         return f'{self.family_name} = {{{",".join([str(c) for c in self.choices])}}}'
+    def compile(self, parse_function):
+        return CompiledMapping(self.family_name,
+                               [parse_function(c) for c in self.choices],
+                               self.is_finite,
+                               self.choice_function,
+                               self.weights,
+                               self.swap_remove)
 
+# A mapping whose choices are already parsed. Skeleton.fill uses the
+# parsed choices as they are, so a mapping that is used for many fills
+# is parsed only once. The populator clones whatever it picks, so the
+# parsed choices are never modified.
+class CompiledMapping:
+    def __init__(self, family_name, parsed_choices, is_finite=False, choice_function=choice,
+                 weights=None, swap_remove=False):
+        self.family_name = family_name
+        self.parsed_choices = parsed_choices
+        self.is_finite = is_finite
+        self.choice_function = choice_function
+        self.weights = weights
+        self.swap_remove = swap_remove
+    def __str__(self):
+        choices = [c if isinstance(c, str) else c.pprint() for c in self.parsed_choices]
+        return f'{self.family_name} = {{{",".join(choices)}}}'
+
+def parse_op(s):
+    return s
+
+# Names fill name holes as they are
+def parse_name(s):
+    return s
+
+def compile_expressions(mappings):
+    return [m.compile(parse_expr_fragment) for m in mappings]
+def compile_statements(mappings):
+    return [m.compile(parse_stmt_fragment) for m in mappings]
+def compile_operations(mappings):
+    return [m.compile(parse_op) for m in mappings]
+def compile_names(mappings):
+    return [m.compile(parse_name) for m in mappings]
+
+# All the ways to fill the holes of a skeleton, numbered from 0 to
+# size - 1. The fill at some index is made directly from the index, so
+# an enumeration can be split into ranges of indices (between processes
+# for example) or resumed from any index.
+#
+# The space is mixed-radix, with one digit per choice made while
+# filling, in the order the holes are filled. A named hole that was
+# already filled isn't a choice, and a finite family has one choice less
+# every time it's picked from. len() only works for spaces that fit in
+# an index (sys.maxsize), size is always the number of fills.
+class FillEnumeration:
+    def __init__(self, skeleton, mappings, parse_function, populate_function, matching_function=None):
+        self.skeleton = skeleton
+        self.mappings = [m if isinstance(m, CompiledMapping) else m.compile(parse_function)
+                         for m in mappings]
+        self.populate_function = populate_function
+        self.matching_function = matching_function
+        self.kind = kind_of(populate_function)
+        recorder = SpaceRecorder()
+        self.fill_with(recorder.choice)
+        self.space = recorder.space
+        self.strides = space_to_strides(self.space)
+        self.size = self.strides[0]
+
+    def fill_with(self, choice_function):
+        return self.skeleton.fill(self.mappings, None, self.populate_function,
+                                  self.matching_function, choice_function)
+
+    def __len__(self):
+        return self.size
+
+    def point(self, index):
+        return int_to_point(index, self.space, self.strides)
+
+    def index(self, point):
+        return point_to_int(point, self.space, self.strides)
+
+    def choice_id(self, index):
+        return ChoiceId(self.skeleton.fingerprint(self.kind, self.mappings), self.kind, index)
+
+    # Like Skeleton.replay, without filling once more for the space
+    def replay(self, choice_id):
+        if choice_id != self.choice_id(choice_id.index):
+            raise RuntimeError(f'{choice_id} is not a fill of this enumeration')
+        return self[choice_id.index]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.size
+        if index < 0 or index >= self.size:
+            raise IndexError(f'fill {index} out of range for {self.size} fills')
+        return self.fill_with(FixedChoice(self.point(index)).choice)
+
+    def iterate(self, begin=0, end=None):
+        end = self.size if end is None else min(end, self.size)
+        for index in range(begin, end):
+            yield self[index]
+
+    # Skips the fills that are the same as an earlier one up to renaming
+    # arrays and loop variables and commuting operands. Pass the same
+    # canonical_filter to continue an enumeration (its counts are the
+    # space reduction). Shards enumerated separately can still have
+    # duplicates between them.
+    def iterate_canonical(self, begin=0, end=None, canonical_filter=None):
+        if canonical_filter is None:
+            canonical_filter = CanonicalFilter()
+        for filled in self.iterate(begin, end):
+            if canonical_filter.is_new(filled.program):
+                yield filled
+
+    def __iter__(self):
+        return self.iterate()
+
+    # The range of indices of one of n_shards (nearly) equal shards
+    def shard(self, which, n_shards):
+        return range(self.size * which // n_shards,
+                     self.size * (which + 1) // n_shards)
+
+fill_kinds = {
+    'expressions': (parse_expr_fragment, populate_expr),
+    'statements': (parse_stmt_fragment, populate_stmt),
+    'operations': (parse_op, populate_op),
+    'names': (parse_name, populate_name),
+}
+
+def kind_of(populate_function):
+    for kind, (_, populate) in fill_kinds.items():
+        if populate is populate_function:
+            return kind
+    return None
+
+# Identifies a fill by the choices made, which are its index in the
+# enumeration of all the fills (see FillEnumeration), so that a corpus
+# can keep ids instead of programs and rebuild them with
+# Skeleton.replay. The fingerprint is of the skeleton, the kind of fill
+# and the families of the mappings (names, finiteness and the number of
+# choices), replaying with other choices of the same shape isn't caught.
+# As bytes it's the 8-byte fingerprint and then the kind and index as
+# varints.
+class ChoiceId:
+    def __init__(self, fingerprint, kind, index):
+        self.fingerprint = fingerprint
+        self.kind = kind
+        self.index = index
+    def __eq__(self, other):
+        return (isinstance(other, ChoiceId) and
+                (self.fingerprint, self.kind, self.index) ==
+                (other.fingerprint, other.kind, other.index))
+    def __hash__(self):
+        return hash((self.fingerprint, self.kind, self.index))
+    def __str__(self):
+        return f'{self.fingerprint.hex()}-{self.kind}-{self.index}'
+    def to_bytes(self):
+        out = bytearray(self.fingerprint)
+        write_varint(out, list(fill_kinds).index(self.kind))
+        write_varint(out, self.index)
+        return bytes(out)
+    @staticmethod
+    def from_bytes(data):
+        kind, pos = read_varint(data, 8)
+        index, _ = read_varint(data, pos)
+        return ChoiceId(bytes(data[:8]), list(fill_kinds)[kind], index)
+    @staticmethod
+    def parse(s):
+        fingerprint, kind, index = s.split('-')
+        return ChoiceId(bytes.fromhex(fingerprint), kind, int(index))
+
+def mapping_shape(mapping):
+    if isinstance(mapping, CompiledMapping):
+        n_choices = len(mapping.parsed_choices)
+    else:
+        n_choices = len(mapping.choices)
+    # Swapping changes which fill a choice index stands for
+    swap = ':swap' if mapping.is_finite and mapping.swap_remove else ''
+    return f'{mapping.family_name}:{int(mapping.is_finite)}:{n_choices}{swap}'
+
+# Mappings that pick with random.choice are sent to the workers with no
+# choice function, meaning "pick from the fill's own stream". The
+# global random.choice would be pickled as a copy of the parent's state.
+def with_default_choice_as_none(mapping):
+    if mapping.choice_function is not choice:
+        return mapping
+    if isinstance(mapping, CompiledMapping):
+        return CompiledMapping(mapping.family_name, mapping.parsed_choices, mapping.is_finite,
+                               None, mapping.weights, mapping.swap_remove)
+    return Mapping(mapping.family_name, mapping.choices, mapping.is_finite, None, mapping.weights,
+                   mapping.swap_remove)
+
+class FillWorker:
+    def __init__(self, program_bytes, mappings, kind, matching_function, seed):
+        self.skeleton = Skeleton(Program.from_bytes(program_bytes))
+        parse_function, self.populate_function = fill_kinds[kind]
+        self.mappings = [m if isinstance(m, CompiledMapping) else m.compile(parse_function)
+                         for m in mappings]
+        self.matching_function = matching_function
+        self.seed = seed
+    def fill(self, index):
+        rng = Random(derive_seed(self.seed, index))
+        mappings = [m if m.choice_function is not None else
+                    CompiledMapping(m.family_name, m.parsed_choices, m.is_finite, rng.choice,
+                                    m.weights, m.swap_remove)
+                    for m in self.mappings]
+        return self.skeleton.fill(mappings, None, self.populate_function, self.matching_function)
+    def fill_range(self, begin, end):
+        filled = [self.fill(index) for index in range(begin, end)]
+        return [(f.program.to_bytes(), f.choice_id) for f in filled]
+
+# Each worker process sets up its FillWorker once (see fill_many)
+fill_worker = None
+
+def init_fill_worker(*args):
+    global fill_worker
+    fill_worker = FillWorker(*args)
+
+def fill_range(begin, end):
+    return fill_worker.fill_range(begin, end)
+
+# A fill of a skeleton knows its choice_id (see ChoiceId), unless it was
+# filled by a custom populate function or a choice function that made up
+# a choice.
 class Skeleton:
-    def __init__(self, code):
+    def __init__(self, code, choice_id=None):
         if isinstance(code, str):
             self.program = parse_str(code)
         elif isinstance(code, Program):
             self.program = code
         else:
             raise RuntimeError(f"Unknown type for code: {type(code)}")
+        self.choice_id = choice_id
+        self._digest = None
 
     def __str__(self):
         return self.program.pprint()
 
-    def fill(self, mappings, parse_function, populate_function, matching_function):
+    # choice_function, when given, picks for every family instead of
+    # the ones of the mappings, and uniformly
+    def fill(self, mappings, parse_function, populate_function, matching_function,
+             choice_function=None):
         populator = PopulateParameters()
         for mapping in mappings:
-            parsed = [parse_function(choice) for choice in mapping.choices]
-            populator.add(mapping.family_name,
-                          parsed,
-                          mapping.is_finite,
-                          mapping.choice_function)
+            if isinstance(mapping, CompiledMapping):
+                parsed = mapping.parsed_choices
+            else:
+                parsed = [parse_function(choice) for choice in mapping.choices]
+            if choice_function is None:
+                populator.add(mapping.family_name, parsed, mapping.is_finite,
+                              mapping.choice_function, mapping.weights, mapping.swap_remove)
+            else:
+                populator.add(mapping.family_name, parsed, mapping.is_finite, choice_function,
+                              swap_remove=mapping.swap_remove)
         populated = populate_function(self.program.clone(), populator.populate, matching_function)
-        return Skeleton(populated)
+        kind = kind_of(populate_function)
+        index = populator.choice_index()
+        if kind is None or index is None:
+            return Skeleton(populated)
+        return Skeleton(populated, ChoiceId(self.fingerprint(kind, mappings), kind, index))
+
+    def fingerprint(self, kind, mappings):
+        if self._digest is None:
+            self._digest = sha256(self.program.to_bytes()).digest()
+        shapes = ','.join(sorted(mapping_shape(m) for m in mappings))
+        return sha256(self._digest + f'{kind};{shapes}'.encode('utf8')).digest()[:8]
+
+    # Rebuilds the fill with the given choice_id. The mappings and
+    # matching_function have to be the ones it was filled with. To
+    # replay many fills, enumerate once and use FillEnumeration.replay.
+    def replay(self, choice_id, mappings, matching_function=None):
+        parse_function, populate_function = fill_kinds[choice_id.kind]
+        enumeration = FillEnumeration(self, mappings, parse_function, populate_function,
+                                      matching_function)
+        return enumeration.replay(choice_id)
 
     # matching_function takes in two family names
     # 1) the node's family name
     # 2) the family name specified in mappings
     # and returns True iff they are considered a match.
     def fill_expressions(self, mappings, matching_function=None):
-        return self.fill(mappings, parse_expr_str, populate_expr, matching_function)
+        return self.fill(mappings, parse_expr_fragment, populate_expr, matching_function)
     def fill_statements(self, mappings, matching_function=None):
-        return self.fill(mappings, parse_stmt_str, populate_stmt, matching_function)
+        return self.fill(mappings, parse_stmt_fragment, populate_stmt, matching_function)
     def fill_operations(self, mappings, matching_function=None):
         # An op is just a string. Return it.
-        def parse_op(s):
-            return s
         return self.fill(mappings, parse_op, populate_op, matching_function)
+    def fill_names(self, mappings, matching_function=None):
+        return self.fill(mappings, parse_name, populate_name, matching_function)
+
+    # Makes n fills on a pool of worker processes and returns them in
+    # order. The index-th fill picks from a stream seeded with
+    # derive_seed(seed, index), so the results are the same for any
+    # number of workers (workers=1 fills in this process). kind is one
+    # of fill_kinds. The mappings and matching_function are sent to the
+    # workers, so they have to be picklable.
+    def fill_many(self, mappings, n, workers=None, seed=0, kind='statements',
+                  matching_function=None, chunk_size=64):
+        if kind not in fill_kinds:
+            raise RuntimeError(f'Unknown kind of fill: {kind}')
+        mappings = [with_default_choice_as_none(m) for m in mappings]
+        args = (self.program.to_bytes(), mappings, kind, matching_function, seed)
+        if workers == 1:
+            worker = FillWorker(*args)
+            return [worker.fill(index) for index in range(n)]
+
+        begins = list(range(0, n, chunk_size))
+        ends = [min(begin + chunk_size, n) for begin in begins]
+        filled = []
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=init_fill_worker,
+                                 initargs=args) as executor:
+            for encoded in executor.map(fill_range, begins, ends):
+                filled += [Skeleton(Program.from_bytes(data), choice_id)
+                           for data, choice_id in encoded]
+        return filled
+
+    # Every way to fill the holes, see FillEnumeration
+    def enumerate_expressions(self, mappings, matching_function=None):
+        return FillEnumeration(self, mappings, parse_expr_fragment, populate_expr, matching_function)
+    def enumerate_statements(self, mappings, matching_function=None):
+        return FillEnumeration(self, mappings, parse_stmt_fragment, populate_stmt, matching_function)
+    def enumerate_operations(self, mappings, matching_function=None):
+        return FillEnumeration(self, mappings, parse_op, populate_op, matching_function)
+    def enumerate_names(self, mappings, matching_function=None):
+        return FillEnumeration(self, mappings, parse_name, populate_name, matching_function)
 
-    # Single threaded
     def generate_code(self, config):
         if '_' in config.possible_values:
             default_range = config.possible_values['_']
@@ -88,19 +387,26 @@ class Skeleton:
             possible_values = config.possible_values
         self.program.populate_decls(possible_values)
 
-        instance = try_create_instance(self.program, var_map, type_assignment, config.force)
-        Path(config.output_dir).mkdir(parents=True, exist_ok=True)
-
-        import pattern_ast
-        old_array_as_ptr = pattern_ast.array_as_ptr
-        pattern_ast.array_as_ptr = config.array_as_ptr
+        instance = try_create_instance(self.program, var_map, type_assignment, config.force,
+                                       config.instance_cache)
+        generate_instance_code(instance, config)
 
-        generate_code(config.output_dir,
-                      instance,
-                      init_value_map=config.initial_values,
-                      template_dir=config.template_dir)
+def generate_instance_code(instance, config):
+    Path(config.output_dir).mkdir(parents=True, exist_ok=True)
+    generate_code(config.output_dir,
+                  instance,
+                  init_value_map=config.initial_values,
+                  template_dir=config.template_dir,
+                  print_context=PrintContext(array_as_ptr=config.array_as_ptr))
 
-        pattern_ast.array_as_ptr = old_array_as_ptr
+# Generates the code for each instance with the config at the same
+# position, on a thread pool. Printing doesn't go through any global
+# state, so the output is the same as generating them one by one.
+def generate_code_many(instances, configs, max_workers=None):
+    if len(instances) != len(configs):
+        raise RuntimeError(f'{len(instances)} instances but {len(configs)} configs')
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(generate_instance_code, instances, configs))
 
 class CodegenConfig:
     def __init__(self):
@@ -112,3 +418,5 @@ class CodegenConfig:
         self.array_as_ptr = False
         self.array_size_depends_on_possible_values = False
         self.force = False
+        # An instance_cache.InstanceCache shared by generate_code calls
+        self.instance_cache = None
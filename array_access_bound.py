@@ -1,6 +1,8 @@
-from z3_utils import expr_to_cexpr, get_scalar_cvars, find_min_max, is_sat
+from z3_utils import expr_to_cexpr, affine_to_cexpr, get_scalar_cvars
 from z3 import Int, Or
+from loguru import logger
 from pattern_ast import Op, Literal
+from pattern_affine import affine_form, affine_indices
 
 class ArrayAccessBound:
     def __init__(self, name, is_local, n_dimensions):
@@ -10,6 +12,10 @@ class ArrayAccessBound:
         self.max_indices = [None] * n_dimensions
         self.n_dimensions = n_dimensions
         self.is_dynamic = False
+        # How the bounds of each dimension were found: 'interval',
+        # 'batch' (z3, with the other dimensions) or 'z3' (None if it
+        # isn't accessed)
+        self.paths = [None] * n_dimensions
     def new_min_index(self, dim, index):
         if self.is_dynamic:
             return
@@ -42,11 +48,84 @@ class ArrayAccessBound:
 def dimension_var(var, dimension):
     return f'{var}{"[]"*(dimension+1)}'
 
-def determine_array_access_bounds(decls, accesses, cvars, constraints, var_map, l=None):
+# When every loop bound is a constant once the fixed variables (a
+# single value in var_map) are known, the constraints of an instance
+# are a box: every variable has an interval of its own, from its loop
+# bounds and its range in var_map. Returns the intervals, or None when
+# some loop bound depends on another variable (coupled loops, like
+# triangular ones) or isn't affine.
+def interval_box(loop_shapes, cvars, var_map):
+    box = {}
+    fixed = {}
+    for name, min_val, max_val in var_map.iterate_ranges():
+        if name in cvars:
+            box[name] = [min_val, max_val]
+            if min_val == max_val:
+                fixed[name] = min_val
+    for shape in loop_shapes:
+        fixed.pop(shape.loop_var.var, None)
+
+    def evaluate(expr):
+        form = affine_form(expr)
+        if not form.is_affine:
+            return None
+        val = form.const
+        for var, coeff in form.coeffs.items():
+            if var not in fixed:
+                return None
+            val += coeff * fixed[var]
+        return val
+
+    for shape in loop_shapes:
+        loop_var = shape.loop_var.var
+        if type(loop_var) != str or loop_var not in cvars:
+            return None
+        greater_eq = evaluate(shape.greater_eq)
+        less_eqs = [evaluate(expr) for expr in shape.less_eq]
+        if greater_eq is None or None in less_eqs:
+            return None
+        interval = box.setdefault(loop_var, [None, None])
+        for less_eq in less_eqs:
+            interval[1] = less_eq if interval[1] is None else min(interval[1], less_eq)
+        interval[0] = greater_eq if interval[0] is None else max(interval[0], greater_eq)
+    return box
+
+# The min and max of an affine form over a box, which are exact since
+# every variable appears in a single term. None if the form isn't
+# affine or a variable isn't bounded.
+def form_interval(form, box):
+    if not form.is_affine:
+        return None
+    min_val = max_val = form.const
+    for var, coeff in form.coeffs.items():
+        if var not in box or None in box[var]:
+            return None
+        low, high = box[var]
+        if coeff > 0:
+            min_val += coeff * low
+            max_val += coeff * high
+        else:
+            min_val += coeff * high
+            max_val += coeff * low
+    return min_val, max_val
+
+def forms_interval(forms, box):
+    intervals = [form_interval(form, box) for form in forms]
+    if None in intervals:
+        return None
+    return min(low for low, _ in intervals), max(high for _, high in intervals)
+
+# The constraints are the ones asserted in session (a SolverSession),
+# every dimension is queried in a scope of its own. Given the loop
+# shapes the constraints came from, dimensions whose indices are affine
+# over a box (see interval_box) are bounded by interval arithmetic, and
+# the others by z3 (see SolverSession.find_min_max_batch).
+def determine_array_access_bounds(decls, accesses, cvars, session, var_map, l=None,
+                                  loop_shapes=None):
     if l is None:
         l = logger
-    constraint_strs = '\n'.join(map(str, constraints))
-    l.debug(f'Determining array sizes for constraints\n{constraint_strs}')
+    l.opt(lazy=True).debug('Determining array sizes for constraints\n{}',
+                           lambda: session.constraint_strs([]))
     bypass_set = set()
     bounds = {}
     cloned = var_map.clone()
@@ -62,43 +141,96 @@ def determine_array_access_bounds(decls, accesses, cvars, constraints, var_map,
                 size_minus_one = Op('-', [size.clone(), Literal(int, 1)])
                 bound.fix_size(dimension, size_minus_one)
 
-    related_cexprs = {}
+    box = None if loop_shapes is None else interval_box(loop_shapes, cvars, var_map)
+
+    related_forms = {}
     for decl in decls:
         for dimension in range(decl.n_dimensions):
             dim_var = dimension_var(decl.name, dimension)
-            related_cexprs[dim_var] = []
+            related_forms[dim_var] = []
 
     for access in accesses:
-        for dimension, index in enumerate(access.indices):
+        for dimension, index in enumerate(affine_indices(access)):
             dim_var = dimension_var(access.var, dimension)
-            cexpr = expr_to_cexpr(index, cvars)
+            related_forms[dim_var].append(index)
+
+    # Dimensions that intervals can't bound are bounded by z3, all of
+    # them at once if the batch works out and else one by one (with the
+    # dimension being any of its indices)
+    min_maxes = {}
+    paths = {}
+    z3_dims = []
+    for decl in decls:
+        for dimension in range(decl.n_dimensions):
+            dim_var = dimension_var(decl.name, dimension)
+            forms = related_forms[dim_var]
+            if len(forms) == 0:
+                continue
+            interval = None if box is None else forms_interval(forms, box)
+            if interval is not None:
+                min_maxes[dim_var] = list(interval)
+                paths[dim_var] = 'interval'
+            else:
+                z3_dims.append(dim_var)
+
+    # The min (max) of a dimension is the least (greatest) min (max) of
+    # its indices, so the batch goes over the indices
+    related_cexprs = {}
+    for dim_var in z3_dims:
+        related_cexprs[dim_var] = []
+        for form in related_forms[dim_var]:
+            cexpr = affine_to_cexpr(form, cvars)
             assert(cexpr is not None)
             related_cexprs[dim_var].append(cexpr)
 
+    if len(z3_dims) > 0:
+        cexprs = [cexpr for dim_var in z3_dims for cexpr in related_cexprs[dim_var]]
+        batch = session.find_min_max_batch(cexprs)
+        if batch is not None:
+            position = 0
+            for dim_var in z3_dims:
+                n_cexprs = len(related_cexprs[dim_var])
+                dim_min_maxes = batch[position:position + n_cexprs]
+                position += n_cexprs
+                min_maxes[dim_var] = [min(low for low, _ in dim_min_maxes),
+                                      max(high for _, high in dim_min_maxes)]
+                paths[dim_var] = 'batch'
+
+    for dim_var in z3_dims:
+        if dim_var in min_maxes:
+            continue
+        dim_var_cexpr = Int(dim_var)
+        extra = [Or([cexpr == dim_var_cexpr for cexpr in related_cexprs[dim_var]])]
+        l.opt(lazy=True).debug('index analysis constraints\n{}',
+                               lambda: session.constraint_strs(extra))
+        min_index, max_index = session.find_min_max(dim_var_cexpr, extra)
+        if min_index is None or max_index is None:
+            return None
+        min_maxes[dim_var] = [min_index, max_index]
+        paths[dim_var] = 'z3'
+
     # find_min(size) for all index where (size > index)
     for decl in decls:
         for dimension, size in enumerate(decl.sizes):
             dim_var = dimension_var(decl.name, dimension)
-            dim_var_cexpr = Int(dim_var)
-            if len(related_cexprs[dim_var]) == 0:
+            if dim_var not in min_maxes:
                 continue
-
-            access_constraints = [cexpr == dim_var_cexpr for cexpr in related_cexprs[dim_var]]
-            access_constraints = Or(access_constraints)
-            index_analysis_constraints = constraints + [access_constraints]
-            l.debug(f'index analysis constraints\n{index_analysis_constraints}')
-            min_index, max_index = find_min_max(index_analysis_constraints, dim_var_cexpr)
-            if min_index is None or max_index is None:
-                return None
-            l.debug(f'Found: min_index({min_index}) max_index({max_index})')
+            min_index, max_index = min_maxes[dim_var]
+            path = paths[dim_var]
+            l.debug(f'Found ({path}): min_index({min_index}) max_index({max_index})')
             if size is not None:
-                size_cexpr = expr_to_cexpr(size, cvars)
-                assert(size_cexpr is not None)
-                must_be_unsat = constraints + [size_cexpr <= max_index]
-                if is_sat(must_be_unsat, print_model=True):
+                size_interval = None if box is None else form_interval(affine_form(size), box)
+                if size_interval is not None:
+                    out_of_bound = size_interval[0] <= max_index
+                else:
+                    size_cexpr = expr_to_cexpr(size, cvars)
+                    assert(size_cexpr is not None)
+                    out_of_bound = session.is_sat([size_cexpr <= max_index], print_model=True)
+                if out_of_bound:
                     l.warning(f'It is possible that {max_index} >= {size}, causing an out-of-bound error')
                     return None
             bound = bounds[decl.name]
+            bound.paths[dimension] = path
             bound.new_min_index(dimension, min_index)
             bound.new_max_index(dimension, max_index)
 
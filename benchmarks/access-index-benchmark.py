@@ -0,0 +1,49 @@
+import time
+from pattern import parse_str
+from pattern_ast import get_accesses
+
+# Compares walking a program for its accesses on every query, as the
+# analyses used to, with querying the program's cached access index.
+# The program is a loop with N_STMTS statements.
+#
+# Run from the repository root: PYTHONPATH=. python benchmarks/access-index-benchmark.py
+
+N_STMTS = 2000
+N_QUERIES = 20
+
+stmts = '\n'.join(f'  A[i][j] = A[i][j] + B[i][j+{u}] * C[j][i] + x{u % 10};'
+                  for u in range(N_STMTS))
+program = parse_str(f'''
+declare A[][];
+declare B[][];
+declare C[][];
+for [(i, >=0, <=99), (j, >=0, <=99)] {{
+{stmts}
+}}
+''')
+
+# What get_accesses(program) did before the index: sets merged at every
+# level of the tree
+def walk():
+    accesses = set()
+    for loop in program.body:
+        for shape in loop.loop_shapes:
+            accesses.update(get_accesses(shape))
+        for stmt in loop.body:
+            accesses.update(get_accesses(stmt))
+    return accesses
+
+begin = time.perf_counter()
+for _ in range(N_QUERIES):
+    n_walked = len(walk())
+walk_time = time.perf_counter() - begin
+
+program.invalidate_indexes()
+begin = time.perf_counter()
+for _ in range(N_QUERIES):
+    n_indexed = len(program.access_index().accesses)
+index_time = time.perf_counter() - begin
+
+print(f'{N_QUERIES} queries over {n_walked} accesses')
+print(f'walk:  {walk_time:.3f}s')
+print(f'index: {index_time:.3f}s (including building it once)')
@@ -0,0 +1,69 @@
+import sys
+import time
+from loguru import logger
+from z3 import Int
+import dependence_analysis
+from dependence_analysis import analyze_dependence
+from pattern import parse_str
+from pattern_affine import affine_indices
+from z3_utils import expr_to_cexpr, affine_to_cexpr
+
+# Compares dependence analysis with and without the GCD test on the
+# cached affine forms of the subscripts, on a loop where the even and
+# odd elements of arrays are written and read separately, and encoding
+# the same index expressions for z3 by walking them every time with
+# reading their cached forms.
+#
+# Run from the repository root: PYTHONPATH=. python benchmarks/affine-benchmark.py
+
+logger.remove()
+logger.add(sys.stderr, level='WARNING')
+
+N_ARRAYS = 4
+N_ENCODINGS = 200
+
+stmts = []
+for a in range(N_ARRAYS):
+    stmts.append(f'A{a}[2 * i] = A{a}[2 * i + 1] + A{a}[(i + 1) * 2 + 1];')
+    stmts.append(f'B{a}[2 * i] = A{a}[2 * i - 1] * 3 + B{a}[2 * (i + 1) - 1];')
+decls = '\n'.join(f'declare A{a}[];\ndeclare B{a}[];' for a in range(N_ARRAYS))
+code = f'{decls}\nfor [(i, >=0, <=99)] {{\n' + '\n'.join(stmts) + '\n}'
+
+def analyze():
+    program = parse_str(code)
+    begin = time.perf_counter()
+    graph, _ = analyze_dependence(program)
+    n_deps = sum(len(deps) for deps in graph.graph.values())
+    return time.perf_counter() - begin, n_deps
+
+subscripts_may_overlap = dependence_analysis.subscripts_may_overlap
+dependence_analysis.subscripts_may_overlap = lambda *args: True
+z3_time, z3_deps = analyze()
+dependence_analysis.subscripts_may_overlap = subscripts_may_overlap
+gcd_time, gcd_deps = analyze()
+assert(gcd_deps == z3_deps)
+
+program = parse_str(code)
+accesses = program.access_index().accesses
+cvars = {'i': Int('i')}
+
+begin = time.perf_counter()
+for _ in range(N_ENCODINGS):
+    for access in accesses:
+        for index in access.indices:
+            expr_to_cexpr(index, cvars)
+walk_time = time.perf_counter() - begin
+
+begin = time.perf_counter()
+for _ in range(N_ENCODINGS):
+    for access in accesses:
+        for form in affine_indices(access):
+            affine_to_cexpr(form, cvars)
+form_time = time.perf_counter() - begin
+
+print(f'dependence analysis ({gcd_deps} dependences)')
+print(f'  z3 only:       {z3_time:.3f}s')
+print(f'  GCD test + z3: {gcd_time:.3f}s')
+print(f'encoding {len(accesses)} accesses {N_ENCODINGS} times')
+print(f'  walk:          {walk_time:.3f}s')
+print(f'  affine form:   {form_time:.3f}s')
@@ -0,0 +1,59 @@
+import sys
+import time
+from loguru import logger
+from api import Skeleton, Mapping
+from populator import CanonicalFilter
+from pattern import parse_str
+from pattern_canonical import canonicalize
+
+# Enumerates every way to pick the arrays of a matmul-like update and
+# reports how many fills are the same program up to renaming arrays and
+# loop variables and commuting + and *, which iterate_canonical() skips
+# before they reach instance creation and compilation. Also checks that
+# programs whose names are the canonical names of other variables (an
+# array called i0 or a0, a loop var called a1) get the same form.
+#
+# Run from the repository root: PYTHONPATH=. python benchmarks/canonical-benchmark.py
+
+logger.remove()
+logger.add(sys.stderr, level='WARNING')
+
+code = """
+declare A[][];
+declare B[][];
+declare C[][];
+declare D[][];
+
+for [i, j, k] {
+  #_:out# = #_:out# + #_:left# * #_:right# + #_:extra#;
+}
+"""
+
+arrays = ['A', 'B', 'C', 'D']
+skeleton = Skeleton(code)
+indices = {'out': '[i][j]', 'left': '[i][k]', 'right': '[k][j]', 'extra': '[i][j]'}
+fills = skeleton.enumerate_expressions([Mapping(hole, [array + index for array in arrays])
+                                        for hole, index in indices.items()])
+
+begin = time.perf_counter()
+n_all = sum(1 for _ in fills)
+all_time = time.perf_counter() - begin
+
+canonical_filter = CanonicalFilter()
+begin = time.perf_counter()
+representatives = list(fills.iterate_canonical(canonical_filter=canonical_filter))
+canonical_time = time.perf_counter() - begin
+
+print(f'space {fills.space}: {n_all} fills in {all_time:.3f}s')
+print(f'canonical: {canonical_filter} in {canonical_time:.3f}s')
+print(representatives[-1])
+
+colliding = [
+    'declare X[]; declare Y[]; for [i] { X[i] = Y[i]; }',
+    'declare i0[]; declare B[]; for [j] { i0[j] = B[j]; }',
+    'declare B[]; declare i0[]; for [j] { B[j] = i0[j]; }',
+    'declare a0[]; declare B[]; for [a1] { a0[a1] = B[a1]; }',
+]
+forms = {canonicalize(parse_str(c)).pprint() for c in colliding}
+assert(len(forms) == 1)
+print(f'colliding names: {forms.pop()}')
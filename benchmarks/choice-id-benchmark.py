@@ -0,0 +1,61 @@
+import random
+import sys
+import time
+from loguru import logger
+from api import Skeleton, Mapping, ChoiceId
+
+# Fills a skeleton N_FILLS times and compares keeping the programs as
+# source with keeping their choice ids, and how fast the ids replay
+# with Skeleton.replay and with one FillEnumeration.
+#
+# Run from the repository root: PYTHONPATH=. python benchmarks/choice-id-benchmark.py
+
+logger.remove()
+logger.add(sys.stderr, level='WARNING')
+
+N_FILLS = 2000
+
+code = """
+declare A[][];
+declare B[][];
+declare C[][];
+declare D[][];
+
+for [i, j, k] {
+  A[i][j] = A[i][j] + #_:left# * #_:right#;
+  B[i][j] = #_:left# - #_:any# * #_:any#;
+  C[i][j] = #_:any# + #_:any#;
+}
+"""
+
+arrays = ['A', 'B', 'C', 'D']
+mappings = [Mapping('left', [f'{a}[i][k]' for a in arrays]),
+            Mapping('right', [f'{a}[k][j]' for a in arrays]),
+            Mapping('any', [f'{a}[{x}][{y}]' for a in arrays
+                            for x in 'ijk' for y in 'ijk'])]
+
+random.seed(0)
+skeleton = Skeleton(code)
+fills = [skeleton.fill_expressions(mappings) for _ in range(N_FILLS)]
+source_bytes = sum(len(f.program.pprint().encode('utf8')) for f in fills)
+ids = [f.choice_id.to_bytes() for f in fills]
+id_bytes = sum(len(i) for i in ids)
+
+print(f'{N_FILLS} fills')
+print(f'  as source:     {source_bytes / N_FILLS:8.1f} bytes per program')
+print(f'  as choice ids: {id_bytes / N_FILLS:8.1f} bytes per program')
+
+begin = time.perf_counter()
+replayed = [skeleton.replay(ChoiceId.from_bytes(i), mappings) for i in ids]
+replay_time = time.perf_counter() - begin
+
+begin = time.perf_counter()
+enumeration = skeleton.enumerate_expressions(mappings)
+enumerated = [enumeration.replay(ChoiceId.from_bytes(i)) for i in ids]
+enumeration_time = time.perf_counter() - begin
+
+for f, r, e in zip(fills, replayed, enumerated):
+    assert(f.program.pprint() == r.program.pprint() == e.program.pprint())
+
+print(f'  Skeleton.replay:        {N_FILLS / replay_time:8.1f} programs/s')
+print(f'  FillEnumeration.replay: {N_FILLS / enumeration_time:8.1f} programs/s')
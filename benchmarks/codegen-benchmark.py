@@ -0,0 +1,74 @@
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from loguru import logger
+from codegen.c_generator import CGenerator
+from instance import Instance
+from pattern_ast import (Program, AbstractLoop, LoopShape, Declaration,
+                         Assignment, Access, Op, Literal, CodeWriter)
+
+# Emits an unrolled kernel with N_STMTS statements, as one string like
+# pprint() and core_code() return and streamed to a file through a
+# CodeWriter like generate_code does, and reports the time and the peak
+# memory of each on top of the program itself. Streaming saves memory,
+# not time: most of the time goes to printing each statement, and both
+# take about as long (within the noise of a run, a few tenths of a
+# second either way on 500k statements).
+#
+# Run from the repository root: PYTHONPATH=. python benchmarks/codegen-benchmark.py
+
+logger.remove()
+logger.add(sys.stderr, level='WARNING')
+
+N_STMTS = 500000
+
+def index(var, offset):
+    return Op('+', [Access(var), Literal(int, offset)])
+
+def make_program():
+    body = []
+    for u in range(N_STMTS):
+        lhs = Access('A', [index('i', u % 64), Access('j')])
+        rhs = Op('*', [Access('B', [index('i', u % 64), Access('j')]), Literal(int, 2)])
+        body.append(Assignment(lhs, rhs))
+    shapes = [LoopShape(Access(v), Literal(int, 0), [Literal(int, 99)], Literal(int, 1))
+              for v in ['i', 'j']]
+    inner = AbstractLoop(shapes[1:], body)
+    decls = [Declaration('A', 2, ty='double'), Declaration('B', 2, ty='double')]
+    return Program(decls, [AbstractLoop(shapes[:1], [inner])], [])
+
+# Timed without tracemalloc, which slows down allocations a lot
+def measure(name, emit):
+    begin = time.perf_counter()
+    size = emit()
+    elapsed = time.perf_counter() - begin
+    tracemalloc.start()
+    emit()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name:<24} {size / 2**20:7.2f}MiB of code {elapsed:6.2f}s peak {peak / 2**20:8.2f}MiB')
+
+program = make_program()
+cgen = CGenerator(Instance(program, {}), {})
+
+with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, 'core.c')
+    def pprint_string():
+        return len(program.pprint())
+    def pprint_streamed():
+        with open(path, 'w') as f:
+            program.write_to(CodeWriter(f))
+        return os.path.getsize(path)
+    def core_code_string():
+        return len(cgen.core_code())
+    def core_code_streamed():
+        with open(path, 'w') as f:
+            cgen.write_core_code(f)
+        return os.path.getsize(path)
+
+    measure('pprint (string)', pprint_string)
+    measure('pprint (streamed)', pprint_streamed)
+    measure('core code (string)', core_code_string)
+    measure('core code (streamed)', core_code_streamed)
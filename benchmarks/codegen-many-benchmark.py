@@ -0,0 +1,85 @@
+import filecmp
+import os
+import random
+import sys
+import tempfile
+import time
+from loguru import logger
+from api import Skeleton, Mapping, CodegenConfig, generate_instance_code, generate_code_many
+from constant_assignment import VariableMap
+from instance import try_create_instance
+from type_assignment import TypeAssignment
+
+# Generates the code of N_INSTANCES instances one by one and with
+# generate_code_many, half of them printing arrays as pointers, and
+# checks that every file is the same byte for byte.
+#
+# Run from the repository root: PYTHONPATH=. python benchmarks/codegen-many-benchmark.py
+
+logger.remove()
+logger.add(sys.stderr, level='WARNING')
+
+N_INSTANCES = 64
+N_STMTS = 200
+
+random.seed(0)
+skeleton = Skeleton("""
+declare A[100][100];
+declare B[100][100];
+for [(i, >=1, <=98), (j, >=1, <=98)] {
+""" + '\n'.join(['  $_:s$'] * N_STMTS) + """
+}
+""")
+statements = [Mapping('s', ['A[i][j] = A[i-1][j] + B[i][j+1];',
+                            'B[i][j] = B[i][j] * 2 + A[i][j-1];',
+                            'A[i+1][j] = B[i][j];'])]
+
+var_map = VariableMap()
+types = TypeAssignment(default_types=['int'])
+types.set('A', 'double')
+types.set('B', 'double')
+
+instances = []
+for _ in range(N_INSTANCES):
+    program = skeleton.fill_statements(statements).program
+    # The sizes are declared, so there's no need to solve for them
+    instance = try_create_instance(program, var_map, types, True)
+    assert(instance is not None)
+    instances.append(instance)
+
+def make_configs(root):
+    configs = []
+    for n in range(N_INSTANCES):
+        config = CodegenConfig()
+        config.initial_values = {}
+        config.template_dir = 'codegen'
+        config.output_dir = os.path.join(root, str(n))
+        config.array_as_ptr = n % 2 == 1
+        configs.append(config)
+    return configs
+
+with tempfile.TemporaryDirectory() as serial_root, tempfile.TemporaryDirectory() as many_root:
+    begin = time.perf_counter()
+    for instance, config in zip(instances, make_configs(serial_root)):
+        generate_instance_code(instance, config)
+    serial_time = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    configs = make_configs(many_root)
+    generate_code_many(instances, configs)
+    many_time = time.perf_counter() - begin
+
+    n_files = 0
+    for n in range(N_INSTANCES):
+        names = os.listdir(os.path.join(serial_root, str(n)))
+        match, mismatch, errors = filecmp.cmpfiles(os.path.join(serial_root, str(n)),
+                                                   os.path.join(many_root, str(n)),
+                                                   names, shallow=False)
+        assert(not mismatch and not errors), (n, mismatch, errors)
+        n_files += len(match)
+        core = open(os.path.join(many_root, str(n), 'core.c')).read()
+        assert(('(*A)' in core) == configs[n].array_as_ptr)
+
+print(f'{N_INSTANCES} instances, {n_files} files identical')
+print(f'serial:             {serial_time:.3f}s')
+print(f'generate_code_many: {many_time:.3f}s')
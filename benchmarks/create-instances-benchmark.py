@@ -0,0 +1,53 @@
+import sys
+import time
+from loguru import logger
+from instance import create_instances
+from pattern import parse_str
+from constant_assignment import VariableMap
+from type_assignment import TypeAssignment
+
+# Looks for instances of a pattern whose loop bounds get random values,
+# most of which make an index go out of bounds (one in 64 attempts
+# makes an instance), by attempting one by one and on a pool of
+# workers, and reports how many attempts it took and why the others
+# were rejected. Every attempt draws its constants from a stream of its
+# own, so an attempt rejected in one run is rejected in the other.
+#
+# Run from the repository root: PYTHONPATH=. python benchmarks/create-instances-benchmark.py
+
+logger.remove()
+logger.add(sys.stderr, level='ERROR')
+
+N_INSTANCES = 4
+MAX_ATTEMPTS = 2000
+DEADLINE = 60
+
+code = """
+declare A[100][100];
+declare B[100][100];
+declare C[100][100];
+
+for [i, j, k] {
+  A[i][j] = A[i][j] + B[i][k] * C[k][j];
+}
+"""
+
+if __name__ == '__main__':
+    program = parse_str(code)
+    program.populate_decls(None)
+    var_map = VariableMap(0, 399)
+    for loop_var in ['i', 'j', 'k']:
+        var_map.set_value(f'{loop_var}_greater_eq', 0)
+    types = TypeAssignment(default_types=['int'])
+    for array in ['A', 'B', 'C']:
+        types.set(array, 'double')
+
+    for workers in [1, None]:
+        begin = time.perf_counter()
+        report = create_instances(program, var_map, types, k=N_INSTANCES, workers=workers,
+                                  max_attempts=MAX_ATTEMPTS, deadline=DEADLINE)
+        elapsed = time.perf_counter() - begin
+        name = 'one by one' if workers == 1 else 'pool'
+        print(f'{name:<12} {elapsed:6.2f}s {report}')
+        found = [index for index, outcome, _ in report.attempts if outcome == 'instance']
+        print(f'  instances from attempts {sorted(found)}')
@@ -0,0 +1,46 @@
+import random
+import time
+from api import Skeleton, Mapping
+from populator import int_to_point, space_to_strides
+
+# Numbers the fills of a skeleton with N_HOLES statement holes and makes
+# fills at random indices of the (huge) space, then compares mapping
+# indices to points with the strides computed once and on every call.
+#
+# Run from the repository root: PYTHONPATH=. python benchmarks/enumeration-benchmark.py
+
+N_HOLES = 100
+N_FILLS = 200
+N_POINTS = 20000
+
+skeleton = Skeleton('declare A[];\ndeclare B[];\nfor [i] {\n' +
+                    '\n'.join(f'  $s{h % 10}:s$' if h % 2 else '  $_:s$' for h in range(N_HOLES)) +
+                    '\n}')
+statements = [Mapping('s', ['A[i] = A[i] + 1;', 'B[i] = A[i];', 'A[i] = B[i] * 2;'])]
+
+begin = time.perf_counter()
+fills = skeleton.enumerate_statements(statements)
+space_time = time.perf_counter() - begin
+
+random.seed(0)
+indices = [random.randrange(fills.size) for _ in range(N_FILLS)]
+begin = time.perf_counter()
+for index in indices:
+    fills[index]
+fill_time = time.perf_counter() - begin
+
+begin = time.perf_counter()
+for index in indices * (N_POINTS // N_FILLS):
+    int_to_point(index, fills.space)
+recompute_time = time.perf_counter() - begin
+
+begin = time.perf_counter()
+for index in indices * (N_POINTS // N_FILLS):
+    int_to_point(index, fills.space, fills.strides)
+strides_time = time.perf_counter() - begin
+
+print(f'{len(fills.space)} choices, {fills.size} fills')
+print(f'space:             {space_time:.3f}s')
+print(f'{N_FILLS} random fills:  {fill_time:.3f}s')
+print(f'{N_POINTS} points recomputing strides: {recompute_time:.3f}s')
+print(f'{N_POINTS} points with strides:        {strides_time:.3f}s')
@@ -0,0 +1,56 @@
+import time
+from api import Skeleton, Mapping, compile_expressions, compile_statements
+from pattern import fragment_cache, FragmentCache
+import pattern
+
+# Fills the same skeleton many times with the same pools, parsing the
+# pools on every fill (no cache), through the fragment cache, and with
+# precompiled mappings.
+#
+# Run from the repository root: PYTHONPATH=. python benchmarks/fill-benchmark.py
+
+N = 2000
+
+skeleton = Skeleton("""
+declare A[][];
+declare B[][];
+
+for [(i, >=#_:low#, <=#_:high#), (j, >=#_:low#, <=#_:high#)] {
+  $_:s$
+  $_:s$
+  $_:s$
+}
+""")
+
+expressions = [
+    Mapping("low", ["0", "1", "i + 1"]),
+    Mapping("high", ["n - 1", "n - 2", "m"]),
+]
+statements = [
+    Mapping("s", ["A[i][j] = A[i][j] * 2 + B[i - 1][j];",
+                  "A[i][j] = A[i - 1][j] + A[i][j - 1] + A[i + 1][j];",
+                  "B[i][j] = (A[i][j] + B[i][j + 1]) / 3;",
+                  "B[i][j] = A[j][i] * B[i][j] - 1;"]),
+]
+
+def fill(expressions, statements):
+    return skeleton.fill_expressions(expressions).fill_statements(statements)
+
+def bench(name, expressions, statements):
+    begin = time.perf_counter()
+    for _ in range(N):
+        fill(expressions, statements)
+    elapsed = time.perf_counter() - begin
+    print(f'{name:25} {N} fills {elapsed:7.3f}s {elapsed / N * 1e6:8.1f}us/fill')
+
+# A cache that can't hold anything parses every time
+pattern.fragment_cache = FragmentCache(max_size=0)
+bench('no cache', expressions, statements)
+
+pattern.fragment_cache = fragment_cache
+bench('fragment cache', expressions, statements)
+print(fragment_cache.stats())
+
+bench('precompiled mappings',
+      compile_expressions(expressions),
+      compile_statements(statements))
@@ -0,0 +1,33 @@
+import os
+import time
+from api import Skeleton, Mapping
+
+# Fill throughput of Skeleton.fill_many for 1, 2, 4, ... workers up to
+# the number of cores, checking that every worker count gives the same
+# fills.
+#
+# Run from the repository root: PYTHONPATH=. python benchmarks/fill-many-benchmark.py
+
+N_FILLS = 2000
+N_HOLES = 50
+
+skeleton = Skeleton('declare A[];\ndeclare B[];\nfor [i] {\n' +
+                    '\n'.join(['  $_:s$'] * N_HOLES) + '\n}')
+statements = [Mapping('s', ['A[i] = A[i] + 1;', 'B[i] = A[i];', 'A[i] = B[i] * 2;'])]
+
+worker_counts = [1]
+while worker_counts[-1] * 2 <= os.cpu_count():
+    worker_counts.append(worker_counts[-1] * 2)
+if worker_counts[-1] != os.cpu_count():
+    worker_counts.append(os.cpu_count())
+
+expected = None
+for workers in worker_counts:
+    begin = time.perf_counter()
+    filled = skeleton.fill_many(statements, N_FILLS, workers=workers, seed=1)
+    elapsed = time.perf_counter() - begin
+    printed = [s.program.pprint() for s in filled]
+    if expected is None:
+        expected = printed
+    assert(printed == expected)
+    print(f'{workers:3} workers: {N_FILLS / elapsed:8.1f} fills/s')
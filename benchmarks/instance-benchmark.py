@@ -0,0 +1,120 @@
+import random
+import sys
+import time
+from loguru import logger
+import array_access_bound
+import instance
+from instance import try_create_instance
+from pattern import parse_str
+from constant_assignment import VariableMap
+from type_assignment import TypeAssignment
+from z3_utils import SolverSession
+
+# Creates instances of a 2-D kernel (the one of example.py) and a 3-D
+# matmul, with one SolverSession per instance answering every query by
+# push/pop, and with fresh solvers that assert all the constraints
+# again for every query, both bounding array dimensions one by one and
+# without interval bounds. Then with a session bounding all the
+# dimensions in one batch, and with interval bounds as well, which
+# every dimension of these (rectangular) kernels takes. All make the
+# same instances.
+# In another kernel k's bounds depend on i, so the constraints aren't a
+# box and all of its dimensions are bounded by z3.
+#
+# Run from the repository root: PYTHONPATH=. python benchmarks/instance-benchmark.py
+
+logger.remove()
+logger.add(sys.stderr, level='WARNING')
+
+N_INSTANCES = 20
+
+kernels = {
+    '2-D': """
+declare I;
+declare J;
+declare A[][J];
+declare B[I][];
+declare C[][];
+
+for [(i, >=3, <=700), (j, >=2, <=900)] {
+  A[i][j] = A[i][j] + 5.0;
+  C[i][j] = C[i][j] + 5.0;
+  B[i][j] = A[i][j] + C[i][j];
+  B[i][j] = A[i][j] + C[i][j];
+}
+""",
+    '3-D': """
+declare A[][];
+declare B[][];
+declare C[][];
+
+for [(i, >=0, <=99), (j, >=0, <=199), (k, >=1, <=49)] {
+  A[i][j] = A[i][j] + B[i][k] * C[k][j];
+  C[k - 1][j] = C[k][j] + A[i + 1][j];
+}
+""",
+    '3-D triangular': """
+declare A[][];
+declare B[][];
+declare C[][];
+
+for [(i, >=0, <=99), (j, >=0, <=199), (k, >=i, <=149)] {
+  A[i][j] = A[i][j] + B[i][k] * C[k][j];
+}
+""",
+}
+
+# Asserts everything again for every query, like before sessions
+class FreshSolvers(SolverSession):
+    def check(self, extra=[]):
+        fresh = SolverSession(self.constraints + extra, self.l)
+        status = fresh.check()
+        self.model = fresh.model
+        return status
+    def find_bound(self, expr, extra, is_max):
+        return SolverSession(self.constraints + extra, self.l).find_bound(expr, [], is_max)
+    def find_min_max_batch(self, exprs):
+        return None
+
+class OneByOne(SolverSession):
+    def find_min_max_batch(self, exprs):
+        return None
+
+def create_instances(code):
+    program = parse_str(code)
+    program.populate_decls(None)
+    var_map = VariableMap()
+    var_map.set_value('I', 1800)
+    var_map.set_value('J', 1500)
+    types = TypeAssignment(default_types=['int'])
+    for array in ['A', 'B', 'C']:
+        types.set(array, 'double')
+    random.seed(0)
+    begin = time.perf_counter()
+    created = [try_create_instance(program, var_map, types, False) for _ in range(N_INSTANCES)]
+    elapsed = time.perf_counter() - begin
+    assert(all(created))
+    paths = {}
+    for bound in created[0].array_access_bounds.values():
+        for path in bound.paths:
+            if path is not None:
+                paths[path] = paths.get(path, 0) + 1
+    return elapsed / N_INSTANCES, [c.pprint() for c in created], paths
+
+interval_box = array_access_bound.interval_box
+for name, code in kernels.items():
+    array_access_bound.interval_box = lambda *args: None
+    instance.SolverSession = FreshSolvers
+    fresh_time, fresh, _ = create_instances(code)
+    instance.SolverSession = OneByOne
+    session_time, in_session, _ = create_instances(code)
+    instance.SolverSession = SolverSession
+    batch_time, batched, _ = create_instances(code)
+    array_access_bound.interval_box = interval_box
+    interval_time, with_intervals, paths = create_instances(code)
+    assert(fresh == in_session == batched == with_intervals)
+    print(f'{name} ({N_INSTANCES} instances, dimensions by {paths})')
+    print(f'  fresh solvers:            {fresh_time * 1000:7.2f}ms per instance')
+    print(f'  session:                  {session_time * 1000:7.2f}ms per instance')
+    print(f'  session, batch:           {batch_time * 1000:7.2f}ms per instance')
+    print(f'  session, batch, interval: {interval_time * 1000:7.2f}ms per instance')
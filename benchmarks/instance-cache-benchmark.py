@@ -0,0 +1,103 @@
+import os
+import random
+import sys
+import tempfile
+import time
+from loguru import logger
+from instance import try_create_instance
+from instance_cache import InstanceCache
+from pattern import parse_str
+from constant_assignment import VariableMap
+from type_assignment import TypeAssignment
+
+# Runs a campaign (every pattern at every size) twice on the same cache
+# file, like re-running it, and then without a cache. The second run
+# finds every outcome in the cache, the ones without an instance too,
+# and makes the same instances.
+#
+# Run from the repository root: PYTHONPATH=. python benchmarks/instance-cache-benchmark.py
+
+logger.remove()
+logger.add(sys.stderr, level='ERROR')
+
+SIZES = [100, 200, 400, 800, 1600]
+N_TRIES = 4
+
+patterns = [
+    # Triangular, so every dimension is bounded by z3
+    """
+declare N;
+declare A[][];
+declare B[][];
+declare C[][];
+
+for [(i, >=0, <=N), (j, >=0, <=199), (k, >=i, <=N)] {
+  A[i][j] = A[i][j] + B[i][k] * C[k][j];
+}
+""",
+    """
+declare N;
+declare A[][];
+declare B[][];
+
+for [(i, >=1, <=N), (j, >=i, <=N)] {
+  A[i][j] = A[i - 1][j] + B[j][i];
+}
+""",
+    # The bounds of j and k are constants that get random values, so
+    # each try is another pattern (some without iterations)
+    """
+declare N;
+declare A[][];
+declare B[][];
+declare C[][];
+
+for [(i, >=0, <=N), j, k] {
+  A[i][j] = A[i][j] + B[i][k] * C[k][j];
+}
+""",
+    # B is too small, no instance
+    """
+declare N;
+declare A[];
+declare B[10];
+
+for [(i, >=0, <=N)] {
+  A[i] = B[i];
+}
+""",
+]
+
+def run(cache):
+    random.seed(0)
+    created = []
+    begin = time.perf_counter()
+    for code in patterns:
+        program = parse_str(code)
+        program.populate_decls(None)
+        for size in SIZES:
+            var_map = VariableMap()
+            var_map.set_value('N', size)
+            types = TypeAssignment(default_types=['int'])
+            for array in ['A', 'B', 'C']:
+                types.set(array, 'double')
+            for _ in range(N_TRIES):
+                instance = try_create_instance(program, var_map, types, False, cache)
+                created.append(None if instance is None else instance.pprint())
+    return time.perf_counter() - begin, created
+
+with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, 'instances.sqlite')
+    cache = InstanceCache(path)
+    cold_time, cold = run(cache)
+    print(f'cold: {cold_time:6.2f}s {cache.report()}')
+    cache.close()
+
+    cache = InstanceCache(path)
+    warm_time, warm = run(cache)
+    print(f'warm: {warm_time:6.2f}s {cache.report()}')
+    cache.close()
+
+uncached_time, uncached = run(None)
+print(f'no cache: {uncached_time:6.2f}s')
+assert(cold == warm == uncached)
@@ -0,0 +1,101 @@
+import gc
+import time
+import tracemalloc
+from pattern import parse_str
+from pattern_ast import Assignment, Access, Op, Literal, AbstractLoop, Program, HashConsTable
+
+# Measures the memory held by a heavily unrolled matmul: the k loop is
+# unrolled by hand into N_UNROLLED statements
+#   C[i][j] = C[i][j] + A[i][k + u] * B[k + u][j];
+# with the loop's attributes assigned, as dependence analysis does.
+#
+# Run from the repository root: PYTHONPATH=. python benchmarks/memory-benchmark.py
+
+N_UNROLLED = 10000
+
+matmul = parse_str('''
+declare A[][];
+declare B[][];
+declare C[][];
+
+for [i, j, (k, +=4)] {
+  C[i][j] = C[i][j] + A[i][k] * B[k][j];
+}
+''')
+
+def k_plus(u):
+    return Op('+', [Access('k'), Literal(int, u)])
+
+def unrolled_stmt(u):
+    return Assignment(
+        Access('C', [Access('i'), Access('j')]),
+        Op('+', [Access('C', [Access('i'), Access('j')]),
+                 Op('*', [Access('A', [Access('i'), k_plus(u)]),
+                          Access('B', [k_plus(u), Access('j')])])]))
+
+def build():
+    loop = matmul.body[0].clone()
+    loop.replace_body([unrolled_stmt(u) for u in range(N_UNROLLED)])
+    program = Program([d.clone() for d in matmul.decls], [loop],
+                      [c.clone() for c in matmul.consts])
+    # Only statements get attributes, like node ids on a dependence graph
+    for i, stmt in enumerate(loop.body):
+        stmt.attributes['node_id'] = i
+    return program
+
+def count_nodes(program):
+    n = 0
+    def visit(node):
+        nonlocal n
+        n += 1
+        if type(node) == Access:
+            for index in node.indices:
+                visit(index)
+        elif type(node) == Op:
+            for arg in node.args:
+                visit(arg)
+        elif type(node) == Assignment:
+            visit(node.lhs)
+            visit(node.rhs)
+        elif type(node) == AbstractLoop:
+            for stmt in node.body:
+                visit(stmt)
+    for stmt in program.body:
+        visit(stmt)
+    return n
+
+tracemalloc.start()
+begin = time.perf_counter()
+program = build()
+build_time = time.perf_counter() - begin
+held, _ = tracemalloc.get_traced_memory()
+
+tracemalloc.reset_peak()
+before_clone, _ = tracemalloc.get_traced_memory()
+begin = time.perf_counter()
+cloned = program.clone()
+clone_time = time.perf_counter() - begin
+after_clone, _ = tracemalloc.get_traced_memory()
+
+# Hash-consing the clone shares the repeated subexpressions. The trees
+# have back pointers, so they're only freed by the cycle collector.
+del cloned
+gc.collect()
+before_interning, _ = tracemalloc.get_traced_memory()
+cloned = program.clone()
+begin = time.perf_counter()
+table = HashConsTable()
+table.intern_stmts(cloned.body)
+intern_time = time.perf_counter() - begin
+gc.collect()
+after_interning, _ = tracemalloc.get_traced_memory()
+tracemalloc.stop()
+
+n_nodes = count_nodes(program)
+print(f'nodes:  {n_nodes}')
+print(f'build:  {held / 2**20:7.2f}MiB ({held / n_nodes:5.1f}B/node) {build_time:.3f}s')
+clone_size = after_clone - before_clone
+print(f'clone:  {clone_size / 2**20:7.2f}MiB ({clone_size / n_nodes:5.1f}B/node) {clone_time:.3f}s')
+interned_size = after_interning - before_interning
+print(f'interned clone: {interned_size / 2**20:7.2f}MiB (incl. table) {intern_time:.3f}s, '
+      f'{table.n_shared} of {table.n_interned} subtrees shared')
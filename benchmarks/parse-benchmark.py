@@ -0,0 +1,60 @@
+import random
+import time
+from lark import Lark
+from pattern import grammar, parse_str, ParserRegistry, TreeSimplifier
+
+# Parses 10k expressions and 10k statements with the parser registry and
+# compares that with building a new Earley parser for every call, which
+# is what parse_str used to do.
+#
+# Run from the repository root: PYTHONPATH=. python benchmarks/parse-benchmark.py
+
+N = 10000
+# Earley is far too slow to run on the whole set
+N_EARLEY = 50
+
+random.seed(0)
+
+def random_expr(depth=0):
+    if depth > 2 or random.random() < 0.3:
+        return random.choice(['i', 'j', 'n', '1', '2.5', 'A[i][j]', 'B[i+1]'])
+    op = random.choice(['+', '-', '*', '/', '<<', '<', '==', '&&'])
+    return f'({random_expr(depth+1)} {op} {random_expr(depth+1)})'
+
+exprs = [random_expr() for _ in range(N)]
+stmts = [f'A[i][j] = {expr};' for expr in exprs]
+
+def uncached_parse(code, start_rule):
+    parser = Lark(grammar, start=start_rule)
+    return TreeSimplifier().transform(parser.parse(code))
+
+def bench(name, codes, parse):
+    begin = time.perf_counter()
+    for code in codes:
+        parse(code)
+    elapsed = time.perf_counter() - begin
+    per_call = elapsed / len(codes) * 1e6
+    print(f'{name:40} {len(codes):6} parses {elapsed:8.3f}s {per_call:10.1f}us/parse')
+
+bench('uncached earley (expr)', exprs[:N_EARLEY],
+      lambda code: uncached_parse(code, 'expr'))
+bench('uncached earley (statement)', stmts[:N_EARLEY],
+      lambda code: uncached_parse(code, 'statement'))
+
+registry = ParserRegistry()
+bench('registry earley (expr)', exprs[:N_EARLEY], lambda code: registry.parse_earley(code, 'expr'))
+bench('registry earley (statement)', stmts[:N_EARLEY], lambda code: registry.parse_earley(code, 'statement'))
+bench('registry lalr (expr)', exprs, lambda code: parse_str(code, 'expr'))
+bench('registry lalr (statement)', stmts, lambda code: parse_str(code, 'statement'))
+bench('recursive descent (expr)', exprs, lambda code: parse_str(code, 'expr', backend='rd'))
+bench('recursive descent (statement)', stmts, lambda code: parse_str(code, 'statement', backend='rd'))
+
+# Building the LALR parsers in a cold process, with and without the
+# serialized parser cache.
+for use_cache in [False, True]:
+    registry = ParserRegistry(use_cache=use_cache)
+    begin = time.perf_counter()
+    for start_rule in ['start', 'statement', 'expr']:
+        registry.lalr(start_rule)
+    elapsed = time.perf_counter() - begin
+    print(f'build lalr parsers (cache={use_cache}): {elapsed:.3f}s')
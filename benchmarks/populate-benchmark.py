@@ -0,0 +1,103 @@
+import random
+import sys
+import time
+from loguru import logger
+from pattern_ast import Program, Declaration, Assignment, Access, Literal, ExpressionHole
+from populator import PopulateParameters, populate_expr, ChoicePool, AliasTable
+
+# Fills a program with a hole in each of N_FAMILIES families and
+# N_FINITE holes of one finite family, with the families looked up by
+# name (the default matcher) and by asking a matching function about
+# every family, and checks that both give the same program for the same
+# seed. Then compares picking from a finite pool by list.remove, by a
+# ChoicePool that keeps the order (and picks the same) and by swapping,
+# and weighted picks with random.choices and an alias table.
+#
+# Run from the repository root: PYTHONPATH=. python benchmarks/populate-benchmark.py
+
+logger.remove()
+logger.add(sys.stderr, level='WARNING')
+
+N_FAMILIES = 2000
+N_FINITE = 20000
+N_WEIGHTED = 1000
+N_PICKS = 100000
+
+def make_program():
+    body = []
+    for k in range(N_FAMILIES):
+        body.append(Assignment(Access('A', [Literal(int, k)]), ExpressionHole('_', f'f{k}')))
+    for k in range(N_FINITE):
+        body.append(Assignment(Access('B', [Literal(int, k)]), ExpressionHole('_', 'finite')))
+    return Program([Declaration('A', 1), Declaration('B', 1)], body, [])
+
+def fill(program, matches):
+    random.seed(0)
+    parameters = PopulateParameters()
+    for k in range(N_FAMILIES):
+        parameters.add(f'f{k}', [Literal(int, v) for v in range(4)])
+    # Swapping, so the time is the time of looking up families
+    parameters.add('finite', [Literal(int, v) for v in range(N_FINITE)], is_finite=True,
+                   swap_remove=True)
+    begin = time.perf_counter()
+    filled = populate_expr(program.clone(), parameters.populate, matches)
+    return time.perf_counter() - begin, filled.pprint()
+
+program = make_program()
+indexed_time, indexed = fill(program, None)
+scan_time, scanned = fill(program, lambda node_family, family: node_family == family)
+assert(indexed == scanned)
+
+print(f'filling {N_FAMILIES} families and {N_FINITE} finite picks')
+print(f'  match every family: {scan_time:.3f}s')
+print(f'  look up by name:    {indexed_time:.3f}s')
+
+def drain_list():
+    random.seed(0)
+    choices = [Literal(int, v) for v in range(N_FINITE)]
+    picked = []
+    while choices:
+        chosen = random.choice(choices)
+        picked.append(chosen.val)
+        choices.remove(chosen)
+    return picked
+
+def drain_pool(swap_remove):
+    random.seed(0)
+    pool = ChoicePool([Literal(int, v) for v in range(N_FINITE)], swap_remove)
+    picked = []
+    while len(pool) > 0:
+        chosen = random.choice(pool.choices)
+        picked.append(chosen.val)
+        pool.remove(chosen)
+    return picked
+
+print(f'picking all of a finite family of {N_FINITE}')
+drained = {}
+for name, drain in [('list.remove', drain_list),
+                    ('ordered pool', lambda: drain_pool(False)),
+                    ('swap', lambda: drain_pool(True))]:
+    begin = time.perf_counter()
+    drained[name] = drain()
+    print(f'  {name + ":":<19} {time.perf_counter() - begin:.3f}s')
+assert(drained['ordered pool'] == drained['list.remove'])
+
+population = list(range(N_WEIGHTED))
+weights = [1 + v % 7 for v in population]
+
+random.seed(0)
+begin = time.perf_counter()
+for _ in range(N_PICKS):
+    random.choices(population, weights)
+choices_time = time.perf_counter() - begin
+
+random.seed(0)
+begin = time.perf_counter()
+table = AliasTable(weights)
+for _ in range(N_PICKS):
+    population[table.pick(random.choice)]
+alias_time = time.perf_counter() - begin
+
+print(f'{N_PICKS} weighted picks from {N_WEIGHTED} choices')
+print(f'  random.choices:     {choices_time:.3f}s')
+print(f'  alias table:        {alias_time:.3f}s')
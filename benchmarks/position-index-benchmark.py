@@ -0,0 +1,57 @@
+import time
+from pattern import parse_str
+from pattern_ast import gather_surrounding_loops
+
+# Compares answering "which loops surround both statements and which one
+# runs first" for every pair of statements by walking up the tree, as
+# dependence analysis used to, with the program's position index.
+#
+# Run from the repository root: PYTHONPATH=. python benchmarks/position-index-benchmark.py
+
+N_STMTS = 100
+
+def nest(depth):
+    if depth == 0:
+        return '\n'.join(f'A[i0] = A[i0] + {u};' for u in range(N_STMTS))
+    return f'for [(i{depth}, >=0, <=9)] {{\n{nest(depth - 1)}\n}}'
+
+program = parse_str(f'declare A[];\nfor [(i0, >=0, <=9)] {{\n{nest(4)}\n{nest(4)}\n}}')
+
+stmts = []
+def collect(loop):
+    for stmt in loop.body:
+        stmts.append(stmt)
+        if hasattr(stmt, 'body'):
+            collect(stmt)
+collect(program)
+
+def walk_up(stmt1, stmt2):
+    loops1 = gather_surrounding_loops(stmt1)
+    loops2 = gather_surrounding_loops(stmt2)
+    common = []
+    for loop1, loop2 in zip(loops1, loops2):
+        if loop1 is not loop2:
+            break
+        common.append(loop1)
+    trace1 = loops1 + [stmt1]
+    trace2 = loops2 + [stmt2]
+    body = common[-1].body
+    n = len(common)
+    return common, body.index(trace1[n]) < body.index(trace2[n])
+
+begin = time.perf_counter()
+for stmt1 in stmts:
+    for stmt2 in stmts:
+        walk_up(stmt1, stmt2)
+walk_time = time.perf_counter() - begin
+
+begin = time.perf_counter()
+positions = program.position_index()
+for stmt1 in stmts:
+    for stmt2 in stmts:
+        positions.common_loops(stmt1, stmt2), positions.precedes(stmt1, stmt2)
+index_time = time.perf_counter() - begin
+
+print(f'{len(stmts) ** 2} statement pairs')
+print(f'walk up: {walk_time:.3f}s')
+print(f'index:   {index_time:.3f}s (including numbering)')
@@ -0,0 +1,60 @@
+import random
+import sys
+import time
+from pattern import parse_str
+from pattern_ast import Times0, Times1, Plus0, rewrite, Access, Assignment, Literal, Op
+
+# Simplifies 0s and 1s in a program with N_STMTS statements, with one
+# replace() pass per rule (the old simplify_0s_and_1s) and with one
+# rewrite() pass applying all three. Then rewrites an index nested far
+# deeper than the recursion limit.
+#
+# Run from the repository root: PYTHONPATH=. python benchmarks/rewrite-benchmark.py
+
+N_STMTS = 2000
+DEPTH = 100000
+
+random.seed(0)
+
+def random_expr(depth=0):
+    if depth > 3:
+        return random.choice(['A[i][j]', 'B[i * 1][j + 0]', '0', '1', 'x'])
+    op = random.choice(['+', '*'])
+    return f'({random_expr(depth + 1)} {op} {random_expr(depth + 1)})'
+
+stmts = '\n'.join(f'  A[i][j] = {random_expr()};' for _ in range(N_STMTS))
+program = parse_str(f'''
+declare A[][];
+declare B[][];
+for [(i, >=0, <=99), (j, >=0, <=99)] {{
+{stmts}
+}}
+''')
+
+passes = program.clone()
+begin = time.perf_counter()
+passes.replace(Times0())
+passes.replace(Times1(), dfs=True)
+passes.replace(Plus0(), dfs=True)
+passes_time = time.perf_counter() - begin
+
+fused = program.clone()
+begin = time.perf_counter()
+fused = rewrite(fused, [Times0(), Times1(), Plus0()])
+fused_time = time.perf_counter() - begin
+
+print(f'3 replace() passes: {passes_time:.3f}s')
+print(f'1 rewrite() pass:   {fused_time:.3f}s')
+# The passes miss rewrites that only appear after a later rule ran,
+# like (0 + 0) * x, so they can leave more behind
+passes = rewrite(passes, [Times0(), Times1(), Plus0()])
+print(f'same result after finishing the passes: {passes.is_syntactically_equal(fused)}')
+
+index = Access('i')
+for _ in range(DEPTH):
+    index = Op('+', [index, Literal(int, 0)])
+stmt = Assignment(Access('A', [index]), Literal(int, 1))
+begin = time.perf_counter()
+stmt = rewrite(stmt, [Plus0()])
+print(f'{DEPTH}-deep index (recursion limit {sys.getrecursionlimit()}): '
+      f'{stmt.lhs.pprint()} in {time.perf_counter() - begin:.3f}s')
@@ -0,0 +1,57 @@
+import os
+import random
+import tempfile
+import time
+from pattern import parse_str
+from pattern_serialization import save_programs, load_programs
+
+# Saves 100k generated programs as source text and in the binary format,
+# then compares loading them back with parse_str and with load_programs.
+#
+# Run from the repository root: PYTHONPATH=. python benchmarks/serialization-benchmark.py
+
+N = 100000
+# Parsing all of them takes minutes, so parse a sample and scale up
+N_PARSED = 5000
+
+random.seed(0)
+
+def random_index(var):
+    return random.choice([var, f'{var} + 1', f'{var} - 1'])
+
+def random_expr(depth=0):
+    if depth > 1 or random.random() < 0.3:
+        return random.choice(['A[i][j]', f'B[{random_index("i")}][j]',
+                              f'C[i][{random_index("j")}]', 'n', '2', '0.5'])
+    op = random.choice(['+', '-', '*', '/'])
+    return f'{random_expr(depth+1)} {op} {random_expr(depth+1)}'
+
+def random_program():
+    stmts = '\n'.join(f'    A[i][j] = {random_expr()};' for _ in range(random.randint(1, 3)))
+    return (f'declare A[][];\ndeclare B[][];\ndeclare C[][];\n'
+            f'for [(i, >=1, <=n - 2), j] {{\n{stmts}\n}}\n')
+
+codes = [random_program() for _ in range(N)]
+
+begin = time.perf_counter()
+programs = [parse_str(code) for code in codes[:N_PARSED]]
+parse_time = (time.perf_counter() - begin) / N_PARSED * N
+print(f'parse_str:     {parse_time:8.2f}s for {N} programs (from {N_PARSED})')
+
+# Save the parsed sample repeatedly so that the file holds N programs
+programs = [programs[i % N_PARSED] for i in range(N)]
+with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, 'programs.bin')
+    begin = time.perf_counter()
+    save_programs(path, programs)
+    elapsed = time.perf_counter() - begin
+    print(f'save_programs: {elapsed:8.2f}s for {N} programs')
+
+    begin = time.perf_counter()
+    n_loaded = sum(1 for _ in load_programs(path))
+    elapsed = time.perf_counter() - begin
+    print(f'load_programs: {elapsed:8.2f}s for {n_loaded} programs '
+          f'({parse_time / elapsed:.1f}x faster than parse_str)')
+
+    text_size = sum(len(codes[i % N_PARSED]) for i in range(N))
+    print(f'size: {os.path.getsize(path)} bytes binary, {text_size} bytes source')
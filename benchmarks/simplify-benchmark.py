@@ -0,0 +1,78 @@
+import contextlib
+import io
+import itertools
+import random
+import sys
+from loguru import logger
+from pattern import parse_str
+from pattern_ast import Node, child_fields
+from loop_unroll import LoopUnroll
+from loop_tiling import tile_loop
+from loop_unroll_and_jam import LoopUnrollAndJam
+
+# Counts the nodes of the programs that unrolling, tiling and unroll and
+# jam produce, with and without simplifying them afterwards.
+#
+# Run from the repository root: PYTHONPATH=. python benchmarks/simplify-benchmark.py
+
+N_VARIANTS = 200
+
+logger.remove()
+logger.add(sys.stderr, level='WARNING')
+
+pattern = parse_str('''
+declare A[][][];
+declare B[][][];
+for [(i, >=0, <=63), (j, >=0, <=63), (k, >=1, <=62)] {
+  A[i][j][k] = A[i][j][k - 1] + B[i][j][k + 1] * 2;
+  B[i][j][k] = A[i][j][k] * 0.5;
+}
+''')
+
+def count_nodes(root):
+    n = 0
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        n += 1
+        for name, is_list in child_fields[type(node)]:
+            value = getattr(node, name)
+            children = value if is_list else [value]
+            stack += [child for child in children if isinstance(child, Node)]
+    return n
+
+def report(name, make_variants):
+    counts = []
+    for simplify in [False, True]:
+        random.seed(0)
+        variants = list(make_variants(simplify))
+        counts.append(sum(count_nodes(variant) for variant in variants))
+    before, after = counts
+    print(f'{name:16} {before:9} nodes -> {after:9} nodes '
+          f'({100 * (before - after) / before:4.1f}% fewer)')
+
+def unrolled(simplify):
+    return itertools.islice(LoopUnroll(4, simplify=simplify).transform(pattern),
+                            N_VARIANTS)
+
+def tiled(simplify):
+    for _ in range(N_VARIANTS):
+        sizes = [random.choice([4, 8, 16, 32]) for _ in range(3)]
+        yield tile_loop(pattern.body[0], 0, sizes, simplify=simplify)
+
+class PatternOnly:
+    def __init__(self, pattern):
+        self.pattern = pattern
+    def clone(self):
+        return PatternOnly(self.pattern.clone())
+
+def unrolled_and_jammed(simplify):
+    # LoopUnrollAndJam prints its progress
+    with contextlib.redirect_stdout(io.StringIO()):
+        transformed = LoopUnrollAndJam(4, simplify=simplify).transform(PatternOnly(pattern))
+        return [instance.pattern for instance in itertools.islice(transformed, N_VARIANTS)]
+
+print(f'{N_VARIANTS} variants each')
+report('unroll', unrolled)
+report('tiling', tiled)
+report('unroll and jam', unrolled_and_jammed)
@@ -0,0 +1,51 @@
+import compileall
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# Measures the startup cost of a short-lived worker: "import api" followed
+# by a first parse_str, with and without the stand-alone parser.
+#
+# Run from the repository root: python benchmarks/startup-benchmark.py
+
+N_RUNS = 10
+
+import_only = 'import api'
+import_and_parse = (
+    'import api\n'
+    'from pattern import parse_str\n'
+    'parse_str("declare A[]; for [i] { A[i] = A[i] + 1; }")\n'
+)
+
+# Byte-compile the modules up front, as an installed copy would be. The
+# stand-alone parser is large and compiling it from source on every run
+# would dominate the measurement.
+compileall.compile_dir(os.getcwd(), maxlevels=0, quiet=1)
+
+def run(code, extra_env):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.getcwd()
+    env.update(extra_env)
+    begin = time.perf_counter()
+    for _ in range(N_RUNS):
+        subprocess.run([sys.executable, '-c', code], env=env, check=True)
+    return (time.perf_counter() - begin) / N_RUNS
+
+with tempfile.NamedTemporaryFile() as not_a_dir:
+    configs = [
+        ('standalone', {}),
+        ('lark, cached lalr', {'LOOPGEN_NO_STANDALONE': '1'}),
+        # The cache directory can't be created, so every run compiles
+        # the grammar
+        ('lark, no cache', {'LOOPGEN_NO_STANDALONE': '1',
+                            'LOOPGEN_CACHE_DIR': not_a_dir.name}),
+    ]
+    # Warm up the cache for the "cached lalr" configuration
+    run(import_and_parse, configs[1][1])
+    for name, env in configs:
+        for label, code in [('import api', import_only),
+                            ('import api + parse_str', import_and_parse)]:
+            elapsed = run(code, env)
+            print(f'{name:20} {label:25} {elapsed * 1000:8.1f}ms')
@@ -0,0 +1,74 @@
+import gc
+import itertools
+import random
+import sys
+import time
+import tracemalloc
+from loguru import logger
+from pattern import parse_str
+from loop_interchange import LoopInterchange, NTries
+from loop_unroll import LoopUnroll
+from pattern_persistent import materialize
+
+# A campaign of 10k interchange variants and 1k unroll variants of one
+# pattern, keeping every variant, with and without the persistent mode.
+# Reports the time and the memory held by the variants, measured with
+# tracemalloc. Unrolled variants are ~50x larger than the pattern, so 10k
+# of them take minutes and gigabytes without the persistent mode.
+#
+# Run from the repository root: PYTHONPATH=. python benchmarks/variant-benchmark.py
+
+N_INTERCHANGE = 10000
+N_UNROLL = 1000
+
+logger.remove()
+logger.add(sys.stderr, level='WARNING')
+
+interchange_pattern = parse_str('''
+declare A[][][];
+declare B[][][];
+for [(i, >=0, <=31), (j, >=0, <=31), (k, >=0, <=31)] {
+  A[i][j][k] = A[i][j][k] + B[i][j][k] * 2;
+  B[i][j][k] = B[i][j][k] * A[i][j][k] - 1;
+}
+''')
+
+unroll_pattern = parse_str('''
+declare A[][];
+declare B[][];
+declare C[][];
+for [(i, >=0, <=63), (j, >=0, <=63)] {
+  A[i][j] = A[i][j] + B[i][j] * C[j][i];
+  B[i][j] = B[i][j] * 0.5 + C[i][j];
+  C[i][j] = A[i][j] - B[i][j];
+}
+''')
+
+def campaign(name, variants, n):
+    gc.collect()
+    tracemalloc.start()
+    begin = time.perf_counter()
+    kept = list(itertools.islice(variants, n))
+    elapsed = time.perf_counter() - begin
+    gc.collect()
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name:30} {len(kept)} variants {elapsed:7.2f}s '
+          f'held {held / 2**20:7.2f}MiB peak {peak / 2**20:7.2f}MiB')
+    return kept
+
+for persistent in [False, True]:
+    random.seed(0)
+    mode = 'persistent' if persistent else 'clone'
+    campaign(f'interchange ({mode})',
+             LoopInterchange(persistent=persistent).transform(interchange_pattern, NTries(N_INTERCHANGE)),
+             N_INTERCHANGE)
+    kept = campaign(f'unroll ({mode})',
+                    LoopUnroll(4, persistent=persistent).transform(unroll_pattern),
+                    N_UNROLL)
+
+# Only the variants that are used need a full tree
+begin = time.perf_counter()
+materialized = [materialize(variant) for variant in kept[:100]]
+elapsed = time.perf_counter() - begin
+print(f'materialize 100 unroll variants: {elapsed:.3f}s')
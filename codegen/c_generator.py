@@ -1,8 +1,12 @@
+import re
+from io import StringIO
 from pathlib import Path
 from shutil import copy2
 from string import Template
-from pattern_ast import (Declaration, Literal, Hex, Assignment,
-                         Access, LoopShape, AbstractLoop, Op, Program, NoOp)
+from pattern_ast import (Declaration, Literal, Hex, Assignment, CodeWriter,
+                         Access, LoopShape, AbstractLoop, Op, Program, NoOp,
+                         current_print_context, printing)
+from pattern_affine import affine_form
 from constant_assignment import VariableMap
 
 def loop_header(loop_var, loop_var_ty, begin, ends, step):
@@ -12,8 +16,10 @@ def loop_header(loop_var, loop_var_ty, begin, ends, step):
             f'{end_clauses}; '
             f'{loop_var} += {step}) {{')
 
+spaces_per_indent = 2
+
 def spaces(indent):
-    return '  ' * indent
+    return ' ' * (spaces_per_indent * indent)
 
 def is_local(decl):
     return decl.is_local
@@ -125,31 +131,40 @@ class CGenerator:
         ])
 
     def nested_loops_full(self, loop_vars, min_indices, max_indices, steps, generate_body):
-        lines = []
-
+        out = StringIO()
+        writer = CodeWriter(out, self.indent, spaces_per_indent)
+        indent = self.indent
+        # generate_body indents through self.no_indent()
+        def write_body(writer, loop_vars):
+            self.indent = writer.depth
+            writer.preformatted(generate_body(loop_vars))
+        self.write_nested_loops_full(writer, loop_vars, min_indices, max_indices,
+                                     steps, write_body)
+        self.indent = indent
+        return out.getvalue()
+
+    def write_nested_loops_full(self, writer, loop_vars, min_indices, max_indices, steps, write_body):
         n_dimensions = len(loop_vars)
         assert(n_dimensions == len(min_indices))
         assert(n_dimensions == len(max_indices))
 
         # open loop header
-        ws = self.no_indent()
         for loop_var, begin, ends, step in zip(loop_vars, min_indices, max_indices, steps):
             loop_var_ty = 'int'
             for decl in self.iterate_decls():
                 if loop_var == decl.name:
                     loop_var_ty = ''
                     break
-            lines.append(f'{ws}{loop_header(loop_var, loop_var_ty, begin, ends, step)}')
-            ws = self.indent_in()
+            writer.line(loop_header(loop_var, loop_var_ty, begin, ends, step))
+            writer.indent()
 
         # body
-        lines.append(generate_body(loop_vars))
+        write_body(writer, loop_vars)
 
         # close loop header
         for _ in range(n_dimensions):
-            lines.append(f'{self.indent_out()}}}')
-
-        return '\n'.join(lines)
+            writer.dedent()
+            writer.line('}')
 
     def nested_loops(self, min_indices, max_indices, generate_body):
         loop_vars = [f'i{depth}' for depth in range(len(min_indices))]
@@ -181,7 +196,7 @@ class CGenerator:
         max_indices = []
         for declared_size, analyzed_bound in zip(decl.sizes, self.access_bounds[decl.name].max_indices):
             if analyzed_bound is None:
-                max_index = Op('-', [declared_size.clone(), Literal(int, 1)]).pprint()
+                max_index = affine_form(declared_size).plus(-1).pprint()
             else:
                 max_index = analyzed_bound
             max_indices.append(max_index)
@@ -303,14 +318,20 @@ class CGenerator:
             ])
 
     def ast(self, node):
+        ty = type(node)
+        if ty == Op or ty == Access or ty == Hex or ty == Literal:
+            return node.pprint()
+        out = StringIO()
+        self.write_ast(node, CodeWriter(out, self.indent, spaces_per_indent))
+        return out.getvalue()
+
+    def write_ast(self, node, writer):
         ty = type(node)
         if ty == Program:
-            self.indent_in()
-            lines = []
+            writer.indent()
             for stmt in node.body:
-                lines.append(self.ast(stmt))
-            self.indent_out()
-            return '\n'.join(lines)
+                self.write_ast(stmt, writer)
+            writer.dedent()
         elif ty == AbstractLoop:
             # get loop vars, min_indices, max_indices
             loop_vars = []
@@ -325,28 +346,46 @@ class CGenerator:
                 assert(type(shape.step) == Literal and
                        shape.step.ty == int)
                 steps.append(self.ast(shape.step))
-            def generate_body(loop_vars):
-                return '\n'.join([
-                    self.ast(stmt) for stmt in node.body
-                ])
-            return self.nested_loops_full(loop_vars,
-                                          min_indices,
-                                          max_indices,
-                                          steps,
-                                          generate_body)
-        elif ty == Assignment:
-            return f'{self.no_indent()}{node.pprint()}'
-        elif ty == Op or ty == Access or ty == Hex or ty == Literal:
-            return node.pprint()
-        elif ty == NoOp:
-            return f'{self.no_indent()}{node.pprint()}'
+            def write_body(writer, loop_vars):
+                for stmt in node.body:
+                    self.write_ast(stmt, writer)
+            self.write_nested_loops_full(writer,
+                                         loop_vars,
+                                         min_indices,
+                                         max_indices,
+                                         steps,
+                                         write_body)
+        elif ty == Assignment or ty == NoOp:
+            writer.line(node.pprint())
         else:
             assert(False)
 
     def core_code(self):
         return self.ast(self.pattern)
 
-def generate_code(output_dir, instance, init_value_map=None, template_dir=None):
+    def write_core_code(self, out):
+        self.write_ast(self.pattern, CodeWriter(out, self.indent, spaces_per_indent))
+
+# Fills in a template like Template.substitute, except that the
+# placeholders in streamed are written out by calling streamed[name](out)
+def write_template(template_str, template_dict, streamed, out):
+    placeholders = '|'.join(re.escape(f'${{{name}}}') for name in streamed)
+    begin = 0
+    for match in re.finditer(placeholders, template_str):
+        out.write(Template(template_str[begin:match.start()]).substitute(template_dict))
+        streamed[match.group()[2:-1]](out)
+        begin = match.end()
+    out.write(Template(template_str[begin:]).substitute(template_dict))
+
+# Prints with print_context, the caller's PrintContext by default
+def generate_code(output_dir, instance, init_value_map=None, template_dir=None,
+                  print_context=None):
+    if print_context is None:
+        print_context = current_print_context.get()
+    with printing(print_context):
+        write_code_files(output_dir, instance, init_value_map, template_dir)
+
+def write_code_files(output_dir, instance, init_value_map=None, template_dir=None):
     if template_dir is None:
         template_dir = 'codegen'
     if init_value_map is None:
@@ -365,8 +404,9 @@ def generate_code(output_dir, instance, init_value_map=None, template_dir=None):
     dst_make_path = f'{output_dir}/Makefile'
     copy2(src_make_path, dst_make_path)
 
-    # prepare template dictionary
+    # prepare template dictionary, the core code is streamed
     cgen = CGenerator(instance, init_value_map)
+    streamed = {'core_code': cgen.write_core_code}
     template_dict = {
         'define_scalars': cgen.define_scalars(),
         'define_arrays': cgen.define_arrays(),
@@ -378,7 +418,6 @@ def generate_code(output_dir, instance, init_value_map=None, template_dir=None):
         'allocate_arrays_code': cgen.allocate_arrays_code(),
         'calculate_checksum_code': cgen.calculate_checksum_code(is_ptr=False),
         'calculate_checksum_code_as_ptr': cgen.calculate_checksum_code(is_ptr=True),
-        'core_code': cgen.core_code(),
 
         'scalar_externs': cgen.scalar_externs(),
         'array_externs': cgen.array_externs(),
@@ -392,20 +431,18 @@ def generate_code(output_dir, instance, init_value_map=None, template_dir=None):
     # fill template
     wrapper_template_path = Path(f'{template_dir}/wrapper.template.c')
     wrapper_template_str = wrapper_template_path.read_text()
-    wrapper_template = Template(wrapper_template_str)
-    wrapper_str = wrapper_template.substitute(template_dict)
 
     # write
     wrapper_dst_path = Path(f'{output_dir}/wrapper.c')
-    wrapper_dst_path.write_text(wrapper_str)
+    with wrapper_dst_path.open('w') as f:
+        write_template(wrapper_template_str, template_dict, streamed, f)
 
     # core
     # fill template
     core_template_path = Path(f'{template_dir}/core.template.c')
     core_template_str = core_template_path.read_text()
-    core_template = Template(core_template_str)
-    core_str = core_template.substitute(template_dict)
 
     # write
     core_dst_path = Path(f'{output_dir}/core.c')
-    core_dst_path.write_text(core_str)
+    with core_dst_path.open('w') as f:
+        write_template(core_template_str, template_dict, streamed, f)
@@ -1,10 +1,9 @@
 from z3 import Solver, Ints, unsat, Optimize, sat, Int
 from loguru import logger
-from pattern_ast import get_accesses, Program, AbstractLoop, Access, Op, Literal, Hex, gather_surrounding_loops, gather_loop_shapes, gather_loop_vars, Assignment
+from pattern_ast import Program, AbstractLoop, Access, Op, Literal, Hex, get_position_index, gather_loop_shapes, gather_loop_vars, Assignment
 from dependence_graph import Dependence, DependenceGraph
-
-def is_ordered(l, v1, v2):
-    return l.index(v1) < l.index(v2)
+from pattern_affine import affine_indices, may_be_equal
+from z3_utils import affine_to_cexpr, index_to_cexpr
 
 # Assign node ids to the body of the programs (declarations aren't assigned anything )
 def assign_node_ids(program):
@@ -51,9 +50,11 @@ def analyze_dependence(program):
     scalar_cvars = generate_scalar_constraint_vars(program.decls)
 
     graph = DependenceGraph()
+    positions = program_w_attributes.position_index()
     for (ref1, ref2) in iterate_unique_reference_pairs(program_w_attributes):
-        for dependence_dv, model in iterate_dependence_direction_vectors(ref1, ref2, scalar_cvars):
-            for ref1_then_ref2_dv in iterate_execution_order_direction_vector(ref1, ref2):
+        for dependence_dv, model in iterate_dependence_direction_vectors(ref1, ref2, scalar_cvars,
+                                                                         positions=positions):
+            for ref1_then_ref2_dv in iterate_execution_order_direction_vector(ref1, ref2, positions):
                 logger.debug(f'Testing:\n'
                              f'{ref1.pprint()} -> {ref2.pprint()}:, '
                              f'dep({dependence_dv}) exe_order({ref1_then_ref2_dv})')
@@ -64,7 +65,7 @@ def analyze_dependence(program):
                     graph.add(ref1, ref2, dv1)
 
             dependence_dv_inv = negate_direction_vector(dependence_dv)
-            for ref2_then_ref1_dv in iterate_execution_order_direction_vector(ref2, ref1):
+            for ref2_then_ref1_dv in iterate_execution_order_direction_vector(ref2, ref1, positions):
                 logger.debug(f'Testing:\n'
                              f'{ref2.pprint()} -> {ref1.pprint()}:, '
                              f'dep({dependence_dv_inv}) exe_order({ref2_then_ref1_dv})')
@@ -76,54 +77,38 @@ def analyze_dependence(program):
     return graph, program_w_attributes
 
 def iterate_unique_reference_pairs(program):
-    refs = list(get_accesses(program))
-    n_refs = len(refs)
-    for i in range(0, n_refs):
-        for j in range(i, n_refs):
-            ref1 = refs[i]
-            ref2 = refs[j]
-            if ref1.var != ref2.var:
-                continue
-            if not ref1.is_write and not ref2.is_write:
-                continue
-            yield (ref1, ref2)
-
-def iterate_execution_order_direction_vector(source_ref, sink_ref):
+    # Only references to the same variable can depend on each other
+    for refs in program.access_index().by_var.values():
+        n_refs = len(refs)
+        for i in range(0, n_refs):
+            for j in range(i, n_refs):
+                ref1 = refs[i]
+                ref2 = refs[j]
+                if not ref1.is_write and not ref2.is_write:
+                    continue
+                yield (ref1, ref2)
+
+def iterate_execution_order_direction_vector(source_ref, sink_ref, positions=None):
     source_stmt = source_ref.parent_stmt
-    source_loops = gather_surrounding_loops(source_stmt)
-    source_trace = source_loops + [source_stmt]
     sink_stmt = sink_ref.parent_stmt
-    sink_loops = gather_surrounding_loops(sink_stmt)
-    sink_trace = sink_loops + [sink_stmt]
+    if positions is None:
+        positions = get_position_index(source_stmt)
     logger.debug(f'debugging execution order dv\n'
-                 f'source: {source_trace}\n'
-                 f'sink: {sink_trace}')
-
-    common_parents = get_common_prefix(source_loops, sink_loops)
-    n_common_parents = len(common_parents)
+                 f'source: {positions.surrounding_loops(source_stmt) + [source_stmt]}\n'
+                 f'sink: {positions.surrounding_loops(sink_stmt) + [sink_stmt]}')
 
-    assert(n_common_parents > 0)
-    n_common_loops = 0
-    for parent in common_parents:
-        if isinstance(parent, AbstractLoop):
-            n_common_loops += len(parent.loop_shapes)
-
-    common_ancestor = common_parents[-1]
-    source_first_diff = source_trace[n_common_parents]
-    sink_first_diff = sink_trace[n_common_parents]
+    common_ancestor = positions.lowest_common_loop(source_stmt, sink_stmt)
+    n_common_loops = positions[common_ancestor].n_loop_dims
+    is_source_first = positions.precedes(source_stmt, sink_stmt)
 
     if isinstance(common_ancestor, Program):
-        if not is_ordered(common_ancestor.body,
-                          source_first_diff,
-                          sink_first_diff):
+        if not is_source_first:
             yield None
         else:
             yield []
     else:
         assert(isinstance(common_ancestor, AbstractLoop))
-        if is_ordered(common_ancestor.body,
-                      source_first_diff,
-                      sink_first_diff):
+        if is_source_first:
             yield ['<='] + ['<=>'] * (n_common_loops - 1)
         else:
             for lt_position in range(n_common_loops):
@@ -139,22 +124,17 @@ def gather_loop_steps(loop_shapes):
         steps.append(shape.step.val)
     return steps
 
-def get_common_prefix(l1, l2):
-    common = []
-    for v1, v2 in zip(l1, l2):
-        if v1 != v2:
-            break
-        common.append(v1)
-    return common
-
-def iterate_dependence_direction_vectors(source_ref, sink_ref, extra_cvars=None, extra_constraints=None):
+def iterate_dependence_direction_vectors(source_ref, sink_ref, extra_cvars=None, extra_constraints=None,
+                                         positions=None):
     extra_cvars = {} if extra_cvars is None else extra_cvars
     extra_constraints = [] if extra_constraints is None else extra_constraints
+    if positions is None:
+        positions = get_position_index(source_ref.parent_stmt)
 
-    source_loops = gather_surrounding_loops(source_ref.parent_stmt)
+    source_loops = positions.surrounding_loops(source_ref.parent_stmt)
     source_loop_shapes = gather_loop_shapes(source_loops)
     source_loop_vars = gather_loop_vars(source_loop_shapes)
-    sink_loops = gather_surrounding_loops(sink_ref.parent_stmt)
+    sink_loops = positions.surrounding_loops(sink_ref.parent_stmt)
     sink_loop_shapes = gather_loop_shapes(sink_loops)
     sink_loop_vars = gather_loop_vars(sink_loop_shapes)
 
@@ -162,9 +142,15 @@ def iterate_dependence_direction_vectors(source_ref, sink_ref, extra_cvars=None,
         = generate_constraint_vars(source_loop_vars,
                                    sink_loop_vars)
 
+    merged_source_cvars = {**source_cvars, **extra_cvars}
+    merged_sink_cvars = {**sink_cvars, **extra_cvars}
+    if not subscripts_may_overlap(source_ref, merged_source_cvars, source_loop_vars,
+                                  sink_ref, merged_sink_cvars, sink_loop_vars,
+                                  extra_cvars):
+        return
+
     constraints = extra_constraints
 
-    merged_source_cvars = {**source_cvars, **extra_cvars}
     constraints += generate_loop_bound_constraints(source_loop_shapes,
                                                    merged_source_cvars)
 
@@ -172,7 +158,6 @@ def iterate_dependence_direction_vectors(source_ref, sink_ref, extra_cvars=None,
                                              merged_source_cvars,
                                              source_step_cvars)
 
-    merged_sink_cvars = {**sink_cvars, **extra_cvars}
     constraints += generate_loop_bound_constraints(sink_loop_shapes,
                                                    merged_sink_cvars)
 
@@ -206,7 +191,7 @@ def iterate_dependence_direction_vectors(source_ref, sink_ref, extra_cvars=None,
                 yield from iterate_recursive(constraints + [source_cvar > sink_cvar],
                                              remaining_loop_vars[1:],
                                              accumulated_dv + ['>'])
-    common_loops = get_common_prefix(source_loops, sink_loops)
+    common_loops = positions.common_loops(source_ref.parent_stmt, sink_ref.parent_stmt)
     common_loop_shapes = gather_loop_shapes(common_loops)
     common_loop_vars = gather_loop_vars(common_loop_shapes)
     yield from iterate_recursive(constraints, common_loop_vars, [])
@@ -230,10 +215,10 @@ def generate_loop_bound_constraints(loop_shapes, cvars):
         assert(type(shape.loop_var) == Access)
         v = shape.loop_var.var
         cvar = cvars[v]
-        begin = expr_to_cexpr(shape.greater_eq, cvars)
+        begin = index_to_cexpr(shape.greater_eq, cvars)
         constraints.append(begin <= cvar)
         for expr in shape.less_eq:
-            end = expr_to_cexpr(expr, cvars)
+            end = index_to_cexpr(expr, cvars)
             constraints.append(cvar <= end)
     return constraints
 
@@ -247,45 +232,10 @@ def generate_step_constraints(loop_shapes, cvars, step_cvars):
         cvar = cvars[v]
         step_cvar = step_cvars[v]
         step = shape.step.val
-        begin = expr_to_cexpr(shape.greater_eq, cvars)
+        begin = index_to_cexpr(shape.greater_eq, cvars)
         constraints += [cvar == step*step_cvar + begin]
     return constraints
 
-def affine_to_cexpr(affine, cvars):
-    if not affine.var:
-        return affine.offset
-    return affine.coeff * cvars[affine.var] + affine.offset
-
-def expr_to_cexpr(expr, cvars):
-    if type(expr) == Op:
-        args = expr.args
-        op = expr.op
-        if len(args) == 1:
-            cexpr = expr_to_cexpr(args[0], cvars)
-            if expr.op == '+':
-                return cexpr
-            elif expr.op == '-':
-                return -cexpr
-        elif len(args) == 2:
-            left = expr_to_cexpr(args[0], cvars)
-            right = expr_to_cexpr(args[1], cvars)
-            if left is not None and right is not None:
-                if op == '+':
-                    return left + right
-                elif op == '*':
-                    return left * right
-                elif op == '-':
-                    return left - right
-                elif op == '/':
-                    return left / right
-    elif type(expr) == Literal:
-        if expr.ty == int:
-            return expr.val
-    elif type(expr) == Access:
-        if expr.is_scalar() and expr.var in cvars:
-            return cvars[expr.var]
-    return None
-
 def generate_scalar_constraint_vars(decls):
     return {decl.name:Int(decl.name) for decl in decls}
 
@@ -298,9 +248,9 @@ def generate_subscript_equality_constraints(source_ref, source_cvars, sink_ref,
         # all iterations.
         pass
     else:
-        for (source_affine, sink_affine) in zip(source_ref.indices, sink_ref.indices):
-            source_cexpr = expr_to_cexpr(source_affine, source_cvars)
-            sink_cexpr = expr_to_cexpr(sink_affine, sink_cvars)
+        for (source_affine, sink_affine) in zip(affine_indices(source_ref), affine_indices(sink_ref)):
+            source_cexpr = affine_to_cexpr(source_affine, source_cvars)
+            sink_cexpr = affine_to_cexpr(sink_affine, sink_cvars)
             # If either is None, it means that we won't be able to determine whether
             # the indices overlap or not. For example, A[A[i]] or A[1.5] vs anything.
             # Since we don't know their intersection, we conservatively assume they
@@ -309,6 +259,24 @@ def generate_subscript_equality_constraints(source_ref, source_cvars, sink_ref,
                 constraints += [source_cexpr == sink_cexpr]
     return constraints
 
+# GCD test on the affine subscripts, the source and sink loop variables
+# being distinct unknowns. When some dimension can't be equal for any
+# integers, the constraints generated below are unsatisfiable anyway.
+def subscripts_may_overlap(source_ref, source_cvars, source_loop_vars,
+                           sink_ref, sink_cvars, sink_loop_vars, extra_cvars):
+    source_only = set(source_loop_vars).difference(extra_cvars)
+    sink_only = set(sink_loop_vars).difference(extra_cvars)
+    for (source_affine, sink_affine) in zip(affine_indices(source_ref), affine_indices(sink_ref)):
+        if not (source_affine.is_affine and sink_affine.is_affine):
+            continue
+        # Same as affine_to_cexpr giving None
+        if (any(var not in source_cvars for var in source_affine.variables()) or
+            any(var not in sink_cvars for var in sink_affine.variables())):
+            continue
+        if not may_be_equal(source_affine, source_only, sink_affine, sink_only):
+            return False
+    return True
+
 def solve(constraints):
     solver = Solver()
     solver.add(constraints)
@@ -390,12 +358,13 @@ def find_min(constraints, expr, default_min=0):
 
 def get_min_distance(dep):
     source_ref = dep.source_ref
-    source_loops = gather_surrounding_loops(source_ref.parent_stmt)
+    positions = get_position_index(source_ref.parent_stmt)
+    source_loops = positions.surrounding_loops(source_ref.parent_stmt)
     source_loop_shapes = gather_loop_shapes(source_loops)
     source_loop_vars = gather_loop_vars(source_loop_shapes)
 
     sink_ref = dep.sink_ref
-    sink_loops = gather_surrounding_loops(sink_ref.parent_stmt)
+    sink_loops = positions.surrounding_loops(sink_ref.parent_stmt)
     sink_loop_shapes = gather_loop_shapes(sink_loops)
     sink_loop_vars = gather_loop_vars(sink_loop_shapes)
 
@@ -423,7 +392,7 @@ def get_min_distance(dep):
     constraints += generate_subscript_equality_constraints(source_ref, source_cvars,
                                                            sink_ref, sink_cvars)
 
-    common_loops = get_common_prefix(source_loops, sink_loops)
+    common_loops = positions.common_loops(source_ref.parent_stmt, sink_ref.parent_stmt)
     common_loop_shapes = gather_loop_shapes(common_loops)
     common_loop_vars = gather_loop_vars(common_loop_shapes)
 
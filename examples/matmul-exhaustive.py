@@ -1,7 +1,4 @@
-from skeleton import parse_str as parse_skeleton
-from skeleton_ast import Var
-from pattern import parse_str as parse_pattern
-from populator import ChoiceFactoryEnumerator, PopulateParameters, populate_name
+from api import Skeleton, Mapping
 
 matmul_code = """
 declare A[][];
@@ -11,47 +8,40 @@ declare C[][];
 for [i, j, k] {
   A[`x:index`][`y:index`] =
       A[`x:index`][`y:index`] +
-      `_:array`[`x:index`][k] * `_:array`[k][`y:index`];
+      #_:left# * #_:right#;
 }
 """
 
-skeleton = parse_skeleton(matmul_code)
-print(skeleton.pprint())
+skeleton = Skeleton(matmul_code)
+print(skeleton)
 
-# To enumerate the total space, we need to know the size of the space
 # For the matmul code above
 #   A = A + _ * _
 # we have two blanks to fill, and for each blank we have three
 # choices: A, B, C.
 #
-# The space is then [3, 3]. To make array choices, we then pass [3, 3]
-# to ChoiceFactoryEnumerator, so that it can generate the sampling
-# functions such that each sampling function would pick the next
-# combination deterministically.
-array_choices = [Var('A'), Var('B'), Var('C')]
-array_choice_space = [3, 3]
+# enumerate_expressions() works out that the space is [3, 3] by
+# walking the holes, and numbers every way to fill them from 0 to 8.
+left_choices = Mapping('left', ['A[`x:index`][k]', 'B[`x:index`][k]', 'C[`x:index`][k]'])
+right_choices = Mapping('right', ['A[k][`y:index`]', 'B[k][`y:index`]', 'C[k][`y:index`]'])
+arrays = skeleton.enumerate_expressions([left_choices, right_choices])
+print(f'array space {arrays.space}: {len(arrays)} fills')
 
 # For index choices, we want either something like A[i][j] or A[j][i],
 # but not A[i][i] or A[j][j]. Basically, we are interested in the
-# permutation of the possible choices. The space should be [2, 1],
-# because when we fill the first hole, we have two choices from {i,
-# j}, but for the second hole, we only have one choice left.
-index_choices = [Var('i'), Var('j')]
-index_choice_space = [2, 1]
+# permutation of the possible choices. Note that is_finite=True. Once
+# we already pick a choice from the space, we remove it from the
+# space, so the space is [2, 1]. The holes named x (and y) are filled
+# with the same choice everywhere, so they count only once.
+index_choices = Mapping('index', ['i', 'j'], is_finite=True)
 
-# The ChoiceFactoryEnumerator then can be used to generate the sampling functions as follows
-for array_choice_factory in ChoiceFactoryEnumerator(array_choice_space).enumerate():
-    for index_choice_factory in ChoiceFactoryEnumerator(index_choice_space).enumerate():
-        populator = PopulateParameters()
-        populator.add('array', array_choices,
-                      choice_function=array_choice_factory.create_choice_function())
-        # Note that is_finite=True. Once we already pick a choice from the space,
-        # we remove it from the space. Permutation can be viewed like this.
-        populator.add('index', index_choices,
-                      is_finite=True,
-                      choice_function=index_choice_factory.create_choice_function())
+for filled_arrays in arrays:
+    indices = filled_arrays.enumerate_names([index_choices])
+    for pattern in indices:
+        print(pattern)
 
-        maybe_pattern = populate_name(skeleton.clone(), populator.populate)
-        maybe_pattern_code = maybe_pattern.pprint()
-        pattern = parse_pattern(maybe_pattern_code)
-        print(pattern.pprint())
+# Any fill can be made directly from its index, so an enumeration can
+# be split between processes with shard() or resumed from an index.
+print(arrays[5])
+for index in arrays.shard(1, 3):
+    print(index, arrays.point(index))
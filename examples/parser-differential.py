@@ -0,0 +1,105 @@
+from pattern import parse_str
+from pattern_ast import Node
+
+# Parses a corpus of patterns and skeletons with both the lark parser
+# (the reference) and the hand-written parser in pattern_parser.py, and
+# checks that they build the same trees. Inputs that lark rejects must be
+# rejected by the hand-written parser too.
+#
+# Run from the repository root: PYTHONPATH=. python examples/parser-differential.py
+
+# Back pointers would make the description cyclic
+skipped_fields = {'parent_stmt', 'surrounding_loop'}
+
+def get_fields(node):
+    fields = {}
+    for cls in type(node).__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            if name not in skipped_fields and hasattr(node, name):
+                fields[name] = getattr(node, name)
+    return fields
+
+def describe(node):
+    if type(node) == list:
+        return [describe(n) for n in node]
+    if isinstance(node, Node):
+        fields = get_fields(node)
+        return (type(node).__name__,
+                sorted((k, describe(v)) for k, v in fields.items()))
+    if type(node) == dict:
+        return sorted((k, describe(v)) for k, v in node.items())
+    return (type(node).__name__, node)
+
+corpus = [
+    ('start', '''
+     declare A[];
+     declare B[][];
+     local C[n][m + 1];
+     for [i, j] {
+       B[i][j] = A[i] + C[i][j];
+     }
+     '''),
+    ('start', '''
+     declare A[];
+     for [(i, >=1, <=n - 1, +=2), (j, <=m, <=i + 1)] {
+       ## comments are ignored
+       A[i] = A[i + 1] * 0.5;
+       ;
+     }
+     A[0] = 0;
+     '''),
+    ('start', '''
+     declare A[];
+     for [i] {
+       A[i] = a < b == c != d <= e >= f << 2 >> 3 & 1 ^ 2 | 3 && x || y;
+       A[i] = !~-+a;
+       A[i] = a - b - c / d / e % f;
+       A[i] = a ? b : c ? d : e;
+       A[i] = (a ? b : c) ? (d ? e : f) : g;
+       A[i] = (a + b) * (c - d);
+     }
+     '''),
+    ('start', 'declare A[]; for [(i)] { A[i] = 0x1F + 0XaB + 1.5e3 + .5 + 2. + 3e-2; }'),
+    ('start', 'declare A[]; for [i] { A[i] = `x`; `y:names` = A[i]; }'),
+    ('statement', 'for [i] { $s$ $t:stmts$ }'),
+    ('statement', 'for [(i, >=#lo#)] { A[i] = #e:exprs# @op:ops@ B[i]; }'),
+    ('statement', ';'),
+    ('statement', 'A[i][j] = A[i - 1][j] @op@ A[i][j - 1] @op@ A[i][j];'),
+    ('expr', 'a<<-b @o@ c'),
+    ('expr', 'x >= 1 && x <= n || !(y == 0)'),
+    ('expr', '-1 - -1'),
+    # Rejected by both
+    ('start', 'for [i] { A[i] = 1; }'),
+    ('start', 'declare A[];'),
+    ('start', 'declare A[]; $s$'),
+    ('start', 'declare A[]; for [i] { }'),
+    ('statement', 'A[i] = ;'),
+    ('statement', 'A[i] = B[i]'),
+    ('statement', 'for [1] { A[i] = 0; }'),
+    ('expr', '`a`[i]'),
+    ('expr', 'a +'),
+    ('expr', 'a ? b'),
+    ('expr', '(a'),
+    ('expr', 'a @o'),
+]
+
+def parse(code, start_rule, backend):
+    try:
+        return describe(parse_str(code, start_rule, backend=backend))
+    except Exception as e:
+        return ('error', type(e).__name__)
+
+n_failed = 0
+for start_rule, code in corpus:
+    expected = parse(code, start_rule, 'lark')
+    actual = parse(code, start_rule, 'rd')
+    # Only whether an input is rejected has to match, not the exception
+    if expected[0] == 'error' and actual[0] == 'error':
+        continue
+    if expected != actual:
+        n_failed += 1
+        print(f'Mismatch ({start_rule}): {code}')
+        print(f'  lark: {expected}')
+        print(f'  rd:   {actual}')
+
+print(f'{len(corpus) - n_failed} / {len(corpus)} inputs agree')
@@ -0,0 +1,13 @@
+from lark import Lark
+from lark.tools.standalone import gen_standalone
+from pattern import lalr_grammar, start_rules, grammar_hash
+
+# Regenerates pattern_standalone.py, the lark-free LALR parser that
+# pattern.py picks up automatically. Run this from the repository root
+# whenever the grammar in pattern.py changes. Until then pattern.py
+# notices the stale grammar hash and falls back to lark.
+
+parser = Lark(lalr_grammar, parser='lalr', start=start_rules)
+with open('pattern_standalone.py', 'w') as f:
+    gen_standalone(parser, out=f)
+    f.write(f"GRAMMAR_SHA256 = '{grammar_hash(lalr_grammar)}'\n")
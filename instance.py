@@ -1,7 +1,9 @@
-from pattern_ast import get_accesses, get_loops, gather_loop_shapes, gather_loop_vars, Access, Op, ConstReplacer, Literal, plus_one
+from pattern_ast import get_loops, gather_loop_shapes, gather_loop_vars, Access, Op, ConstReplacer, rewrite, Literal, plus_one
+from pattern_affine import affine_indices
 from random import randint, choice, shuffle, uniform
 from loguru import logger
-from z3_utils import expr_to_cexpr, get_scalar_cvars, get_int_cvars, find_max, find_min
+from z3_utils import (expr_to_cexpr, affine_to_cexpr, index_to_cexpr, get_scalar_cvars,
+                      get_int_cvars, find_max, find_min, SolverSession)
 from copy import deepcopy
 from constant_assignment import VariableMap
 from array_access_bound import (
@@ -10,14 +12,21 @@ from array_access_bound import (
     ArrayAccessBound)
 from type_assignment import TypeAssignment, assign_types
 from z3 import Solver, Int, unsat, Optimize, sat, Or, And, Not
+from pattern_ast import Program
+from instance_cache import InstanceCache
+from randomstate import derive_seed
+import multiprocessing
+from multiprocessing import Pool
+import random
+import time
 
 # Whatever's an index, it should be greater than 0 and less
 # than or equal the possible array size for that dimension
 def generate_index_constraints(accesses, cvars, var_map):
     constraints = []
     for access in accesses:
-        for dimension, index in enumerate(access.indices):
-            cexpr = expr_to_cexpr(index, cvars)
+        for dimension, index in enumerate(affine_indices(access)):
+            cexpr = affine_to_cexpr(index, cvars)
             if cexpr is not None:
                 constraints.append(0 <= cexpr)
                 dim_var = dimension_var(access.var, dimension)
@@ -32,12 +41,12 @@ def generate_loop_shape_constraints(loop_shapes, cvars):
     for shape in loop_shapes:
         i = expr_to_cexpr(shape.loop_var, cvars)
 
-        i_greater_eq = expr_to_cexpr(shape.greater_eq, cvars)
+        i_greater_eq = index_to_cexpr(shape.greater_eq, cvars)
         if i_greater_eq is not None:
             constraints.append(i_greater_eq <= i)
 
         for expr in shape.less_eq:
-            i_less_eq = expr_to_cexpr(expr, cvars)
+            i_less_eq = index_to_cexpr(expr, cvars)
             if i_less_eq is not None:
                 constraints.append(i <= i_less_eq)
     return constraints
@@ -86,27 +95,17 @@ def replace_constant_variables_blindly(pattern, var_map):
         elif type(min_val) == float:
             val = uniform(min_val, max_val)
         replace_map[const.name] = val
-    replacer = ConstReplacer(replace_map)
-    cloned.replace(replacer)
+    cloned = rewrite(cloned, [ConstReplacer(replace_map)])
     cloned.consts = []
     return cloned
 
-def try_create_instance(pattern, var_map, types, force):
-    l = logger
-
-    random_pattern = replace_constant_variables_blindly(pattern, var_map)
-    accesses = get_accesses(random_pattern)
-
-    if force:
-        bounds = {}
-        for decl in random_pattern.decls:
-            for size in decl.sizes:
-                assert(size is not None)
-            bound = ArrayAccessBound(decl.name, decl.is_local, decl.n_dimensions)
-            bounds[decl.name] = bound
-        assign_types(random_pattern, types)
-        return Instance(random_pattern, bounds)
-
+# Works out with z3 the array access bounds of a pattern whose
+# constants are substituted. Returns the outcome and the bounds (None
+# unless the outcome is 'instance'). Outcomes other than 'unknown' (a
+# timeout or failing to bound an array) are certain, and are what an
+# InstanceCache keeps.
+def solve_array_access_bounds(random_pattern, var_map, types, l):
+    accesses = random_pattern.access_index().accesses
     cvars = get_int_cvars(random_pattern, types)
 
     cloned_var_map = var_map.clone()
@@ -126,60 +125,222 @@ def try_create_instance(pattern, var_map, types, force):
                                                    cvars,
                                                    cloned_var_map)
 
+    loop_shapes = []
     loop_shape_constraints = []
     for loop in get_loops(random_pattern):
+        loop_shapes += loop.loop_shapes
         loop_shape_constraints += generate_loop_shape_constraints(loop.loop_shapes,
                                                                   cvars)
 
     bound_constraints = generate_bound_constraints(random_pattern.decls, cvars, cloned_var_map)
 
-    l.debug('Index constraints:\n' + '\n'.join(map(str, index_constraints)))
-    l.debug('Loop shape constraints:\n' + '\n'.join(map(str, loop_shape_constraints)))
-    l.debug('Bound constraints:\n' + '\n'.join(map(str, bound_constraints)))
-
-    if len(index_constraints) > 0:
-        invert_index_constraints = Not(And(index_constraints))
+    l.opt(lazy=True).debug('Index constraints:\n{}',
+                           lambda: '\n'.join(map(str, index_constraints)))
+    l.opt(lazy=True).debug('Loop shape constraints:\n{}',
+                           lambda: '\n'.join(map(str, loop_shape_constraints)))
+    l.opt(lazy=True).debug('Bound constraints:\n{}',
+                           lambda: '\n'.join(map(str, bound_constraints)))
 
-        constraints = [invert_index_constraints] + loop_shape_constraints + bound_constraints
+    # The loop shape and bound constraints hold for every query below
+    session = SolverSession(loop_shape_constraints + bound_constraints, l)
 
-        solver = Solver()
-        solver.set('timeout', 10000)
-        solver.add(constraints)
-        status = solver.check()
+    if len(index_constraints) > 0:
+        invert_index_constraints = [Not(And(index_constraints))]
+        status = session.check(invert_index_constraints)
         if status != unsat:
             l.debug(f'Constraints are not unsatisfiable ({status}). '
                     'May result in index out of bound')
-            l.debug('Constraints:\n' + '\n'.join(map(str, constraints)))
+            l.opt(lazy=True).debug('Constraints:\n{}',
+                                   lambda: session.constraint_strs(invert_index_constraints))
             if status == sat:
-                l.debug(f'Model:\n{solver.model()}')
-            return None
-
-    constraints = index_constraints + loop_shape_constraints + bound_constraints
-    solver = Solver()
-    solver.set('timeout', 10000)
-    solver.add(constraints)
-    status = solver.check()
+                l.debug(f'Model:\n{session.model}')
+                return 'out of bounds', None
+            return 'unknown', None
+
+    session.add(index_constraints)
+    status = session.check()
     if status != sat:
         l.debug(f'Constraints are not satisfiable ({status}). '
                 'May result in no iterations')
-        l.debug('\n'.join(map(str, constraints)))
-        return None
+        l.opt(lazy=True).debug('{}', lambda: session.constraint_strs([]))
+        return ('no iterations' if status == unsat else 'unknown'), None
 
     bounds = determine_array_access_bounds(random_pattern.decls,
                                            accesses, cvars,
-                                           constraints,
-                                           cloned_var_map, l)
+                                           session,
+                                           cloned_var_map, l,
+                                           loop_shapes)
     if bounds is None:
-        return None
+        return 'unknown', None
+    return 'instance', bounds
+
+# With a cache (see instance_cache.py), what z3 works out for the
+# pattern is looked up first and stored after. Returns the outcome (see
+# solve_array_access_bounds) and the instance, if there is one.
+def attempt_instance(pattern, var_map, types, force, cache=None):
+    l = logger
+
+    random_pattern = replace_constant_variables_blindly(pattern, var_map)
+
+    if force:
+        bounds = {}
+        for decl in random_pattern.decls:
+            for size in decl.sizes:
+                assert(size is not None)
+            bound = ArrayAccessBound(decl.name, decl.is_local, decl.n_dimensions)
+            bounds[decl.name] = bound
+        assign_types(random_pattern, types)
+        return 'instance', Instance(random_pattern, bounds)
+
+    cached = None
+    if cache is not None:
+        key = cache.key(random_pattern, var_map, types)
+        cached = cache.get(key)
+    if cached is not None:
+        outcome, bounds = cached
+    else:
+        outcome, bounds = solve_array_access_bounds(random_pattern, var_map, types, l)
+        if cache is not None and outcome != 'unknown':
+            cache.put(key, outcome, bounds)
+    if bounds is None:
+        return outcome, None
 
     assign_types(random_pattern, types)
-    return Instance(random_pattern, bounds)
+    return outcome, Instance(random_pattern, bounds)
+
+def try_create_instance(pattern, var_map, types, force, cache=None):
+    return attempt_instance(pattern, var_map, types, force, cache)[1]
 
-def create_instance(pattern, var_map, types):
+def create_instance(pattern, var_map, types, force=False, cache=None):
     for _ in range(1000):
-        result = try_create_instance(pattern, var_map, types)
+        result = try_create_instance(pattern, var_map, types, force, cache)
         if result is None:
             continue
         return result
 
     return None
+
+# What create_instances found: the instances, and the outcome and time
+# of every attempt that finished. Attempts still running when enough
+# instances were found (or at the deadline) are cancelled.
+class CreationReport:
+    def __init__(self):
+        self.instances = []
+        self.attempts = []
+        self.n_cancelled = 0
+        self.deadline_passed = False
+    def add(self, index, outcome, seconds):
+        self.attempts.append((index, outcome, seconds))
+    def outcome_counts(self):
+        counts = {}
+        for _, outcome, _ in self.attempts:
+            counts[outcome] = counts.get(outcome, 0) + 1
+        return counts
+    def pprint(self):
+        counts = ', '.join(f'{n} {outcome}' for outcome, n in sorted(self.outcome_counts().items()))
+        deadline = ', deadline passed' if self.deadline_passed else ''
+        return (f'{len(self.instances)} instances from {len(self.attempts)} attempts '
+                f'({counts}), {self.n_cancelled} cancelled{deadline}')
+    def __str__(self):
+        return self.pprint()
+
+# Each worker process sets up its attempts once (see create_instances)
+creation_worker = None
+
+class CreationWorker:
+    def __init__(self, pattern_bytes, var_map, types, force, cache_path, seed):
+        self.pattern = Program.from_bytes(pattern_bytes)
+        self.var_map = var_map
+        self.types = types
+        self.force = force
+        self.cache = None if cache_path is None else InstanceCache(cache_path)
+        self.seed = seed
+    # The index-th attempt draws its constants (and types) from a
+    # stream of its own, so it's the same whichever worker makes it.
+    # The state of the random module is restored after, it's the
+    # caller's with workers=1. Returns what the attempt added to the
+    # cache's counts too, for the caller's cache.
+    def attempt(self, index):
+        state = random.getstate()
+        counts = self.cache_counts()
+        random.seed(derive_seed(self.seed, index))
+        try:
+            begin = time.perf_counter()
+            outcome, instance = attempt_instance(self.pattern, self.var_map, self.types,
+                                                 self.force, self.cache)
+            seconds = time.perf_counter() - begin
+        finally:
+            random.setstate(state)
+        counts = tuple(after - before for after, before in zip(self.cache_counts(), counts))
+        if instance is None:
+            return index, outcome, seconds, counts, None, None
+        return (index, outcome, seconds, counts,
+                instance.pattern.to_bytes(), instance.array_access_bounds)
+    def cache_counts(self):
+        if self.cache is None:
+            return (0, 0, 0)
+        return self.cache.hits, self.cache.misses, self.cache.stores
+
+def init_creation_worker(*args):
+    global creation_worker
+    creation_worker = CreationWorker(*args)
+
+def attempt_in_worker(index):
+    return creation_worker.attempt(index)
+
+# Makes up to max_attempts attempts at an instance on a pool of worker
+# processes and returns a CreationReport with the first k instances
+# found, as soon as they are found or when deadline seconds have
+# passed. The rest of the attempts are cancelled (workers=1 attempts
+# one by one in this process, and only stops at the deadline between
+# attempts). A cache with a file is shared with the workers, and the
+# hits, misses and stores of the attempts in the report are added to
+# the cache's counts.
+def create_instances(pattern, var_map, types, k=1, workers=None, max_attempts=1000,
+                     deadline=None, seed=0, force=False, cache=None):
+    cache_path = None
+    if cache is not None and cache.path != ':memory:':
+        cache_path = cache.path
+    args = (pattern.to_bytes(), var_map, types, force, cache_path, seed)
+    end = None if deadline is None else time.perf_counter() + deadline
+    report = CreationReport()
+
+    def add(result):
+        index, outcome, seconds, counts, pattern_bytes, bounds = result
+        report.add(index, outcome, seconds)
+        if cache is not None and workers != 1:
+            cache.add_counts(*counts)
+        if pattern_bytes is not None:
+            report.instances.append(Instance(Program.from_bytes(pattern_bytes), bounds))
+
+    if workers == 1:
+        worker = CreationWorker(*args)
+        if cache is not None:
+            worker.cache = cache
+        for index in range(max_attempts):
+            if len(report.instances) >= k:
+                break
+            if end is not None and time.perf_counter() >= end:
+                report.deadline_passed = True
+                break
+            add(worker.attempt(index))
+        report.n_cancelled = max_attempts - len(report.attempts)
+        return report
+
+    pool = Pool(workers, initializer=init_creation_worker, initargs=args)
+    try:
+        results = pool.imap_unordered(attempt_in_worker, range(max_attempts))
+        while len(report.instances) < k and len(report.attempts) < max_attempts:
+            timeout = None if end is None else max(end - time.perf_counter(), 0)
+            try:
+                add(results.next(timeout))
+            except multiprocessing.TimeoutError:
+                report.deadline_passed = True
+                break
+    finally:
+        # Stops the attempts that are still running
+        pool.terminate()
+        pool.join()
+    del report.instances[k:]
+    report.n_cancelled = max_attempts - len(report.attempts)
+    return report
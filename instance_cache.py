@@ -0,0 +1,90 @@
+import pickle
+import sqlite3
+import threading
+from hashlib import sha256
+
+# A persistent cache of what try_create_instance works out with z3 for
+# a pattern whose constants are substituted: its array access bounds,
+# or that it has none (an index can be out of bounds, or the loops have
+# no iterations). Records are content-addressed by a hash of the
+# serialized pattern, the ranges of the variable map and the type
+# assignment, so one cache can be shared by campaigns and patterns.
+#
+# The records live in an SQLite database at path (':memory:' for a
+# cache that only lasts as long as the object). Bump VERSION whenever
+# the analysis changes what it finds, old records are then ignored.
+VERSION = 1
+
+def var_map_key(var_map):
+    ranges = [f'{var}={var_map.get_min(var)!r}:{var_map.get_max(var)!r}'
+              for var in sorted(var_map.ranges)]
+    return f'{var_map.default_min!r}:{var_map.default_max!r};{",".join(ranges)}'
+
+def types_key(types):
+    assigned = [f'{var}={"|".join(types.map[var])}' for var in sorted(types.map)]
+    return f'{"|".join(types.default_types)};{",".join(assigned)}'
+
+class InstanceCache:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS instances '
+                                '(key TEXT PRIMARY KEY, outcome TEXT, bounds BLOB)')
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def key(self, pattern, var_map, types):
+        digest = sha256(pattern.to_bytes())
+        digest.update(f'{VERSION};{var_map_key(var_map)};{types_key(types)}'.encode('utf8'))
+        return digest.hexdigest()
+
+    # (outcome, bounds) or None if there's no record
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT outcome, bounds FROM instances WHERE key = ?',
+                                          (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        outcome, bounds = row
+        return outcome, None if bounds is None else pickle.loads(bounds)
+
+    def put(self, key, outcome, bounds):
+        data = None if bounds is None else pickle.dumps(bounds)
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO instances VALUES (?, ?, ?)',
+                                    (key, outcome, data))
+            self.stores += 1
+
+    # For lookups made through other connections to the same file (see
+    # instance.create_instances)
+    def add_counts(self, hits, misses, stores):
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+            self.stores += stores
+
+    def outcome_counts(self):
+        with self.lock:
+            rows = self.connection.execute('SELECT outcome, COUNT(*) FROM instances '
+                                           'GROUP BY outcome').fetchall()
+        return dict(rows)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def report(self):
+        counts = self.outcome_counts()
+        records = ', '.join(f'{n} {outcome}' for outcome, n in sorted(counts.items()))
+        return (f'{self.hits} hits, {self.misses} misses ({self.hit_rate():.1%} hit rate), '
+                f'{self.stores} stored, {sum(counts.values())} records ({records})')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
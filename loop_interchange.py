@@ -2,7 +2,8 @@ from dependence_analysis import analyze_dependence
 import random
 
 from loguru import logger
-from pattern_ast import get_loops
+from pattern_ast import get_loops, AbstractLoop
+from pattern_persistent import iterate_paths, reorder_loop_shapes
 
 def reorder(new_order, l):
     l[:] = [l[i] for i in new_order]
@@ -42,13 +43,23 @@ class NTries:
         self.n -= 1
         return True
 
+# With persistent=True the patterns yielded share every statement with
+# each other, only the loops are copied. Call
+# pattern_persistent.materialize on the ones that are kept.
 class LoopInterchange:
+    def __init__(self, persistent=False):
+        self.persistent = persistent
+
     def transform(self, pattern, tries=None):
         dependence_graph, pattern_with_ids = analyze_dependence(pattern)
 
         if tries is None:
             tries = NTries(10)
 
+        if self.persistent:
+            yield from self.transform_persistent(dependence_graph, pattern_with_ids, tries)
+            return
+
         while tries.next():
             cloned = pattern_with_ids.clone()
             is_legal = True
@@ -60,3 +71,21 @@ class LoopInterchange:
                 reorder(order, loop.loop_shapes)
             if is_legal:
                 yield cloned
+
+    def transform_persistent(self, dependence_graph, pattern_with_ids, tries):
+        loop_paths = [(path, stmt) for path, stmt in iterate_paths(pattern_with_ids)
+                      if type(stmt) == AbstractLoop]
+        while tries.next():
+            orders = []
+            for _, loop in loop_paths:
+                order = randomize_loop_order(loop)
+                if not is_permutable(dependence_graph, loop, order):
+                    break
+                orders.append(order)
+            if len(orders) < len(loop_paths):
+                continue
+            # Reordering doesn't change the bodies, so the paths stay valid
+            transformed = pattern_with_ids
+            for (path, _), order in zip(loop_paths, orders):
+                transformed = reorder_loop_shapes(transformed, path, order)
+            yield transformed
@@ -1,5 +1,6 @@
 from dependence_analysis import analyze_dependence
 from pattern_ast import get_loops, AbstractLoop, Access, Literal, Op
+from pattern_simplify import simplify as simplify_expressions
 from pattern import parse_str, parse_stmt_str, parse_expr_str
 from dependence_analysis import analyze_dependence, calculate_distance_vectors
 
@@ -32,7 +33,7 @@ def tilable_loop_nests(dependence_graph, loop):
             if is_completely_permutable(dependence_graph, loop, start, depth):
                 yield (start, depth)
 
-def tile_loop(loop, tile_begin, tile_sizes):
+def tile_loop(loop, tile_begin, tile_sizes, simplify=True):
     new_shapes = []
     tile_end = tile_begin + len(tile_sizes)
 
@@ -61,6 +62,9 @@ def tile_loop(loop, tile_begin, tile_sizes):
     new_shapes = prefix + tiled_big_step + tiled_small_step + suffix
     new_body = [stmt.clone() for stmt in loop.body]
     new_loop = AbstractLoop(new_shapes, new_body)
+    # The bounds are built as a_tile + (1 * 10 - 1)
+    if simplify:
+        new_loop = simplify_expressions(new_loop)
     return new_loop
 
 # pick random loop
@@ -2,15 +2,19 @@ from dependence_analysis import analyze_dependence, assign_node_ids
 import random
 
 from loguru import logger
-from pattern_ast import get_loops, Access, AbstractLoop, Program, Op, Replacer, Literal, LoopShape
+from pattern_ast import get_loops, Access, AbstractLoop, Program, Op, Rule, rewrite, Literal, LoopShape
+from pattern_simplify import simplify, simplify_persistent
+from pattern_persistent import persistent_replace, make_loop, find_path, get_stmt, splice
 
-class UnrollReplacer(Replacer):
+class UnrollReplacer(Rule):
+    node_types = (Access,)
     def __init__(self, var, offset):
         self.var = var
         self.offset = offset
-    def should_replace(self, node):
-        return type(node) == Access and node.var == self.var
-    def replace(self, node):
+    # The first copy keeps the loop var as it is
+    def matches(self, node):
+        return self.offset != 0 and node.var == self.var
+    def rewrite(self, node):
         return Op('+', [node.clone(), Literal(int, self.offset)])
 
 # TODO: reuse rather than copy-paste
@@ -22,9 +26,14 @@ class IdGenerator:
         self.current += 1
         return r
 
+# With persistent=True the patterns yielded share the parts that aren't
+# changed by unrolling with each other. Call
+# pattern_persistent.materialize on the ones that are kept.
 class LoopUnroll:
-    def __init__(self, max_factor):
+    def __init__(self, max_factor, persistent=False, simplify=True):
         self.max_factor = max_factor
+        self.persistent = persistent
+        self.simplify = simplify
 
     def transform(self, pattern):
         pattern_with_ids = assign_node_ids(pattern)
@@ -60,114 +69,146 @@ class LoopUnroll:
 
         # TODO: assign unique node ids
         while True:
-            cloned = pattern_with_ids.clone()
+            if self.persistent:
+                transformed = pattern_with_ids
+            else:
+                transformed = pattern_with_ids.clone()
 
             for loop_id, loop_var in sorted_loop_vars:
                 factor = random.randint(1, self.max_factor)
                 if factor == 1:
                     continue
-                loops = get_loops(cloned)
-                loop = None
-                for l in loops:
-                    if l.attributes['node_id'] == loop_id:
-                        loop = l
-                assert(loop is not None)
-                loop_shapes_before = []
-                loop_shapes_after = []
-                loop_var_index = None
-                unroll_shape = None
-                remainder_shape = None
-
-                is_unrollable = True
-
-                for i, shape in enumerate(loop.loop_shapes):
-                    if shape.loop_var.var == loop_var:
-                        loop_var_index = i
-                        original_step = shape.step.clone()
-
-                        # Build the unroll shape
-                        # only support literals for simplicity
-                        logger.info('trying')
-                        if (type(shape.greater_eq) != Literal or shape.greater_eq.ty != int or
-                            type(shape.less_eq) != Literal or shape.less_eq.ty != int or
-                            type(shape.step) != Literal or shape.step.ty != int):
-                            is_unrollable = False
-                            break
-
-                        logger.info('passed')
-
-                        unroll_greater_eq = shape.greater_eq.val
-                        unroll_step = shape.step.val * factor
-                        unroll_n_iterations = (shape.less_eq.val - shape.greater_eq.val + shape.step.val) // (shape.step.val * factor)
-                        unroll_less_eq = unroll_greater_eq + ((unroll_n_iterations - 1) * unroll_step)
-                        unroll_shape = LoopShape(shape.loop_var.clone(),
-                                                 Literal(int, unroll_greater_eq),
-                                                 Literal(int, unroll_less_eq),
-                                                 Literal(int, unroll_step))
-
-                        # Build the remainder shape
-                        remainder_greater_eq = unroll_less_eq + unroll_step
-                        remainder_less_eq = shape.less_eq.val
-                        remainder_step = shape.step.val
-                        remainder_shape = LoopShape(shape.loop_var.clone(),
-                                                    Literal(int, remainder_greater_eq),
-                                                    Literal(int, remainder_less_eq),
-                                                    Literal(int, remainder_step))
-                        break
-                    else:
-                        loop_shapes_before.append(shape)
-
-                if not is_unrollable:
-                    print(f'{loop_var} is not unrollable')
-                    continue
-                assert(loop_var_index is not None)
-                assert(unroll_shape is not None)
-                assert(remainder_shape is not None)
-
-                for shape in loop.loop_shapes[loop_var_index+1:]:
-                    loop_shapes_after.append(shape)
-
-                unrolled_body = []
-                for f in range(0, factor):
-                    unrolled_innermost_body = []
-                    step = loop.loop_shapes[loop_var_index].step
-                    assert(type(step) == Literal)
-                    assert(step.ty == int)
-                    replacer = UnrollReplacer(loop_var, f * step.val)
-                    for stmt in loop.body:
-                        unrolled_stmt = stmt.clone()
-                        unrolled_stmt.replace(replacer)
-                        unrolled_innermost_body.append(unrolled_stmt)
-                    if len(loop_shapes_after) == 0:
-                        unrolled_body += unrolled_innermost_body
-                    else:
-                        shapes = [shape.clone() for shape in loop_shapes_after]
-                        unrolled_body.append(AbstractLoop(shapes,
-                                                          unrolled_innermost_body))
-
-                remainder_innermost_body = [stmt.clone() for stmt in loop.body]
-                if len(loop_shapes_after) == 0:
-                    remainder_body = remainder_innermost_body
-                else:
-                    shapes = [shape.clone() for shape in loop_shapes_after]
-                    remainder_body = [AbstractLoop(shapes, remainder_innermost_body)]
-
-                unrolled_loop = AbstractLoop([unroll_shape], unrolled_body)
-                remainder_loop = AbstractLoop([remainder_shape], remainder_body)
-
-                # The unroll sequence is the unrolled loop followed by the remainder loop
-                if len(loop_shapes_before) == 0:
-                    unroll_sequence = [unrolled_loop, remainder_loop]
-                else:
-                    # The surrounding loop needs to preserve the loop_id
-                    # since the surrounding loops may be unrolled as well
-                    unroll_sequence = [AbstractLoop(loop_shapes_before,
-                                                    [unrolled_loop, remainder_loop],
-                                                    loop_id)]
-
-                # Replace the original loop with the unroll sequence
-                index = loop.surrounding_loop.find_stmt(loop)
-                loop.surrounding_loop.remove_stmt(loop)
-                loop.surrounding_loop.insert_stmts(index, unroll_sequence)
-
-            yield cloned
+                transformed = self.unroll(transformed, loop_id, loop_var, factor)
+
+            yield transformed
+
+    # Statements that are copied into the unrolled body. In persistent
+    # mode they share the parts that don't use the loop var. The offsets
+    # are folded into the indices, so unrolling twice gives i + 3 rather
+    # than (i + 1) + 2.
+    def copy_stmt(self, stmt, replacer=None):
+        if self.persistent:
+            if replacer is None:
+                return stmt
+            replaced = persistent_replace(stmt, replacer)
+            return simplify_persistent(replaced) if self.simplify else replaced
+        cloned = stmt.clone()
+        if replacer is not None:
+            if self.simplify:
+                cloned = simplify(cloned, [replacer])
+            else:
+                cloned = rewrite(cloned, [replacer])
+        return cloned
+
+    def copy_shape(self, shape):
+        return shape if self.persistent else shape.clone()
+
+    def new_loop(self, loop_shapes, body, attributes=None):
+        if self.persistent:
+            return make_loop(loop_shapes, body, attributes)
+        return AbstractLoop(loop_shapes, body, attributes)
+
+    def unroll(self, root, loop_id, loop_var, factor):
+        def is_wanted_loop(stmt):
+            return type(stmt) == AbstractLoop and stmt.attributes.get('node_id') == loop_id
+        loop_path = find_path(root, is_wanted_loop)
+        assert(loop_path is not None)
+        loop = get_stmt(root, loop_path)
+        loop_shapes_before = []
+        loop_shapes_after = []
+        loop_var_index = None
+        unroll_shape = None
+        remainder_shape = None
+
+        is_unrollable = True
+
+        for i, shape in enumerate(loop.loop_shapes):
+            if shape.loop_var.var == loop_var:
+                loop_var_index = i
+
+                # Build the unroll shape
+                # only support literals for simplicity
+                logger.info('trying')
+                if (type(shape.greater_eq) != Literal or shape.greater_eq.ty != int or
+                    len(shape.less_eq) != 1 or
+                    type(shape.less_eq[0]) != Literal or shape.less_eq[0].ty != int or
+                    type(shape.step) != Literal or shape.step.ty != int):
+                    is_unrollable = False
+                    break
+
+                logger.info('passed')
+
+                less_eq = shape.less_eq[0].val
+                unroll_greater_eq = shape.greater_eq.val
+                unroll_step = shape.step.val * factor
+                unroll_n_iterations = (less_eq - shape.greater_eq.val + shape.step.val) // (shape.step.val * factor)
+                unroll_less_eq = unroll_greater_eq + ((unroll_n_iterations - 1) * unroll_step)
+                unroll_shape = LoopShape(shape.loop_var.clone(),
+                                         Literal(int, unroll_greater_eq),
+                                         [Literal(int, unroll_less_eq)],
+                                         Literal(int, unroll_step))
+
+                # Build the remainder shape
+                remainder_greater_eq = unroll_less_eq + unroll_step
+                remainder_less_eq = less_eq
+                remainder_step = shape.step.val
+                remainder_shape = LoopShape(shape.loop_var.clone(),
+                                            Literal(int, remainder_greater_eq),
+                                            [Literal(int, remainder_less_eq)],
+                                            Literal(int, remainder_step))
+                break
+            else:
+                loop_shapes_before.append(shape)
+
+        if not is_unrollable:
+            print(f'{loop_var} is not unrollable')
+            return root
+        assert(loop_var_index is not None)
+        assert(unroll_shape is not None)
+        assert(remainder_shape is not None)
+
+        for shape in loop.loop_shapes[loop_var_index+1:]:
+            loop_shapes_after.append(shape)
+
+        unrolled_body = []
+        for f in range(0, factor):
+            unrolled_innermost_body = []
+            step = loop.loop_shapes[loop_var_index].step
+            assert(type(step) == Literal)
+            assert(step.ty == int)
+            replacer = UnrollReplacer(loop_var, f * step.val)
+            for stmt in loop.body:
+                unrolled_innermost_body.append(self.copy_stmt(stmt, replacer))
+            if len(loop_shapes_after) == 0:
+                unrolled_body += unrolled_innermost_body
+            else:
+                shapes = [self.copy_shape(shape) for shape in loop_shapes_after]
+                unrolled_body.append(self.new_loop(shapes, unrolled_innermost_body))
+
+        remainder_innermost_body = [self.copy_stmt(stmt) for stmt in loop.body]
+        if len(loop_shapes_after) == 0:
+            remainder_body = remainder_innermost_body
+        else:
+            shapes = [self.copy_shape(shape) for shape in loop_shapes_after]
+            remainder_body = [self.new_loop(shapes, remainder_innermost_body)]
+
+        unrolled_loop = self.new_loop([unroll_shape], unrolled_body)
+        remainder_loop = self.new_loop([remainder_shape], remainder_body)
+
+        # The unroll sequence is the unrolled loop followed by the remainder loop
+        if len(loop_shapes_before) == 0:
+            unroll_sequence = [unrolled_loop, remainder_loop]
+        else:
+            # The surrounding loop needs to preserve the loop_id
+            # since the surrounding loops may be unrolled as well
+            unroll_sequence = [self.new_loop(loop_shapes_before,
+                                             [unrolled_loop, remainder_loop],
+                                             {'node_id': loop_id})]
+
+        # Replace the original loop with the unroll sequence
+        if self.persistent:
+            return splice(root, loop_path, unroll_sequence)
+        index = loop.surrounding_loop.find_stmt(loop)
+        loop.surrounding_loop.remove_stmt(loop)
+        loop.surrounding_loop.insert_stmts(index, unroll_sequence)
+        return root
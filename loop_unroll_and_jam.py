@@ -1,6 +1,7 @@
 import random
 import dependence_analysis as da
-from abstract_ast import get_ordered_loops, Replacer, AbstractLoop, Literal, LoopShape, Access, Op
+from pattern_simplify import simplify
+from pattern_ast import get_ordered_loops, Rule, rewrite, AbstractLoop, Literal, LoopShape, Access, Op
 
 def is_distance_ok(graph, loop_var, distance):
     for deps in graph.iterate_dependences():
@@ -34,13 +35,15 @@ def is_positive(dv):
             return False
     return False
 
-class UnrollReplacer(Replacer):
+class UnrollReplacer(Rule):
+    node_types = (Access,)
     def __init__(self, var, offset):
         self.var = var
         self.offset = offset
-    def should_replace(self, node):
-        return type(node) == Access and node.var == self.var
-    def replace(self, node):
+    # The first copy keeps the loop var as it is
+    def matches(self, node):
+        return self.offset != 0 and node.var == self.var
+    def rewrite(self, node):
         return Op('+', [node.clone(), Literal(int, self.offset)])
 
 def iterate_direction_vectors(graph, loop):
@@ -89,12 +92,16 @@ def is_legal(graph, loop, dim, factor):
     # return distance <= min_distances[loop_var]
     
 class LoopUnrollAndJam:
-    def __init__(self, max_factor):
+    def __init__(self, max_factor, simplify=True):
         self.max_factor = max_factor
+        self.simplify = simplify
 
     def transform(self, instance):
-        graph = da.analyze_dependence(instance.pattern)
-        print(graph.pprint())
+        # The dependence graph refers to statements by the node ids of
+        # the pattern it returns
+        graph, pattern_with_ids = da.analyze_dependence(instance.pattern)
+        instance = instance.clone()
+        instance.pattern = pattern_with_ids
         while True:
             cloned = instance.clone()
 
@@ -114,6 +121,7 @@ class LoopUnrollAndJam:
             if factor == 1:
                 print('Not unrolling')
                 yield cloned
+                continue
 
             print(which_loop.pprint())
             is_ok = is_legal(graph, which_loop, which_dim, factor)
@@ -125,13 +133,15 @@ class LoopUnrollAndJam:
             unrolled_shapes = []
             unroll_greater_eq = which_shape.greater_eq.val
             unroll_step = which_shape.step.val * factor
-            unroll_n_iterations = (which_shape.less_eq.val -
+            assert(len(which_shape.less_eq) == 1)
+            which_less_eq = which_shape.less_eq[0].val
+            unroll_n_iterations = (which_less_eq -
                                    which_shape.greater_eq.val +
                                    which_shape.step.val) // unroll_step
             unroll_less_eq = unroll_greater_eq + ((unroll_n_iterations - 1) * unroll_step)
             unroll_shape = LoopShape(which_shape.loop_var.clone(),
                                      Literal(int, unroll_greater_eq),
-                                     Literal(int, unroll_less_eq),
+                                     [Literal(int, unroll_less_eq)],
                                      Literal(int, unroll_step))
             unrolled_shapes = (
                 [unroll_shape] +
@@ -141,18 +151,20 @@ class LoopUnrollAndJam:
             for f in range(0, factor):
                 replacer = UnrollReplacer(which_var, f * which_shape.step.val)
                 for stmt in which_loop.body:
-                    unrolled_stmt = stmt.clone()
-                    unrolled_stmt.replace(replacer)
+                    if self.simplify:
+                        unrolled_stmt = simplify(stmt.clone(), [replacer])
+                    else:
+                        unrolled_stmt = rewrite(stmt.clone(), [replacer])
                     unrolled_body.append(unrolled_stmt)
             unrolled_loop = AbstractLoop(unrolled_shapes, unrolled_body)
     
             # Build the remainder shape
             remainder_greater_eq = unroll_less_eq + unroll_step
-            remainder_less_eq = which_shape.less_eq.val
+            remainder_less_eq = which_less_eq
             remainder_step = which_shape.step.val
             remainder_shape = LoopShape(which_shape.loop_var.clone(),
                                         Literal(int, remainder_greater_eq),
-                                        Literal(int, remainder_less_eq),
+                                        [Literal(int, remainder_less_eq)],
                                         Literal(int, remainder_step))
             remainder_shapes = (
                 [remainder_shape] +
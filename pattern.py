@@ -1,4 +1,8 @@
-from lark import Lark, Transformer
+import os
+import tempfile
+from collections import OrderedDict
+from hashlib import sha256
+from pathlib import Path
 
 # Note:
 # Operator precedence is based on
@@ -82,6 +86,36 @@ grammar = '''
     %ignore COMMENT
 '''
 
+# The Earley parser lexes dynamically, so "<<" is never mistaken for two
+# "<". LALR uses a standard lexer where RELATION would win the tie against
+# BITWISE_SHIFT, so give the shift operators a higher priority.
+lalr_grammar = grammar.replace('BITWISE_SHIFT:', 'BITWISE_SHIFT.2:')
+
+start_rules = ['start', 'statement', 'expr']
+
+def grammar_hash(g):
+    return sha256(g.encode('utf-8')).hexdigest()
+
+# pattern_standalone.py is a lark-free LALR parser generated by
+# generate-standalone-parser.py. Short-lived processes that use it never
+# import lark or analyze the grammar. It is ignored if it was generated
+# from an older grammar, or if LOOPGEN_NO_STANDALONE is set.
+pattern_standalone = None
+if not os.environ.get('LOOPGEN_NO_STANDALONE'):
+    try:
+        import pattern_standalone
+    except ImportError:
+        pattern_standalone = None
+if (pattern_standalone is not None and
+    getattr(pattern_standalone, 'GRAMMAR_SHA256', None) != grammar_hash(lalr_grammar)):
+    pattern_standalone = None
+
+if pattern_standalone is not None:
+    from pattern_standalone import Transformer, UnexpectedInput
+else:
+    from lark import Transformer
+    from lark.exceptions import UnexpectedInput
+
 # _NEWLINE: ( /\r?\n[\t ]*/ | COMMENT )+
 
 
@@ -91,7 +125,7 @@ grammar = '''
 # DEC_NUMBER: /0|[1-9]\d*/i
 
 
-from pattern_ast import Assignment, Access, AbstractLoop, Program, get_accesses, Declaration, Const, Literal, Op, LoopShape, get_loops, get_accesses, LoopShapeBuilder, Hex, NoOp, StatementHole, ExpressionHole, NameHole, OpHole
+from pattern_ast import Assignment, Access, AbstractLoop, Program, get_accesses, Declaration, Const, Literal, Op, LoopShape, get_loops, get_accesses, LoopShapeBuilder, Hex, NoOp, StatementHole, ExpressionHole, NameHole, OpHole, infer_consts, StructuralKey
 
 class TreeSimplifier(Transformer):
     def dimension(self, args):
@@ -115,6 +149,8 @@ class TreeSimplifier(Transformer):
     def const(self, args):
         return Const(args[0])
     def scalar(self, args):
+        if type(args[0]) == NameHole:
+            return args[0]
         return ''.join(args)
     def index(self, args):
         return args[0]
@@ -125,7 +161,7 @@ class TreeSimplifier(Transformer):
     def int_literal(self, args):
         return Literal(int, int(args[0]))
     def hex_literal(self, args):
-        return Hex(args[0])
+        return Hex(str(args[0]))
     def scalar_access(self, args):
         return Access(args[0])
     def array_access(self, args):
@@ -150,23 +186,24 @@ class TreeSimplifier(Transformer):
     def equality(self, args):
         if len(args) == 1:
             return args[0]
-        return Op(args[1], [args[0], args[2]])
+        return Op(str(args[1]), [args[0], args[2]])
     def relational(self, args):
         if len(args) == 1:
             return args[0]
-        return Op(args[1], [args[0], args[2]])
+        return Op(str(args[1]), [args[0], args[2]])
     def additive(self, args):
         if len(args) == 1:
             return args[0]
-        return Op(args[1], [args[0], args[2]])
+        return Op(str(args[1]), [args[0], args[2]])
     def multiplicative(self, args):
         if len(args) == 1:
             return args[0]
-        return Op(args[1], [args[0], args[2]])
+        op = args[1] if type(args[1]) == OpHole else str(args[1])
+        return Op(op, [args[0], args[2]])
     def bitwise_shift(self, args):
         if len(args) == 1:
             return args[0]
-        return Op(args[1], [args[0], args[2]])
+        return Op(str(args[1]), [args[0], args[2]])
     def bitwise_or(self, args):
         if len(args) == 1:
             return args[0]
@@ -182,7 +219,7 @@ class TreeSimplifier(Transformer):
     def unary(self, args):
         if len(args) == 1:
             return args[0]
-        return Op(args[0], [args[1]])
+        return Op(str(args[0]), [args[1]])
     def atom(self, args):
         return args[0]
 
@@ -250,55 +287,166 @@ class TreeSimplifier(Transformer):
                 body.append(arg)
             else:
                 raise RuntimeError('Unsupported syntax in main program')
-        # Add implicit constants that are created when the bounds and steps
-        # of loop vars are not explicitly stated
-        non_consts = set()
-        for decl in decls:
-            non_consts.add(decl.name)
-        for stmt in body:
-            for loop in get_loops(stmt):
-                for shape in loop.loop_shapes:
-                    non_consts.add(shape.loop_var.var)
-        consts_set = set()
-        for stmt in body:
-            for access in get_accesses(stmt):
-                if access.var not in non_consts:
-                    consts_set.add(access.var)
-        consts = [Const(name)
-                  for name in sorted(list(consts_set))]
+        consts = infer_consts(decls, body)
         return Program(decls, body, consts)
 
     # holes
     def expr_hole(self, args):
         if len(args) == 1:
-            return ExpressionHole(args[0], '_')
+            return ExpressionHole(str(args[0]), '_')
         elif len(args) == 2:
-            return ExpressionHole(args[0], args[1])
+            return ExpressionHole(str(args[0]), str(args[1]))
     def op_hole(self, args):
         if len(args) == 1:
-            return OpHole(args[0], '_')
+            return OpHole(str(args[0]), '_')
         elif len(args) == 2:
-            return OpHole(args[0], args[1])
+            return OpHole(str(args[0]), str(args[1]))
         assert(False)
     def name_hole(self, args):
         if len(args) == 1:
-            return NameHole(args[0], '_')
+            return NameHole(str(args[0]), '_')
         elif len(args) == 2:
-            return NameHole(args[0], args[1])
+            return NameHole(str(args[0]), str(args[1]))
         assert(False)
     def statement_hole(self, args):
         if len(args) == 1:
-            return StatementHole(args[0], '_')
+            return StatementHole(str(args[0]), '_')
         elif len(args) == 2:
-            return StatementHole(args[0], args[1])
+            return StatementHole(str(args[0]), str(args[1]))
         assert(False)
 
-def parse_str(code, start_rule="start"):
-    parser = Lark(grammar, start=start_rule)
-    lark_ast = parser.parse(code)
-    tree_simplifier = TreeSimplifier()
-    abstract_ast = tree_simplifier.transform(lark_ast)
-    return abstract_ast
+# Serialized LALR parsers are stored here so that a new process doesn't
+# have to analyze the grammar again. Lark checks the grammar hash stored
+# in the file, so stale caches are simply rebuilt.
+def default_cache_dir():
+    if 'LOOPGEN_CACHE_DIR' in os.environ:
+        return Path(os.environ['LOOPGEN_CACHE_DIR'])
+    return Path(tempfile.gettempdir()) / 'loopgen'
+
+# Compiles the grammar once per start rule.
+#
+# The LALR parser transforms the tree while parsing, so it doesn't build
+# an intermediate lark tree at all. When the stand-alone parser is
+# available it is used instead of compiling the LALR grammar. The Earley
+# parser is the reference and is only used when LALR rejects the input.
+class ParserRegistry:
+    def __init__(self, cache_dir=None, use_cache=True, use_standalone=True):
+        self.cache_dir = default_cache_dir() if cache_dir is None else Path(cache_dir)
+        self.use_cache = use_cache
+        self.use_standalone = use_standalone and pattern_standalone is not None
+        self.lalr_parsers = {}
+        self.earley_parsers = {}
+        self.standalone_parser = None
+
+    def cache_path(self, start_rule):
+        if not self.use_cache:
+            return False
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        except OSError:
+            return False
+        return str(self.cache_dir / f'pattern-lalr-{start_rule}.cache')
+
+    def lalr(self, start_rule):
+        if start_rule not in self.lalr_parsers:
+            self.lalr_parsers[start_rule] = self.build_lalr(start_rule)
+        return self.lalr_parsers[start_rule]
+
+    def build_lalr(self, start_rule):
+        if self.use_standalone:
+            # One stand-alone parser handles all start rules
+            if self.standalone_parser is None:
+                self.standalone_parser = pattern_standalone.Lark_StandAlone(
+                    transformer=TreeSimplifier())
+            return self.standalone_parser
+        from lark import Lark
+        return Lark(lalr_grammar,
+                    start=start_rule,
+                    parser='lalr',
+                    transformer=TreeSimplifier(),
+                    cache=self.cache_path(start_rule))
+
+    def earley(self, start_rule):
+        if start_rule not in self.earley_parsers:
+            from lark import Lark
+            options = {}
+            if pattern_standalone is not None:
+                # TreeSimplifier only recognizes the stand-alone trees
+                options['tree_class'] = pattern_standalone.Tree
+            self.earley_parsers[start_rule] = Lark(grammar, start=start_rule, **options)
+        return self.earley_parsers[start_rule]
+
+    def parse_earley(self, code, start_rule="start"):
+        lark_ast = self.earley(start_rule).parse(code)
+        return TreeSimplifier().transform(lark_ast)
+
+    def parse(self, code, start_rule="start"):
+        try:
+            return self.lalr(start_rule).parse(code, start=start_rule)
+        except UnexpectedInput:
+            return self.parse_earley(code, start_rule)
+
+parsers = ParserRegistry()
+
+# Which parser parse_str uses by default. "lark" is the reference;
+# "rd" is the hand-written parser in pattern_parser.py, which builds
+# the nodes directly without an intermediate parse tree.
+parser_backend = os.environ.get('LOOPGEN_PARSER', 'lark')
+
+def parse_str(code, start_rule="start", backend=None):
+    backend = parser_backend if backend is None else backend
+    if backend == 'lark':
+        return parsers.parse(code, start_rule)
+    elif backend == 'rd':
+        import pattern_parser
+        return pattern_parser.parse_str(code, start_rule)
+    raise RuntimeError(f'Unsupported parser backend ({backend})')
+
+# Parsed fragments (statements and expressions used to fill holes) keyed
+# on (start_rule, code). The same pools are parsed over and over when a
+# skeleton is filled many times, so the cache keeps the most recently
+# used ones. The cached nodes are never handed out; callers get clones
+# so they can mutate the result freely.
+class FragmentCache:
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.fragments = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def parse(self, code, start_rule):
+        key = (start_rule, code)
+        if key in self.fragments:
+            self.hits += 1
+            self.fragments.move_to_end(key)
+            return self.fragments[key].clone()
+        self.misses += 1
+        fragment = parse_str(code, start_rule)
+        self.fragments[key] = fragment
+        if len(self.fragments) > self.max_size:
+            self.fragments.popitem(last=False)
+        return fragment.clone()
+
+    def clear(self):
+        self.fragments.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.fragments),
+            'max_size': self.max_size,
+        }
+
+fragment_cache = FragmentCache()
+
+def parse_stmt_fragment(code):
+    return fragment_cache.parse(code, "statement")
+
+def parse_expr_fragment(code):
+    return fragment_cache.parse(code, "expr")
 
 def parse_stmt_str(code):
     return parse_str(code, "statement")
@@ -319,24 +467,31 @@ def generate_patterns_from_skeleton(
         n_wanted=1,
         existing_hashes=None,
         max_tries=10000):
-    from hashlib import md5
     patterns = []
 
-    hashes = set() if existing_hashes is None else existing_hashes
+    # Duplicates within this call are found by structure. The sha256 of
+    # the encoded pattern is only computed to check and extend
+    # existing_hashes, which may come from other runs.
+    seen = set()
 
     n_generated = 0
     for _ in range(max_tries):
         body = generate(skeleton.clone())
-        pattern = parse_str(body.pprint())
-        code = pattern.pprint()
-
-        code_hash = md5(code.encode('utf-8')).hexdigest()
-        if code_hash in hashes:
+        # Filling holes may have introduced new constants
+        pattern = Program(body.decls, body.body, infer_consts(body.decls, body.body))
+
+        key = StructuralKey(pattern)
+        code_hash = None
+        if existing_hashes is not None:
+            code_hash = sha256(pattern.to_bytes()).hexdigest()
+        if key in seen or (code_hash is not None and code_hash in existing_hashes):
             print('duplicate')
             continue
 
         patterns.append(pattern)
-        hashes.add(code_hash)
+        seen.add(key)
+        if existing_hashes is not None:
+            existing_hashes.add(code_hash)
         n_generated += 1
         print(f'Progress: {n_generated} / {n_wanted}')
         if n_generated == n_wanted:
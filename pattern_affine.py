@@ -0,0 +1,145 @@
+from math import gcd
+from pattern_ast import Access, Literal, Op
+from pattern_simplify import build_affine
+
+# The normal form of an int expression as
+#   c1 * v1 + c2 * v2 + ... + const
+# where the variables are scalars (loop variables and parameters) keyed
+# by name. Expressions that aren't affine, like A[i], i * j or i / 2,
+# have is_affine set to False and are only usable through expr.
+#
+# Forms are computed once per index expression and cached on the Op or
+# Access node, which drops the cache whenever its children change. A
+# form is shared by everyone asking for it so it must not be mutated.
+class AffineForm:
+    __slots__ = ('coeffs', 'const', 'is_affine', 'expr')
+    def __init__(self, coeffs, const, is_affine=True, expr=None):
+        self.coeffs = coeffs
+        self.const = const
+        self.is_affine = is_affine
+        self.expr = expr
+    def is_constant(self):
+        return self.is_affine and len(self.coeffs) == 0
+    def variables(self):
+        return self.coeffs.keys()
+    def plus(self, const):
+        if not self.is_affine:
+            op = '+' if const >= 0 else '-'
+            return non_affine(Op(op, [self.expr.clone(), Literal(int, abs(const))]))
+        return AffineForm(self.coeffs, self.const + const)
+    def to_expr(self):
+        if not self.is_affine:
+            return self.expr
+        terms = [(var, coeff, Access(var)) for var, coeff in self.coeffs.items()]
+        return build_affine(terms, self.const)
+    def pprint(self):
+        return self.to_expr().pprint()
+    def __str__(self):
+        return self.pprint()
+
+def non_affine(expr):
+    return AffineForm({}, 0, False, expr)
+
+def constant_form(val):
+    return AffineForm({}, val)
+
+def add_forms(a, b, sign):
+    coeffs = dict(a.coeffs)
+    for var, coeff in b.coeffs.items():
+        total = coeffs.get(var, 0) + sign * coeff
+        if total == 0:
+            coeffs.pop(var, None)
+        else:
+            coeffs[var] = total
+    return AffineForm(coeffs, a.const + sign * b.const)
+
+def scale_form(form, k):
+    if k == 0:
+        return constant_form(0)
+    coeffs = {var: k * coeff for var, coeff in form.coeffs.items()}
+    return AffineForm(coeffs, k * form.const)
+
+def is_affine_op(node):
+    if type(node) != Op:
+        return False
+    if len(node.args) == 1:
+        return node.op in ['+', '-']
+    return len(node.args) == 2 and node.op in ['+', '-', '*']
+
+def combine(node, args):
+    if not all(arg.is_affine for arg in args):
+        return non_affine(node)
+    if len(args) == 1:
+        return args[0] if node.op == '+' else scale_form(args[0], -1)
+    a, b = args
+    if node.op == '+':
+        return add_forms(a, b, 1)
+    if node.op == '-':
+        return add_forms(a, b, -1)
+    if a.is_constant():
+        return scale_form(b, a.const)
+    if b.is_constant():
+        return scale_form(a, b.const)
+    return non_affine(node)
+
+def leaf_form(node):
+    ty = type(node)
+    if ty == int:
+        return constant_form(node)
+    if ty == Literal and node.ty == int:
+        return constant_form(node.val)
+    if ty == Access and node.is_scalar() and type(node.var) == str:
+        return AffineForm({node.var: 1}, 0)
+    return non_affine(node)
+
+# Returns the (cached) AffineForm of an int expression. Uses an explicit
+# stack because unrolled indices can be nested very deeply.
+def affine_form(expr):
+    cached = getattr(expr, '_affine', None)
+    if cached is not None:
+        return cached
+    forms = []
+    stack = [(expr, False)]
+    while stack:
+        node, visited = stack.pop()
+        cached = getattr(node, '_affine', None)
+        if cached is not None:
+            forms.append(cached)
+            continue
+        if not is_affine_op(node):
+            form = leaf_form(node)
+        elif not visited:
+            stack.append((node, True))
+            for arg in reversed(node.args):
+                stack.append((arg, False))
+            continue
+        else:
+            n_args = len(node.args)
+            form = combine(node, forms[-n_args:])
+            del forms[-n_args:]
+        if type(node) in [Access, Op]:
+            node._affine = form
+        forms.append(form)
+    return forms[0]
+
+def affine_indices(access):
+    return [affine_form(index) for index in access.indices]
+
+# GCD test: whether a = b can have an integer solution, where the
+# variables in a_only (b_only) are distinct between the two sides and
+# the rest are shared. Only meaningful when both forms are affine.
+def may_be_equal(a, a_only, b, b_only):
+    coeffs = {}
+    for var, coeff in a.coeffs.items():
+        key = ('a', var) if var in a_only else var
+        coeffs[key] = coeffs.get(key, 0) + coeff
+    for var, coeff in b.coeffs.items():
+        key = ('b', var) if var in b_only else var
+        coeffs[key] = coeffs.get(key, 0) - coeff
+    diff = b.const - a.const
+    divisor = 0
+    for coeff in coeffs.values():
+        divisor = gcd(divisor, coeff)
+    if divisor == 0:
+        return diff == 0
+    return diff % divisor == 0
@@ -1,9 +1,69 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from io import StringIO
 from loguru import logger
 
 space_per_indent = 2
 
-# TODO: make this non-global
-array_as_ptr = False
+# How nodes print, as opposed to what they are. Held in a context
+# variable rather than passed to every pprint() so that each thread (or
+# task) generating code has its own, see printing().
+#   array_as_ptr: print A[i] as (*A)[i]
+class PrintContext:
+    __slots__ = ('array_as_ptr',)
+    def __init__(self, array_as_ptr=False):
+        self.array_as_ptr = array_as_ptr
+
+current_print_context = ContextVar('print_context', default=PrintContext())
+
+@contextmanager
+def printing(context):
+    token = current_print_context.set(context)
+    try:
+        yield context
+    finally:
+        current_print_context.reset(token)
+
+# Writes lines to a file-like object, indented by the current depth.
+# Statements print through write_to() so that big programs are streamed
+# out instead of being joined into strings at every level of nesting.
+# Lines are separated, not terminated, by newlines like '\n'.join.
+class CodeWriter:
+    def __init__(self, out, depth=0, spaces=space_per_indent):
+        self.out = out
+        self.depth = depth
+        self.spaces = spaces
+        self.is_empty = True
+        # What goes before a line: the newline ending the previous one
+        # (none for the first line) and the indentation. Only changes
+        # with the depth, so it isn't rebuilt for every line.
+        self.newline = ''
+        self.set_prefix()
+    def set_prefix(self):
+        self.prefix = self.newline + ' ' * (self.spaces * self.depth)
+    def preformatted(self, text):
+        self.out.write(self.newline + text)
+        if self.is_empty:
+            self.is_empty = False
+            self.newline = '\n'
+            self.set_prefix()
+    def line(self, text):
+        if self.is_empty:
+            self.preformatted(self.prefix + text)
+        else:
+            self.out.write(self.prefix + text)
+    def indent(self):
+        self.depth += 1
+        self.set_prefix()
+    def dedent(self):
+        assert(self.depth > 0)
+        self.depth -= 1
+        self.set_prefix()
+
+def pprint_to_string(node, indent=0):
+    out = StringIO()
+    node.write_to(CodeWriter(out, indent))
+    return out.getvalue()
 
 def is_list_syntactically_equal(list1, list2):
     if len(list1) != len(list2):
@@ -13,6 +73,16 @@ def is_list_syntactically_equal(list1, list2):
             return False
     return True
 
+# For fields that are either plain values or nodes (the var of an
+# Access can be a NameHole, the op of an Op an OpHole)
+def is_field_syntactically_equal(field1, field2):
+    if isinstance(field1, Node):
+        return field1.is_syntactically_equal(field2)
+    return not isinstance(field2, Node) and field1 == field2
+
+def list_structural_hash(nodes):
+    return hash(tuple(node.structural_hash() for node in nodes))
+
 class Replacer:
     def should_replace(self, node):
         raise NotImplementedError(type(self))
@@ -21,36 +91,82 @@ class Replacer:
     def replace(self, node):
         raise NotImplementedError(type(self))
 
+# A rewrite rule for the rewrite() engine. node_types lists the node
+# types the rule can match, which is how the engine dispatches nodes to
+# rules. Rules are also Replacers, so replace() and persistent_replace
+# can apply them top-down in a single pass. The engine rewrites a node
+# until no rule matches it, unless the rule is_applied_once (a renaming
+# whose new names can be old names too).
+class Rule(Replacer):
+    node_types = ()
+    is_applied_once = False
+    def matches(self, node):
+        raise NotImplementedError(type(self))
+    def rewrite(self, node):
+        raise NotImplementedError(type(self))
+    def should_skip(self, node):
+        return False
+    def should_replace(self, node):
+        return type(node) in self.node_types and self.matches(node)
+    def replace(self, node):
+        return self.rewrite(node)
+
+# Nodes use __slots__ because generated programs (unrolled loops in
+# particular) can hold a very large number of them. Most nodes never get
+# any attributes, so the attributes dict is only created when it is
+# first used.
 class Node:
+    __slots__ = ()
+    @property
+    def attributes(self):
+        if self._attributes is None:
+            self._attributes = {}
+        return self._attributes
+    @attributes.setter
+    def attributes(self, attributes):
+        self._attributes = attributes
+    def copy_attributes(self):
+        return None if self._attributes is None else self._attributes.copy()
     # clone the node including the node ids
     def clone(self):
         raise NotImplementedError(type(self))
     def is_syntactically_equal(self, other):
         raise NotImplementedError(type(self))
+    # A hash that agrees with is_syntactically_equal. It uses Python's
+    # hash of strings, so it is only stable within one process.
+    def structural_hash(self):
+        raise NotImplementedError(type(self))
     def precedence(self):
         raise NotImplementedError(type(self))
     def replace(self, replacer, dfs=False):
         raise NotImplementedError(type(self))
     def pprint(self):
         raise NotImplementedError(type(self))
+    # Statements that span several lines override this
+    def write_to(self, writer):
+        writer.line(self.pprint())
     def __str__(self):
         return self.pprint()
 
 class Const(Node):
+    __slots__ = ('name', '_attributes')
     def __init__(self, name, attributes=None):
         self.name = name
-        self.attributes = {} if attributes is None else attributes
+        self._attributes = attributes
     def pprint(self, indent=0):
         ws = space_per_indent * indent * ' '
         return f'{ws}const {self.name};'
     def clone(self):
-        return Const(self.name, self.attributes.copy())
+        return Const(self.name, self.copy_attributes())
     def is_syntactically_equal(self, other):
         return type(other) == Const and self.name == other.name
+    def structural_hash(self):
+        return hash((Const, self.name))
     def replace(self, replacer, dfs=False):
         self.name = replace(self.name, replacer, dfs)
 
 class Declaration(Node):
+    __slots__ = ('name', 'n_dimensions', 'sizes', 'is_local', 'ty', '_attributes')
     def __init__(self, name, n_dimensions, sizes=None, is_local=False, ty=None, attributes=None):
         self.name = name
         self.n_dimensions = n_dimensions
@@ -60,7 +176,7 @@ class Declaration(Node):
             self.sizes = sizes
         self.is_local = is_local
         self.ty = ty
-        self.attributes = {} if attributes is None else attributes
+        self._attributes = attributes
     def pprint(self, indent=0):
         localness = 'local' if self.is_local else 'declare'
         ty = ' ' if self.ty is None else f' {self.ty} '
@@ -70,46 +186,65 @@ class Declaration(Node):
     def clone(self):
         return Declaration(self.name, self.n_dimensions,
                            list(self.sizes), self.is_local, self.ty,
-                           self.attributes.copy())
+                           self.copy_attributes())
     def is_syntactically_equal(self, other):
         return (
             type(other) == Declaration and
             self.name == other.name and
             self.n_dimensions == other.n_dimensions and
             self.is_local == other.is_local and
-            self.sizes == other.sizes
+            len(self.sizes) == len(other.sizes) and
+            all(size is other_size or
+                (size is not None and other_size is not None and
+                 size.is_syntactically_equal(other_size))
+                for size, other_size in zip(self.sizes, other.sizes))
         )
+    def structural_hash(self):
+        sizes = tuple(None if size is None else size.structural_hash()
+                      for size in self.sizes)
+        return hash((Declaration, self.name, self.n_dimensions, self.is_local, sizes))
     def replace(self, replacer, dfs=False):
         self.name = replace(self.name, replacer, dfs)
         self.sizes = replace_each(self.sizes, replacer, dfs)
 
+# parent_stmt is set on expressions used as array indices and is_write
+# on the left-hand side of an assignment
 class Literal(Node):
+    __slots__ = ('ty', 'val', 'parent_stmt', 'is_write', '_attributes', '_hash')
     def __init__(self, ty, val, attributes=None):
         self.ty = ty
         self.val = val
-        self.attributes = {} if attributes is None else attributes
+        self._hash = None
+        self._attributes = attributes
     def pprint(self, indent=0):
         return f'{self.val}'
     def clone(self):
-        return Literal(self.ty, self.val, self.attributes.copy())
+        return Literal(self.ty, self.val, self.copy_attributes())
     def is_syntactically_equal(self, other):
-        return self.ty == other.ty and self.val == other.val
+        return isinstance(other, Literal) and self.ty == other.ty and self.val == other.val
+    def structural_hash(self):
+        if self._hash is None:
+            self._hash = hash((Literal, self.ty, self.val))
+        return self._hash
     def replace(self, replacer, dfs=False):
         self.ty = replace(self.ty, replacer, dfs)
         self.val = replace(self.val, replacer, dfs)
+        self._hash = None
     def dep_print(self, refs):
         return f'{self.val}'
 
 class Hex(Literal):
+    __slots__ = ('str_val',)
     def __init__(self, str_val, attributes=None):
         self.ty = bytes
         self.str_val = str_val
+        self._hash = None
         self.val = bytes.fromhex(str_val[2:])  # remove the 0x
-        self.attributes = {} if attributes is None else attributes
+        self._attributes = attributes
     def pprint(self, indent=0):
         return f'{self.str_val}'
     def clone(self):
-        return Hex(self.str_val, self.attributes.copy())
+        return Hex(self.str_val, self.copy_attributes())
     def is_syntactically_equal(self, other):
         return (type(other) == Hex and
                 self.ty == other.ty and
@@ -118,13 +253,15 @@ class Hex(Literal):
         self.ty = replace(self.ty, replacer, dfs)
         self.val = replace(self.val, replacer, dfs)
         self.str_val = replace(self.str_val, replacer, dfs)
+        self._hash = None
     def dep_print(self, refs):
         return f'{self.str_val}'
 
 class NoOp(Node):
+    __slots__ = ('surrounding_loop', '_attributes')
     def __init__(self, attributes=None):
         self.surrounding_loop = None
-        self.attributes = {} if attributes is None else attributes
+        self._attributes = attributes
     def pprint(self, indent=0):
         ws = space_per_indent * indent * ' '
         return f'{ws};'
@@ -134,29 +271,34 @@ class NoOp(Node):
         return NoOp()
     def is_syntactically_equal(self, other):
         return type(other) == NoOp
+    def structural_hash(self):
+        return hash(NoOp)
     def replace(self, replacer, dfs=False):
         pass
     def clone(self):
-        return NoOp(self.attributes.copy())
+        return NoOp(self.copy_attributes())
 
 class Assignment(Node):
+    __slots__ = ('lhs', 'rhs', 'surrounding_loop', '_attributes')
     def __init__(self, lhs, rhs, attributes=None):
         self.lhs = lhs
         self.lhs.is_write = True
         self.rhs = rhs
         self.surrounding_loop = None
-        for access in get_accesses(self):
+        self.set_parent_stmt()
+        self._attributes = attributes
+    def set_parent_stmt(self):
+        for access in iterate_accesses(self):
             access.parent_stmt = self
             for index in access.indices:
                 index.parent_stmt = self
-        self.attributes = {} if attributes is None else attributes
     def pprint(self, indent=0):
         ws = space_per_indent * indent * ' '
         return f'{ws}{self.lhs.pprint()} = {self.rhs.pprint()};'
     def dep_print(self, refs):
         return f'{self.lhs.dep_print(refs)} = {self.rhs.dep_print(refs)};'
     def clone(self):
-        cloned = Assignment(self.lhs.clone(), self.rhs.clone(), self.attributes.copy())
+        cloned = Assignment(self.lhs.clone(), self.rhs.clone(), self.copy_attributes())
         return cloned
     def is_syntactically_equal(self, other):
         return (
@@ -164,12 +306,13 @@ class Assignment(Node):
             self.lhs.is_syntactically_equal(other.lhs) and
             self.rhs.is_syntactically_equal(other.rhs)
         )
+    def structural_hash(self):
+        return hash((Assignment, self.lhs.structural_hash(), self.rhs.structural_hash()))
     def replace(self, replacer, dfs=False):
         self.lhs, self.rhs = replace_each([self.lhs, self.rhs], replacer, dfs)
-        for access in get_accesses(self):
-            access.parent_stmt = self
-            for index in access.indices:
-                index.parent_stmt = self
+        self.set_parent_stmt()
+        if self.surrounding_loop is not None:
+            self.surrounding_loop.invalidate_indexes()
 
 def replace(i, replacer, dfs=False):
     if dfs:
@@ -193,16 +336,19 @@ def replace_each(l, replacer, dfs=False):
     return [replace(i, replacer, dfs) for i in l]
 
 class Access(Node):
+    __slots__ = ('var', 'indices', 'is_write', 'parent_stmt', '_attributes', '_hash', '_affine')
     def __init__(self, var, indices=None, attributes=None):
         self.var = var
         self.indices = indices if indices else []
+        self._hash = None
+        self._affine = None
         self.is_write = False
         self.parent_stmt = None
-        self.attributes = {} if attributes is None else attributes
+        self._attributes = attributes
     def is_scalar(self):
         return len(self.indices) == 0
     def pprint(self, indent=0):
-        if self.is_scalar() or not array_as_ptr:
+        if self.is_scalar() or not current_print_context.get().array_as_ptr:
             name = self.var
         else:
             name = f'(*{self.var})'
@@ -216,18 +362,25 @@ class Access(Node):
             return self.pprint()
     def clone(self):
         cloned_indices = [i.clone() for i in self.indices]
-        cloned = Access(self.var, cloned_indices, self.attributes.copy())
+        cloned = Access(self.var, cloned_indices, self.copy_attributes())
         cloned.is_write = self.is_write
         return cloned
     def is_syntactically_equal(self, other):
         return (
             type(other) == Access and
-            self.var == other.var and
+            is_field_syntactically_equal(self.var, other.var) and
             is_list_syntactically_equal(self.indices, other.indices)
         )
+    def structural_hash(self):
+        if self._hash is None:
+            var = self.var.structural_hash() if isinstance(self.var, Node) else self.var
+            self._hash = hash((Access, var, list_structural_hash(self.indices)))
+        return self._hash
     def replace(self, replacer, dfs=False):
         self.var = replace(self.var, replacer, dfs)
         self.indices = replace_each(self.indices, replacer, dfs)
+        self._hash = None
+        self._affine = None
 
 class LoopShapeBuilder:
     def __init__(self):
@@ -290,6 +443,7 @@ def is_default_step(expr):
         expr.val == 1
 
 class LoopShape(Node):
+    __slots__ = ('loop_var', 'greater_eq', 'less_eq', 'step')
     def __init__(self, loop_var, greater_eq, less_eq, step):
         self.loop_var = loop_var
         self.greater_eq = greater_eq
@@ -324,52 +478,83 @@ class LoopShape(Node):
             is_list_syntactically_equal(self.less_eq, other.less_eq) and
             self.step.is_syntactically_equal(other.step)
         )
+    def structural_hash(self):
+        return hash((LoopShape,
+                     self.loop_var.structural_hash(),
+                     self.greater_eq.structural_hash(),
+                     list_structural_hash(self.less_eq),
+                     self.step.structural_hash()))
     def replace(self, replacer, dfs=False):
         self.loop_var = replace(self.loop_var, replacer, dfs)
         self.greater_eq = replace(self.greater_eq, replacer, dfs)
         self.less_eq = replace_each(self.less_eq, replacer, dfs)
         self.step = replace(self.step, replacer, dfs)
 
+# Loops and programs keep an AccessIndex of everything under them, and
+# programs a PositionIndex of their statements. They're built on first
+# use and dropped, together with the ones of the surrounding loops,
+# whenever the body changes through these methods or replace(). Code
+# that assigns node fields directly must call invalidate_indexes()
+# itself.
 class LoopTrait():
+    __slots__ = ()
     def find_stmt(self, stmt):
         return self.body.index(stmt)
     def remove_stmt(self, stmt):
         self.body.remove(stmt)
+        self.invalidate_indexes()
     def insert_stmts(self, i, stmts):
         self.body[i:i] = stmts
         for stmt in stmts:
             stmt.surrounding_loop = self
+        self.invalidate_indexes()
     def append_stmt(self, stmt):
         self.body.append(stmt)
         stmt.surrounding_loop = self
+        self.invalidate_indexes()
+    def access_index(self):
+        if self._access_index is None:
+            self._access_index = AccessIndex(self)
+        return self._access_index
+    def invalidate_indexes(self):
+        loop = self
+        while loop is not None:
+            loop._access_index = None
+            if type(loop) == Program:
+                loop._position_index = None
+            loop = loop.surrounding_loop
     def replace_body(self, stmts):
         self.body = []
         for stmt in stmts:
             self.append_stmt(stmt)
 
 class AbstractLoop(Node, LoopTrait):
+    __slots__ = ('loop_shapes', 'body', 'surrounding_loop', '_attributes', '_access_index')
     def __init__(self, loop_shapes, body, attributes=None):
         self.loop_shapes = loop_shapes
         for loop_shape in loop_shapes:
-            for access in get_accesses(loop_shape):
+            for access in iterate_accesses(loop_shape):
                 access.parent_stmt = self
         self.body = body
         self.surrounding_loop = None
+        self._access_index = None
         for stmt in body:
             stmt.surrounding_loop = self
-        self.attributes = {} if attributes is None else attributes
+        self._attributes = attributes
     def pprint(self, indent=0):
-        ws = space_per_indent * indent * ' '
-        loop_vars = []
+        return pprint_to_string(self, indent)
+    def write_to(self, writer):
         shapes = [shape.pprint() for shape in self.loop_shapes]
-        header = f'{ws}for [{", ".join(shapes)}] {{'
-        body = [f'{stmt.pprint(indent+1)}' for stmt in self.body]
-        end = f'{ws}}}'
-        return '\n'.join([header] + body + [end])
+        writer.line(f'for [{", ".join(shapes)}] {{')
+        writer.indent()
+        for stmt in self.body:
+            stmt.write_to(writer)
+        writer.dedent()
+        writer.line('}')
     def clone(self):
         cloned_loop_shapes = [shape.clone() for shape in self.loop_shapes]
         cloned_body = [stmt.clone() for stmt in self.body]
-        cloned_loop = AbstractLoop(cloned_loop_shapes, cloned_body, self.attributes.copy())
+        cloned_loop = AbstractLoop(cloned_loop_shapes, cloned_body, self.copy_attributes())
         return cloned_loop
     def is_syntactically_equal(self, other):
         return (
@@ -377,17 +562,25 @@ class AbstractLoop(Node, LoopTrait):
             is_list_syntactically_equal(self.loop_shapes, other.loop_shapes) and
             is_list_syntactically_equal(self.body, other.body)
         )
+    def structural_hash(self):
+        return hash((AbstractLoop,
+                     list_structural_hash(self.loop_shapes),
+                     list_structural_hash(self.body)))
     def replace(self, replacer, dfs=False):
         self.loop_shapes = replace_each(self.loop_shapes, replacer, dfs)
         self.body = replace_each(self.body, replacer, dfs)
         for stmt in self.body:
             stmt.surrounding_loop = self
+        self.invalidate_indexes()
 
 class Op(Node):
+    __slots__ = ('op', 'args', 'parent_stmt', 'is_write', '_attributes', '_hash', '_affine')
     def __init__(self, op, args, attributes=None):
         self.op = op
         self.args = args
-        self.attributes = {} if attributes is None else attributes
+        self._hash = None
+        self._affine = None
+        self._attributes = attributes
     def precedence(self):
         if len(self.args) == 1:
             return 200
@@ -446,17 +639,24 @@ class Op(Node):
         return self.generic_print(formatter)
     def clone(self):
         cloned_args = [arg.clone() for arg in self.args]
-        return Op(self.op, cloned_args, self.attributes.copy())
+        return Op(self.op, cloned_args, self.copy_attributes())
     def is_syntactically_equal(self, other):
         return (
             type(other) == Op and
-            self.op == other.op and
+            is_field_syntactically_equal(self.op, other.op) and
             is_list_syntactically_equal(self.args, other.args)
         )
+    def structural_hash(self):
+        if self._hash is None:
+            op = self.op.structural_hash() if isinstance(self.op, Node) else self.op
+            self._hash = hash((Op, op, list_structural_hash(self.args)))
+        return self._hash
     def replace(self, replacer, dfs=False):
         if type(self.op) == OpHole:
             self.op = replace(self.op, replacer, dfs)
         self.args = replace_each(self.args, replacer, dfs)
+        self._hash = None
+        self._affine = None
 
 def plus_one(expr):
     if type(expr) == int:
@@ -467,6 +667,8 @@ def plus_one(expr):
         raise RuntimeError(f'plus_one: unsupported type {type(expr)}')
 
 class Program(Node, LoopTrait):
+    __slots__ = ('decls', 'body', 'consts', 'surrounding_loop', 'loop_shapes', '_attributes', '_access_index',
+                 '_position_index')
     def __init__(self, decls, body, consts, attributes=None):
         self.decls = decls
         self.body = body
@@ -478,7 +680,13 @@ class Program(Node, LoopTrait):
         self.loop_shapes = []
         for stmt in body:
             stmt.surrounding_loop = self
-        self.attributes = {} if attributes is None else attributes
+        self._attributes = attributes
+        self._access_index = None
+        self._position_index = None
+    def position_index(self):
+        if self._position_index is None:
+            self._position_index = PositionIndex(self)
+        return self._position_index
     def is_local(self, name):
         for decl in self.decls:
             if decl.name == name:
@@ -490,16 +698,15 @@ class Program(Node, LoopTrait):
                 return decl
         return None
     def pprint(self, indent=0):
-        body = []
-        # body += [f'{decl.pprint(indent)}' for decl in self.decls]
-        # body += [f'{const.pprint(indent)}' for const in self.consts]
-        body += [f'{stmt.pprint(indent)}' for stmt in self.body]
-        return '\n'.join(body)
+        return pprint_to_string(self, indent)
+    def write_to(self, writer):
+        for stmt in self.body:
+            stmt.write_to(writer)
     def clone(self):
         cloned_decls = [decl.clone() for decl in self.decls]
         cloned_body = [stmt.clone() for stmt in self.body]
         cloned_consts = [const.clone() for const in self.consts]
-        return Program(cloned_decls, cloned_body, cloned_consts, self.attributes.copy())
+        return Program(cloned_decls, cloned_body, cloned_consts, self.copy_attributes())
     def is_syntactically_equal(self, other):
         return (
             type(other) == Program and
@@ -507,6 +714,22 @@ class Program(Node, LoopTrait):
             is_list_syntactically_equal(self.body, other.body) and
             is_list_syntactically_equal(self.consts, other.consts)
         )
+    def structural_hash(self):
+        return hash((Program,
+                     list_structural_hash(self.decls),
+                     list_structural_hash(self.body),
+                     list_structural_hash(self.consts)))
+    # See pattern_serialization.py for the format
+    def to_bytes(self):
+        from pattern_serialization import to_bytes
+        return to_bytes(self)
+    @staticmethod
+    def from_bytes(data):
+        from pattern_serialization import from_bytes
+        program = from_bytes(data)
+        if type(program) != Program:
+            raise RuntimeError(f'Serialized node is not a program ({type(program)})')
+        return program
     def merge(self, other):
         cloned = other.clone()
 
@@ -534,6 +757,7 @@ class Program(Node, LoopTrait):
         self.body += cloned.body
         for stmt in cloned.body:
             stmt.surrounding_loop = self
+        self.invalidate_indexes()
     def replace(self, replacer, dfs=False):
         self.decls = replace_each(self.decls, replacer, dfs)
         self.consts = replace_each(self.consts, replacer, dfs)
@@ -541,25 +765,18 @@ class Program(Node, LoopTrait):
         self.body = replace_each(self.body, replacer, dfs)
         for stmt in self.body:
             stmt.surrounding_loop = self
+        self.invalidate_indexes()
     def populate_decls(self, possible_values = None):
         possible_values = {} if possible_values is None else possible_values
-        accesses = get_accesses(self)
+        by_var = self.access_index().by_var
         loop_vars = gather_loop_vars(gather_loop_shapes(get_loops(self)))
-        undeclared = []
-        for access in accesses:
-            name = access.var
+        unique_undeclared = []
+        for name, accesses in by_var.items():
             if name in loop_vars:
                 continue
             if self.get_decl(name):
                 continue
-            undeclared.append(access)
-        unique_names = set()
-        unique_undeclared = []
-        for access in undeclared:
-            if access.var in unique_names:
-                continue
-            unique_names.add(access.var)
-            unique_undeclared.append(access)
+            unique_undeclared.append(accesses[0])
         unique_undeclared.sort(key = lambda access: access.var)
         # sorted_unique_undeclared = sorted(unique_undeclared, lambda access: access.var)
         for access in unique_undeclared:
@@ -579,7 +796,87 @@ class Program(Node, LoopTrait):
             decl = Declaration(access.var, len(access.indices), sizes)
             self.decls.append(decl)
 
+# Yields the accesses under an expression, statement or loop shape in
+# program order, without building sets like get_accesses. It uses an
+# explicit stack since unrolled indices can be nested very deeply.
+def iterate_accesses(node):
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        ty = type(node)
+        if ty == Access:
+            yield node
+            stack += reversed(node.indices)
+        elif ty == Op:
+            stack += reversed(node.args)
+        elif ty == Assignment:
+            stack += [node.rhs, node.lhs]
+        elif ty == LoopShape:
+            stack.append(node.step)
+            stack += reversed(node.less_eq)
+            stack += [node.greater_eq, node.loop_var]
+        elif ty == AbstractLoop:
+            stack += reversed(node.body)
+            stack += reversed(node.loop_shapes)
+        elif ty == Program:
+            stack += reversed(node.body)
+
+# The accesses under a loop or program (including its loop shapes), in
+# program order:
+#   accesses: all of them
+#   by_var:   var -> accesses of that var
+#   reads, writes: the accesses split by is_write
+#   owners:   access -> the statement (Assignment or AbstractLoop for
+#             loop shapes) it belongs to
+# Nested loops contribute their own index, so after a change only the
+# loops on the path to it are walked again.
+class AccessIndex:
+    __slots__ = ('accesses', 'by_var', 'reads', 'writes', 'owners')
+    def __init__(self, root):
+        self.accesses = []
+        self.by_var = {}
+        self.reads = []
+        self.writes = []
+        self.owners = {}
+        for shape in root.loop_shapes:
+            self.add_accesses(iterate_accesses(shape), root)
+        for stmt in root.body:
+            if type(stmt) == AbstractLoop:
+                self.merge(stmt.access_index())
+            else:
+                self.add_accesses(iterate_accesses(stmt), stmt)
+
+    def add_accesses(self, accesses, owner):
+        for access in accesses:
+            self.accesses.append(access)
+            self.by_var.setdefault(access.var, []).append(access)
+            if access.is_write:
+                self.writes.append(access)
+            else:
+                self.reads.append(access)
+            self.owners[access] = owner
+
+    def merge(self, other):
+        self.accesses += other.accesses
+        for var, accesses in other.by_var.items():
+            self.by_var.setdefault(var, []).extend(accesses)
+        self.reads += other.reads
+        self.writes += other.writes
+        self.owners.update(other.owners)
+
+    def get(self, var):
+        return self.by_var.get(var, [])
+
+    def owner(self, access):
+        return self.owners[access]
+
+    def __len__(self):
+        return len(self.accesses)
+
 def get_accesses(node, ignore_indices=False):
+    # Loops and programs answer from their index
+    if not ignore_indices and isinstance(node, LoopTrait):
+        return set(node.access_index().accesses)
     accesses = set()
     if isinstance(node, Assignment):
         accesses.update(get_accesses(node.lhs, ignore_indices))
@@ -624,6 +921,24 @@ def get_accesses(node, ignore_indices=False):
     else:
         raise RuntimeError('Unhandled type of node ' + str(type(node)))
 
+# Add implicit constants that are created when the bounds and steps
+# of loop vars are not explicitly stated
+def infer_consts(decls, body):
+    non_consts = set()
+    for decl in decls:
+        non_consts.add(decl.name)
+    for stmt in body:
+        for loop in get_loops(stmt):
+            for shape in loop.loop_shapes:
+                non_consts.add(shape.loop_var.var)
+    consts_set = set()
+    for stmt in body:
+        for access in iterate_accesses(stmt):
+            # Name holes aren't constants, they are filled in later
+            if type(access.var) == str and access.var not in non_consts:
+                consts_set.add(access.var)
+    return [Const(name) for name in sorted(list(consts_set))]
+
 def count_ops(node, ignore_indices=False):
     if isinstance(node, Assignment):
         return count_ops(node.lhs, ignore_indices) + count_ops(node.rhs, ignore_indices)
@@ -732,7 +1047,7 @@ def get_ordered_loops(node):
 # returns a map from array name to the number of dimensions for that array
 def get_arrays(program):
     arrays = {}
-    for access in get_accesses(program):
+    for access in program.access_index().accesses:
         array_name = access.var
         n_dimensions = len(access.indices)
         if not array_name in arrays:
@@ -741,25 +1056,38 @@ def get_arrays(program):
             assert(arrays[array_name] == n_dimensions)
     return arrays
 
-class ConstReplacer(Replacer):
+class ConstReplacer(Rule):
+    node_types = (Access,)
     def __init__(self, replace_map):
         self.replace_map = replace_map
-    def should_skip(self, node):
-        return not isinstance(node, Node)
-    def should_replace(self, node):
-        return type(node) == Access and node.var in self.replace_map
-    def replace(self, node):
+    def matches(self, node):
+        return node.var in self.replace_map
+    def rewrite(self, node):
         return Literal(type(self.replace_map[node.var]), self.replace_map[node.var])
 
-class VarRenamer(Replacer):
+# Renames arrays, scalars and loop vars, all at once (a name that's
+# renamed to another one isn't renamed again). Through replace() it
+# renames the names themselves, so the ones in indices are renamed too.
+class VarRenamer(Rule):
+    node_types = (Access, Declaration, Const)
+    is_applied_once = True
     def __init__(self, replace_map):
         self.replace_map = replace_map
-    def should_skip(self, node):
-        return False
     def should_replace(self, node):
         return type(node) == str and node in self.replace_map
     def replace(self, node):
         return self.replace_map[node]
+    def matches(self, node):
+        name = node.var if type(node) == Access else node.name
+        return type(name) == str and name in self.replace_map
+    def rewrite(self, node):
+        if type(node) == Access:
+            renamed = Access(self.replace_map[node.var], node.indices, node.copy_attributes())
+            renamed.is_write = node.is_write
+            return renamed
+        renamed = node.clone()
+        renamed.name = self.replace_map[node.name]
+        return renamed
 
 def is_zero(node):
     return type(node) == Literal and node.ty == int and node.val == 0
@@ -767,44 +1095,109 @@ def is_zero(node):
 def is_one(node):
     return type(node) == Literal and node.ty == int and node.val == 1
 
-class Times0(Replacer):
-    def should_skip(self, node):
-        return False
-    def should_replace(self, node):
-        if type(node) != Op or node.op != '*':
+def is_binary_op(node, op):
+    return node.op == op and len(node.args) == 2
+
+class Times0(Rule):
+    node_types = (Op,)
+    def matches(self, node):
+        if not is_binary_op(node, '*'):
             return False
         return is_zero(node.args[0]) or is_zero(node.args[1])
-    def replace(self, node):
+    def rewrite(self, node):
         return Literal(int, 0)
 
-class Plus0(Replacer):
-    def should_skip(self, node):
-        return False
-    def should_replace(self, node):
-        if type(node) != Op or node.op != '+':
+class Plus0(Rule):
+    node_types = (Op,)
+    def matches(self, node):
+        if not is_binary_op(node, '+'):
             return False
         return is_zero(node.args[0]) or is_zero(node.args[1])
-    def replace(self, node):
+    def rewrite(self, node):
         if is_zero(node.args[0]):
-            return node.args[1].clone()
-        return node.args[0].clone()
+            return node.args[1]
+        return node.args[0]
 
-class Times1(Replacer):
-    def should_skip(self, node):
-        return False
-    def should_replace(self, node):
-        if type(node) != Op or node.op != '*':
+class Times1(Rule):
+    node_types = (Op,)
+    def matches(self, node):
+        if not is_binary_op(node, '*'):
             return False
         return is_one(node.args[0]) or is_one(node.args[1])
-    def replace(self, node):
+    def rewrite(self, node):
         if is_one(node.args[0]):
-            return node.args[1].clone()
-        return node.args[0].clone()
+            return node.args[1]
+        return node.args[0]
 
 def simplify_0s_and_1s(node):
-    node.replace(Times0())
-    node.replace(Times1(), dfs=True)
-    node.replace(Plus0(), dfs=True)
+    return rewrite(node, [Times0(), Times1(), Plus0()])
+
+# Nodes compare and hash by identity because the analyses keep sets of
+# accesses and look statements up in loop bodies, where two equal reads
+# in one statement are still different references. StructuralKey wraps a
+# node so that it can be used as a dict key or set element that compares
+# by structure instead.
+class StructuralKey:
+    __slots__ = ('node', 'hash')
+    def __init__(self, node):
+        self.node = node
+        self.hash = node.structural_hash()
+    def __hash__(self):
+        return self.hash
+    def __eq__(self, other):
+        return (type(other) == StructuralKey and
+                self.hash == other.hash and
+                self.node.is_syntactically_equal(other.node))
+
+# Interns Literal, Access and Op subtrees so that equal subtrees are
+# stored once. Nodes with attributes (node ids) are never shared.
+#
+# Shared subtrees must not be mutated, and their parent_stmt only points
+# to one of the statements using them, so interned programs are meant
+# for storage, hashing and printing. clone() gives back a tree without
+# sharing for transformations and analyses.
+class HashConsTable:
+    def __init__(self):
+        self.nodes = {}
+        self.n_interned = 0
+        self.n_shared = 0
+
+    def intern(self, node):
+        ty = type(node)
+        if ty == Access:
+            node.indices = [self.intern(index) for index in node.indices]
+            node._hash = None
+            node._affine = None
+        elif ty == Op:
+            node.args = [self.intern(arg) for arg in node.args]
+            node._hash = None
+            node._affine = None
+        elif ty not in [Literal, Hex]:
+            return node
+        if node._attributes:
+            return node
+        self.n_interned += 1
+        key = StructuralKey(node)
+        existing = self.nodes.get(key)
+        if existing is not None:
+            self.n_shared += 1
+            return existing
+        self.nodes[key] = node
+        return node
+
+    # Interns the expressions of every assignment in a statement tree
+    def intern_stmts(self, stmts):
+        for stmt in stmts:
+            if type(stmt) == Assignment:
+                stmt.lhs = self.intern(stmt.lhs)
+                stmt.rhs = self.intern(stmt.rhs)
+                if stmt.surrounding_loop is not None:
+                    stmt.surrounding_loop.invalidate_indexes()
+            elif type(stmt) == AbstractLoop:
+                self.intern_stmts(stmt.body)
+
+    def __len__(self):
+        return len(self.nodes)
 
 def gather_surrounding_loops(stmt):
     def recurse(s, acc):
@@ -814,6 +1207,90 @@ def gather_surrounding_loops(stmt):
         return recurse(outer, [outer] + acc)
     return recurse(stmt, [])
 
+# Numbers the statements of a program in one depth-first walk. Each
+# statement (and the program) gets a Position with
+#   pre, post: the interval of pre-order numbers of it and everything
+#              under it
+#   depth:     the number of surrounding loops
+#   ancestors: the surrounding loops, outermost first, starting with the
+#              program, as gather_surrounding_loops returns them
+#   n_loop_dims: the number of loop shapes of the ancestors and itself
+# so execution order and common loops are answered without walking the
+# tree. The program caches it, see Program.position_index.
+class Position:
+    __slots__ = ('pre', 'post', 'depth', 'ancestors', 'chain', 'n_loop_dims')
+
+class PositionIndex:
+    def __init__(self, program):
+        self.positions = {}
+        self.counter = 0
+        self.number(program, [], 0)
+
+    def number(self, node, ancestors, n_loop_dims):
+        position = Position()
+        position.pre = self.counter
+        self.counter += 1
+        position.depth = len(ancestors)
+        position.ancestors = ancestors
+        position.n_loop_dims = n_loop_dims + len(node.loop_shapes) if isinstance(node, LoopTrait) else n_loop_dims
+        self.positions[node] = position
+        if isinstance(node, LoopTrait):
+            # Shared by the statements in the body
+            position.chain = ancestors + [node]
+            for stmt in node.body:
+                self.number(stmt, position.chain, position.n_loop_dims)
+        else:
+            position.chain = None
+        position.post = self.counter - 1
+
+    def __getitem__(self, node):
+        return self.positions[node]
+
+    def __contains__(self, node):
+        return node in self.positions
+
+    def contains(self, outer, inner):
+        outer_position = self.positions[outer]
+        inner_pre = self.positions[inner].pre
+        return outer_position.pre <= inner_pre <= outer_position.post
+
+    # Whether stmt1 is executed before stmt2 in the same iteration of
+    # their common loops, i.e. it ends before stmt2 starts. A loop
+    # doesn't precede the statements in it, nor the other way around.
+    def precedes(self, stmt1, stmt2):
+        return self.positions[stmt1].post < self.positions[stmt2].pre
+
+    # The innermost loop (or the program) that strictly surrounds both
+    # statements. The chains are only as long as the loop nests are
+    # deep, so the binary search is a handful of comparisons.
+    def lowest_common_loop(self, stmt1, stmt2):
+        ancestors = self.positions[stmt1].ancestors
+        pre2 = self.positions[stmt2].pre
+        lo, hi = 0, len(ancestors) - 1
+        # ancestors[0] is the program, which contains everything
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            mid_position = self.positions[ancestors[mid]]
+            if mid_position.pre < pre2 <= mid_position.post:
+                lo = mid
+            else:
+                hi = mid - 1
+        return ancestors[lo]
+
+    # The loops surrounding both statements, outermost first, like the
+    # common prefix of their gather_surrounding_loops
+    def common_loops(self, stmt1, stmt2):
+        return self.positions[self.lowest_common_loop(stmt1, stmt2)].chain
+
+    def surrounding_loops(self, stmt):
+        return self.positions[stmt].ancestors
+
+def get_position_index(stmt):
+    root = stmt
+    while root.surrounding_loop is not None:
+        root = root.surrounding_loop
+    return root.position_index()
+
 def gather_loop_shapes(loops):
     loop_shapes = []
     for loop in loops:
@@ -827,14 +1304,24 @@ def gather_loop_vars(loop_shapes):
         loop_vars.append(shape.loop_var.var)
     return loop_vars
 
+# Hole itself has no slots so that OpHole can also derive from Op. Each
+# kind of hole declares its fields.
 class Hole(Node):
+    __slots__ = ()
     def __init__(self, hole_name, family_name):
         self.hole_name = hole_name
         self.family_name = family_name
     def is_hole(self):
         return True
+    def is_syntactically_equal(self, other):
+        return (type(other) == type(self) and
+                self.hole_name == other.hole_name and
+                self.family_name == other.family_name)
+    def structural_hash(self):
+        return hash((type(self), self.hole_name, self.family_name))
 
 class NameHole(Hole):
+    __slots__ = ('hole_name', 'family_name')
     def pprint(self, indent=0):
         return '_'
     def replace(self, replacer, dfs=False):
@@ -843,6 +1330,7 @@ class NameHole(Hole):
         return NameHole(self.hole_name, self.family_name)
 
 class StatementHole(Hole):
+    __slots__ = ('hole_name', 'family_name', 'surrounding_loop')
     def pprint(self, indent=0):
         ws = space_per_indent * indent * ' '
         return f'{ws}${self.hole_name}:{self.family_name}$'
@@ -852,6 +1340,7 @@ class StatementHole(Hole):
         return StatementHole(self.hole_name, self.family_name)
 
 class ExpressionHole(Hole):
+    __slots__ = ('hole_name', 'family_name', 'parent_stmt', 'is_write')
     def pprint(self, indent=0):
         return f'#{self.hole_name}:{self.family_name}#'
     def replace(self, replacer, dfs=False):
@@ -860,6 +1349,7 @@ class ExpressionHole(Hole):
         return ExpressionHole(self.hole_name, self.family_name)
 
 class OpHole(Hole, Op):
+    __slots__ = ('hole_name', 'family_name')
     def pprint(self, indent=0):
         return '@'
     def replace(self, replacer, dfs=False):
@@ -868,3 +1358,131 @@ class OpHole(Hole, Op):
         return OpHole(self.hole_name, self.family_name)
     def precedence(self):
         return 150 # same precedence as multiplicatives
+
+# The fields of each node type that can hold nodes, lists of nodes
+# marked True
+child_fields = {
+    Const: [],
+    Declaration: [('sizes', True)],
+    Literal: [],
+    Hex: [],
+    NoOp: [],
+    Assignment: [('lhs', False), ('rhs', False)],
+    Access: [('var', False), ('indices', True)],
+    LoopShape: [('loop_var', False), ('greater_eq', False), ('less_eq', True), ('step', False)],
+    AbstractLoop: [('loop_shapes', True), ('body', True)],
+    Op: [('op', False), ('args', True)],
+    Program: [('decls', True), ('consts', True), ('loop_shapes', True), ('body', True)],
+    NameHole: [],
+    StatementHole: [],
+    ExpressionHole: [],
+    OpHole: [],
+}
+
+# Applies rules bottom-up in one pass over the tree, modifying it in
+# place, and returns the new root (which is only different from root if
+# the root itself was rewritten).
+#
+# Each node is handed to the rules for its type once its children are
+# done, and rewritten until none of them matches. A rule's result isn't
+# walked again, so it should be built from the (already rewritten)
+# children of the node it replaces.
+#
+# The walk uses an explicit stack, so it handles expressions nested far
+# deeper than the recursion limit, like repeatedly unrolled indices.
+# parent_stmt is only recomputed for statements that changed.
+max_rewrites_per_node = 1000
+
+def rewrite(root, rules):
+    dispatch = {}
+    for rule in rules:
+        for ty in rule.node_types:
+            dispatch.setdefault(ty, []).append(rule)
+
+    # Pre-order walk recording where each node is held:
+    # (node, parent entry, field, list index or None, statement)
+    entries = []
+    stack = [(root, -1, None, None, None)]
+    while stack:
+        node, parent, field, index, stmt = stack.pop()
+        if type(node) in [Assignment, AbstractLoop, Program]:
+            stmt = node
+        current = len(entries)
+        entries.append((node, parent, field, index, stmt))
+        for name, is_list in child_fields[type(node)]:
+            value = getattr(node, name)
+            if is_list:
+                for i, child in enumerate(value):
+                    if isinstance(child, Node):
+                        stack.append((child, current, name, i, stmt))
+            elif isinstance(value, Node):
+                stack.append((value, current, name, None, stmt))
+
+    # Every node comes after its children in reverse pre-order
+    changed = bytearray(len(entries))
+    changed_stmts = []
+    new_root = root
+    for current in range(len(entries) - 1, -1, -1):
+        node, parent, field, index, stmt = entries[current]
+        if changed[current] and hasattr(node, '_hash'):
+            node._hash = None
+        if changed[current] and hasattr(node, '_affine'):
+            node._affine = None
+        rewritten = node
+        n_rewrites = 0
+        applied = None
+        matched = True
+        while matched:
+            matched = False
+            for rule in dispatch.get(type(rewritten), []):
+                if applied is not None and rule in applied:
+                    continue
+                if rule.matches(rewritten):
+                    rewritten = rule.rewrite(rewritten)
+                    if rule.is_applied_once:
+                        applied = [rule] if applied is None else applied + [rule]
+                    matched = True
+                    n_rewrites += 1
+                    if n_rewrites > max_rewrites_per_node:
+                        raise RuntimeError(f'rewrite: no fixpoint for {node.pprint()}')
+                    break
+        if rewritten is not node:
+            if parent < 0:
+                new_root = rewritten
+                continue
+            holder = entries[parent][0]
+            if index is None:
+                setattr(holder, field, rewritten)
+            else:
+                getattr(holder, field)[index] = rewritten
+            if field == 'body':
+                rewritten.surrounding_loop = holder
+            elif field == 'lhs':
+                rewritten.is_write = True
+            # A rewritten statement changes the loop holding it
+            owner = stmt if stmt is not node else entries[parent][4]
+            if owner is not None:
+                changed_stmts.append(owner)
+            changed[parent] = 1
+        elif changed[current] and parent >= 0:
+            changed[parent] = 1
+
+    if changed_stmts:
+        seen = set()
+        for stmt in changed_stmts:
+            if stmt in seen:
+                continue
+            seen.add(stmt)
+            if type(stmt) == Assignment:
+                stmt.set_parent_stmt()
+                loop = stmt.surrounding_loop
+            elif type(stmt) == AbstractLoop:
+                for shape in stmt.loop_shapes:
+                    for access in iterate_accesses(shape):
+                        access.parent_stmt = stmt
+                loop = stmt
+            else:
+                loop = stmt
+            if loop is not None:
+                loop.invalidate_indexes()
+    return new_root
@@ -0,0 +1,119 @@
+from pattern_ast import (AbstractLoop, Access, Op, Literal, Rule, VarRenamer,
+                         iterate_accesses, rewrite, greater_eq_const_name,
+                         less_eq_const_name)
+
+# A canonical form of programs, for telling apart programs that are the
+# same up to
+#   - the names of the arrays and of the loop variables, and
+#   - the order of the operands of + and *.
+# Loop variables are renamed i0, i1, ... in the order of their loops,
+# along with the constants of their default bounds (i_greater_eq,
+# i_less_eq). Operands are then ordered by a key in which arrays are
+# anonymous, arrays are renamed a0, a1, ... in the order they first
+# appear, and operands are ordered again to break ties. Decls are
+# sorted by name.
+#
+# Programs with the same form are equivalent up to renaming, but not
+# every two such programs get the same form. Renaming arrays also
+# assumes they're configured alike (types, initial values). Scalars
+# that aren't loop variables keep their names, they're the parameters
+# that configurations refer to.
+
+commutative_ops = ['+', '*']
+
+def expr_key(node, names):
+    ty = type(node)
+    if ty == Access:
+        var = names.get(node.var, node.var) if type(node.var) == str else node.var.pprint()
+        return var + ''.join(f'[{expr_key(index, names)}]' for index in node.indices)
+    if ty == Op:
+        return f'({node.op} {" ".join(expr_key(arg, names) for arg in node.args)})'
+    if ty == Literal:
+        return f'{node.ty.__name__}:{node.val}'
+    return node.pprint()
+
+class SortOperands(Rule):
+    node_types = (Op,)
+    def __init__(self, names):
+        self.names = names
+    def matches(self, node):
+        return (node.op in commutative_ops and len(node.args) == 2 and
+                expr_key(node.args[1], self.names) < expr_key(node.args[0], self.names))
+    def rewrite(self, node):
+        return Op(node.op, [node.args[1], node.args[0]], node.copy_attributes())
+
+def renamable_names(program):
+    arrays = {decl.name for decl in program.decls if decl.n_dimensions > 0}
+    loop_vars = set()
+    stack = list(program.body)
+    while stack:
+        stmt = stack.pop()
+        if type(stmt) == AbstractLoop:
+            for shape in stmt.loop_shapes:
+                if type(shape.loop_var.var) == str:
+                    loop_vars.add(shape.loop_var.var)
+            stack += stmt.body
+    return arrays, loop_vars - arrays
+
+def bound_names(loop_var):
+    return [greater_eq_const_name(loop_var), less_eq_const_name(loop_var)]
+
+# Names the variables of to_rename in the order they first appear as
+# prefix0, prefix1, ..., skipping names that are taken. The ones that
+# never appear (declared but unused) come last, by name.
+def first_appearance_names(program, to_rename, prefix, taken):
+    order = []
+    seen = set()
+    for access in iterate_accesses(program):
+        var = access.var
+        if type(var) == str and var in to_rename and var not in seen:
+            seen.add(var)
+            order.append(var)
+    order += sorted(to_rename - seen)
+    names = {}
+    n = 0
+    for var in order:
+        while f'{prefix}{n}' in taken:
+            n += 1
+        names[var] = f'{prefix}{n}'
+        n += 1
+    return names
+
+def taken_names(program, renamable):
+    taken = set()
+    for access in program.access_index().accesses:
+        if type(access.var) == str and access.var not in renamable:
+            taken.add(access.var)
+    for decl in program.decls:
+        if decl.name not in renamable:
+            taken.add(decl.name)
+    return taken
+
+def canonicalize(program):
+    arrays, loop_vars = renamable_names(program)
+    renamable = arrays | loop_vars
+    for loop_var in loop_vars:
+        renamable.update(bound_names(loop_var))
+    taken = taken_names(program, renamable)
+
+    # Loop variables first appear in loop shapes, so their names don't
+    # depend on the order of operands
+    names = first_appearance_names(program, loop_vars, 'i', taken)
+    for loop_var, name in list(names.items()):
+        for bound, new_bound in zip(bound_names(loop_var), bound_names(name)):
+            names[bound] = new_bound
+
+    # The new names can be old names of other variables (an array called
+    # i0), so every variable is renamed at once, in one pass at the end
+    anonymous = dict(names)
+    anonymous.update({array: '@a' for array in arrays})
+    canonical = rewrite(program.clone(), [SortOperands(anonymous)])
+    names.update(first_appearance_names(canonical, arrays, 'a', taken))
+    canonical = rewrite(canonical, [VarRenamer(names)])
+
+    canonical = rewrite(canonical, [SortOperands({})])
+    canonical.decls.sort(key=lambda decl: decl.name)
+    return canonical
+
+def canonical_key(program):
+    return canonicalize(program).to_bytes()
@@ -0,0 +1,289 @@
+import re
+from pattern_ast import (Assignment, Access, AbstractLoop, Program, Declaration,
+                         Literal, Op, LoopShapeBuilder, Hex, NoOp, StatementHole,
+                         ExpressionHole, NameHole, OpHole, infer_consts,
+                         greater_eq_const_name, less_eq_const_name)
+
+# A hand-written parser for the grammar in pattern.py.
+#
+# It builds pattern_ast nodes directly in one pass instead of going
+# through a lark parse tree and TreeSimplifier. Binary operators are
+# parsed by precedence climbing. The lark parser is the reference, see
+# examples/parser-differential.py.
+
+token_regex = re.compile(r'''
+    (?P<ws>[ \t\f\r\n]+|\#\#[^\n]*)
+  | (?P<hex>0[xX][0-9a-fA-F]*)
+  | (?P<float>(?:[0-9]+\.[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?|[0-9]+[eE][+-]?[0-9]+)
+  | (?P<int>[0-9]+)
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<punct><<|>>|<=|>=|==|!=|&&|\|\||\+=|[-+*/%<>=!~&|^?:;,()\[\]{}$\#@`])
+''', re.VERBOSE)
+
+keywords = {'declare', 'local', 'for'}
+
+# Same levels as the grammar, from loosest to tightest
+binary_precedence = {
+    '||': 80,
+    '&&': 90,
+    '|': 93,
+    '^': 95,
+    '&': 100,
+    '==': 110, '!=': 110,
+    '<': 120, '>': 120, '<=': 120, '>=': 120,
+    '<<': 130, '>>': 130,
+    '+': 140, '-': 140,
+    '*': 150, '/': 150, '%': 150, '@': 150,
+}
+lowest_precedence = min(binary_precedence.values())
+
+unary_ops = {'+', '-', '!', '~'}
+loop_shape_prefixes = {'<=', '>=', '+='}
+
+class Token:
+    def __init__(self, kind, value, pos):
+        self.kind = kind
+        self.value = value
+        self.pos = pos
+
+def tokenize(code):
+    tokens = []
+    pos = 0
+    while pos < len(code):
+        match = token_regex.match(code, pos)
+        if match is None:
+            raise RuntimeError(f'Unexpected character {code[pos]!r} at {position(code, pos)}')
+        kind = match.lastgroup
+        value = match.group()
+        if kind == 'name' and value in keywords:
+            kind = 'keyword'
+        if kind != 'ws':
+            tokens.append(Token(kind, value, pos))
+        pos = match.end()
+    tokens.append(Token('eof', '', pos))
+    return tokens
+
+def position(code, pos):
+    line = code.count('\n', 0, pos) + 1
+    column = pos - (code.rfind('\n', 0, pos) + 1) + 1
+    return f'line {line}, column {column}'
+
+class RecursiveDescentParser:
+    def __init__(self, code):
+        self.code = code
+        self.tokens = tokenize(code)
+        self.current = 0
+
+    def peek(self, offset=0):
+        return self.tokens[self.current + offset]
+
+    def at(self, value, offset=0):
+        token = self.peek(offset)
+        return token.kind in ['punct', 'keyword'] and token.value == value
+
+    def advance(self):
+        token = self.tokens[self.current]
+        self.current += 1
+        return token
+
+    def error(self, token=None):
+        token = self.peek() if token is None else token
+        what = 'end of input' if token.kind == 'eof' else repr(token.value)
+        raise RuntimeError(f'Unexpected {what} at {position(self.code, token.pos)}')
+
+    def expect(self, value):
+        if not self.at(value):
+            self.error()
+        return self.advance()
+
+    def expect_name(self):
+        token = self.peek()
+        if token.kind != 'name':
+            self.error()
+        return self.advance().value
+
+    def parse(self, start_rule="start"):
+        if start_rule == 'start':
+            result = self.start()
+        elif start_rule == 'statement':
+            result = self.statement()
+        elif start_rule == 'expr':
+            result = self.expr()
+        else:
+            raise RuntimeError(f'Unsupported start rule ({start_rule})')
+        if self.peek().kind != 'eof':
+            self.error()
+        return result
+
+    def start(self):
+        decls = [self.declaration()]
+        while self.at('declare') or self.at('local'):
+            decls.append(self.declaration())
+        body = [self.statement()]
+        while self.peek().kind != 'eof':
+            body.append(self.statement())
+        for stmt in body:
+            if type(stmt) not in [AbstractLoop, Assignment, NoOp]:
+                raise RuntimeError('Unsupported syntax in main program')
+        return Program(decls, body, infer_consts(decls, body))
+
+    def declaration(self):
+        if not (self.at('declare') or self.at('local')):
+            self.error()
+        is_local = self.advance().value == 'local'
+        name = self.expect_name()
+        sizes = []
+        while self.at('['):
+            self.advance()
+            if self.at(']'):
+                sizes.append(None)
+            else:
+                sizes.append(self.expr())
+            self.expect(']')
+        self.expect(';')
+        return Declaration(name, len(sizes), sizes, is_local=is_local)
+
+    def statement(self):
+        if self.at('for'):
+            return self.abstract_loop()
+        if self.at(';'):
+            self.advance()
+            return NoOp()
+        if self.at('$'):
+            hole_name, family_name = self.hole('$')
+            return StatementHole(hole_name, family_name)
+        lhs = self.expr()
+        self.expect('=')
+        rhs = self.expr()
+        self.expect(';')
+        return Assignment(lhs, rhs)
+
+    def abstract_loop(self):
+        self.expect('for')
+        self.expect('[')
+        loop_shapes = [self.loop_shape()]
+        while self.at(','):
+            self.advance()
+            loop_shapes.append(self.loop_shape())
+        self.expect(']')
+        self.expect('{')
+        body = [self.statement()]
+        while not self.at('}'):
+            body.append(self.statement())
+        self.advance()
+        return AbstractLoop(loop_shapes, body)
+
+    # "(i)" is both a multi loop shape with one part and a single loop
+    # shape whose expression is parenthesized. Both give the same shape.
+    def loop_shape(self):
+        merged = LoopShapeBuilder()
+        if self.at('('):
+            self.advance()
+            merged = self.loop_shape_part()
+            while self.at(','):
+                self.advance()
+                merged.merge(self.loop_shape_part())
+            self.expect(')')
+        else:
+            merged.set_shape_part(self.expr())
+        if merged.loop_var is None or type(merged.loop_var) != Access:
+            raise RuntimeError(f'Unsupported loop shape at {position(self.code, self.peek().pos)}')
+        loop_var = merged.loop_var.var
+        return merged.build(Access(greater_eq_const_name(loop_var)),
+                            Access(less_eq_const_name(loop_var)),
+                            Literal(int, 1))
+
+    def loop_shape_part(self):
+        builder = LoopShapeBuilder()
+        token = self.peek()
+        if token.kind == 'punct' and token.value in loop_shape_prefixes:
+            self.advance()
+            builder.set_shape_part(self.expr(), token.value)
+        else:
+            builder.set_shape_part(self.expr())
+        return builder
+
+    def hole(self, delimiter):
+        self.expect(delimiter)
+        hole_name = self.expect_name()
+        family_name = '_'
+        if self.at(':'):
+            self.advance()
+            family_name = self.expect_name()
+        self.expect(delimiter)
+        return hole_name, family_name
+
+    def expr(self):
+        condition = self.binary(lowest_precedence)
+        if not self.at('?'):
+            return condition
+        self.advance()
+        if_true = self.binary(lowest_precedence)
+        self.expect(':')
+        if_false = self.expr()
+        return Op('?:', [condition, if_true, if_false])
+
+    def binary_op(self):
+        token = self.peek()
+        if token.kind != 'punct' or token.value not in binary_precedence:
+            return None
+        return token.value
+
+    # Every binary operator is left associative
+    def binary(self, min_precedence):
+        lhs = self.unary()
+        while True:
+            op = self.binary_op()
+            if op is None or binary_precedence[op] < min_precedence:
+                return lhs
+            precedence = binary_precedence[op]
+            if op == '@':
+                op = OpHole(*self.hole('@'))
+            else:
+                self.advance()
+            rhs = self.binary(precedence + 1)
+            lhs = Op(op, [lhs, rhs])
+
+    def unary(self):
+        ops = []
+        while self.peek().kind == 'punct' and self.peek().value in unary_ops:
+            ops.append(self.advance().value)
+        result = self.atom()
+        for op in reversed(ops):
+            result = Op(op, [result])
+        return result
+
+    def atom(self):
+        token = self.peek()
+        if self.at('('):
+            self.advance()
+            result = self.expr()
+            self.expect(')')
+            return result
+        if self.at('#'):
+            return ExpressionHole(*self.hole('#'))
+        if self.at('`'):
+            return Access(NameHole(*self.hole('`')))
+        if token.kind == 'int':
+            self.advance()
+            return Literal(int, int(token.value))
+        if token.kind == 'float':
+            self.advance()
+            return Literal(float, float(token.value))
+        if token.kind == 'hex':
+            self.advance()
+            return Hex(token.value)
+        if token.kind == 'name':
+            self.advance()
+            if not self.at('['):
+                return Access(token.value)
+            indices = []
+            while self.at('['):
+                self.advance()
+                indices.append(self.expr())
+                self.expect(']')
+            return Access(token.value, indices)
+        self.error()
+
+def parse_str(code, start_rule="start"):
+    return RecursiveDescentParser(code).parse(start_rule)
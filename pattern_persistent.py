@@ -0,0 +1,181 @@
+from pattern_ast import (Node, Const, Declaration, Literal, Hex, NoOp, Assignment,
+                         Access, LoopShape, AbstractLoop, Op, OpHole, Program,
+                         NameHole, StatementHole, ExpressionHole)
+
+# Persistent (path-copying) operations on programs.
+#
+# None of these functions modify their input. They return a new root
+# that shares every subtree that didn't change with the old one, and
+# only the nodes on the path to a change are copied. This makes trying
+# many variants of one program cheap compared to cloning it each time.
+#
+# Shared nodes keep their back pointers (surrounding_loop, parent_stmt)
+# to the tree they were created in, and a subtree may even appear more
+# than once in a new tree. Reading, printing, hashing and serializing
+# the result is fine. Anything that follows back pointers or mutates
+# nodes (dependence analysis, codegen, the mutating transformations)
+# needs materialize() first, which builds an ordinary tree.
+
+# The fields replace() visits for each node type. Lists are replaced
+# element by element.
+replace_fields = {
+    Const: [('name', False)],
+    Declaration: [('name', False), ('sizes', True)],
+    Literal: [('ty', False), ('val', False)],
+    Hex: [('ty', False), ('val', False), ('str_val', False)],
+    NoOp: [],
+    Assignment: [('lhs', False), ('rhs', False)],
+    Access: [('var', False), ('indices', True)],
+    LoopShape: [('loop_var', False), ('greater_eq', False), ('less_eq', True), ('step', False)],
+    AbstractLoop: [('loop_shapes', True), ('body', True)],
+    Op: [('op', False), ('args', True)],
+    Program: [('decls', True), ('consts', True), ('loop_shapes', True), ('body', True)],
+    NameHole: [],
+    StatementHole: [],
+    ExpressionHole: [],
+    OpHole: [],
+}
+
+slot_names_cache = {}
+
+def slot_names(cls):
+    if cls not in slot_names_cache:
+        names = []
+        for c in reversed(cls.__mro__):
+            names += getattr(c, '__slots__', ())
+        slot_names_cache[cls] = names
+    return slot_names_cache[cls]
+
+# Copies a node without calling its constructor, which would point the
+# back pointers of the (shared) children to the copy
+def shallow_copy(node):
+    copied = object.__new__(type(node))
+    for name in slot_names(type(node)):
+        if hasattr(node, name):
+            setattr(copied, name, getattr(node, name))
+    if '_hash' in slot_names(type(node)):
+        copied._hash = None
+    if '_affine' in slot_names(type(node)):
+        copied._affine = None
+    if '_access_index' in slot_names(type(node)):
+        copied._access_index = None
+    if '_position_index' in slot_names(type(node)):
+        copied._position_index = None
+    return copied
+
+def with_fields(node, **fields):
+    copied = shallow_copy(node)
+    for name, value in fields.items():
+        setattr(copied, name, value)
+    return copied
+
+def make_loop(loop_shapes, body, attributes=None):
+    loop = object.__new__(AbstractLoop)
+    loop.loop_shapes = loop_shapes
+    loop.body = body
+    loop.surrounding_loop = None
+    loop._attributes = attributes
+    loop._access_index = None
+    return loop
+
+def replace_children(node, replacer, dfs):
+    if not isinstance(node, Node):
+        return node
+    changed = {}
+    for name, is_list in replace_fields[type(node)]:
+        value = getattr(node, name)
+        # Like Op.replace, only op holes are visited, not op strings
+        if type(node) == Op and name == 'op' and type(value) != OpHole:
+            continue
+        if is_list:
+            new_value = [persistent_replace(v, replacer, dfs) for v in value]
+            if any(a is not b for a, b in zip(new_value, value)):
+                changed[name] = new_value
+        else:
+            new_value = persistent_replace(value, replacer, dfs)
+            if new_value is not value:
+                changed[name] = new_value
+    if not changed:
+        return node
+    return with_fields(node, **changed)
+
+# Same as pattern_ast.replace, but returns a new tree instead of
+# modifying the given one
+def persistent_replace(i, replacer, dfs=False):
+    if dfs:
+        i = replace_children(i, replacer, dfs)
+
+    if replacer.should_skip(i):
+        return i
+
+    if replacer.should_replace(i):
+        return replacer.replace(i)
+
+    if not dfs:
+        i = replace_children(i, replacer, dfs)
+
+    return i
+
+# Statements are addressed by paths: the indices into the bodies from
+# the root (a Program or AbstractLoop) down to the statement.
+
+def get_stmt(root, path):
+    node = root
+    for i in path:
+        node = node.body[i]
+    return node
+
+def iterate_paths(root, path=()):
+    for i, stmt in enumerate(root.body):
+        stmt_path = path + (i,)
+        yield stmt_path, stmt
+        if type(stmt) == AbstractLoop:
+            yield from iterate_paths(stmt, stmt_path)
+
+def find_path(root, predicate):
+    for path, stmt in iterate_paths(root):
+        if predicate(stmt):
+            return path
+    return None
+
+def path_of(root, stmt):
+    return find_path(root, lambda s: s is stmt)
+
+# Returns a new root where the node at path is update(node), copying the
+# loops along the path
+def update_at(root, path, update):
+    if len(path) == 0:
+        return update(root)
+    i = path[0]
+    body = list(root.body)
+    body[i] = update_at(root.body[i], path[1:], update)
+    return with_fields(root, body=body)
+
+def splice(root, path, stmts):
+    def update_parent(parent):
+        i = path[-1]
+        return with_fields(parent, body=parent.body[:i] + list(stmts) + parent.body[i+1:])
+    return update_at(root, path[:-1], update_parent)
+
+def replace_stmt(root, path, stmt):
+    return splice(root, path, [stmt])
+
+def remove_stmt(root, path):
+    return splice(root, path, [])
+
+def insert_stmts(root, loop_path, index, stmts):
+    def update_loop(loop):
+        return with_fields(loop, body=loop.body[:index] + list(stmts) + loop.body[index:])
+    return update_at(root, loop_path, update_loop)
+
+def reorder_loop_shapes(root, loop_path, order):
+    def update_loop(loop):
+        return with_fields(loop, loop_shapes=[loop.loop_shapes[i] for i in order])
+    return update_at(root, loop_path, update_loop)
+
+def replace_in_stmt(root, path, replacer, dfs=False):
+    return replace_stmt(root, path, persistent_replace(get_stmt(root, path), replacer, dfs))
+
+# Builds an ordinary tree with no sharing and correct back pointers
+def materialize(root):
+    return root.clone()
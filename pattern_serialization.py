@@ -0,0 +1,446 @@
+import struct
+from pattern_ast import (Program, Declaration, Const, AbstractLoop, LoopShape,
+                         Assignment, NoOp, Access, Op, Literal, Hex, NameHole,
+                         StatementHole, ExpressionHole, OpHole,
+                         is_default_greater_eq, is_default_less_eq, is_default_step,
+                         greater_eq_const_name, less_eq_const_name)
+
+# A compact binary encoding of pattern_ast programs.
+#
+# An encoded program is:
+#   magic (4 bytes) | version (1 byte) | record
+#
+# A record starts with the strings it adds to the string table (a varint
+# count followed by length-prefixed UTF-8 strings), followed by the root
+# node. Every name (variables, ops, hole names, types) is stored once and
+# referred to by its index in the table.
+#
+# A node is a tag byte followed by its fields. Integers are zigzag
+# varints and floats are 8-byte doubles. If the NODE_ID bit of the tag is
+# set, the node's attributes['node_id'] follows the tag as a varint.
+# Other attributes aren't stored. Loop shape bounds and steps that are
+# the parser's defaults are only recorded as flags.
+#
+# A stream of programs (see write_programs) is a stream header followed
+# by length-prefixed records. The string table is shared by all the
+# records of a stream, so names common to the programs are stored once.
+
+MAGIC = b'LGPB'
+STREAM_MAGIC = b'LGPS'
+VERSION = 1
+
+PROGRAM = 1
+DECLARATION = 2
+CONST = 3
+LOOP = 4
+ASSIGNMENT = 5
+NO_OP = 6
+SCALAR = 7
+ACCESS = 8
+NAME_HOLE_ACCESS = 9
+OP = 10
+OP_HOLE_OP = 11
+INT = 12
+FLOAT = 13
+HEX = 14
+STATEMENT_HOLE = 15
+EXPRESSION_HOLE = 16
+NONE = 17
+
+NODE_ID = 0x80
+TAG_MASK = 0x7f
+
+# Declaration flags
+IS_LOCAL = 1
+HAS_TYPE = 2
+NO_SIZES = 4
+
+# Loop shape flags
+DEFAULT_GREATER_EQ = 1
+DEFAULT_LESS_EQ = 2
+DEFAULT_STEP = 4
+
+float_struct = struct.Struct('<d')
+
+def write_varint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+def zigzag(n):
+    return n << 1 if n >= 0 else ((-n) << 1) - 1
+
+def unzigzag(n):
+    return n >> 1 if n & 1 == 0 else -((n + 1) >> 1)
+
+# Reads _attributes so that nodes without attributes don't get an empty
+# dict created for them
+def get_node_id(node):
+    attributes = getattr(node, '_attributes', None)
+    if not attributes:
+        return None
+    return attributes.get('node_id')
+
+class Encoder:
+    def __init__(self):
+        self.strings = []
+        self.string_ids = {}
+        self.n_written_strings = 0
+        self.out = bytearray()
+
+    def string(self, s):
+        i = self.string_ids.get(s)
+        if i is None:
+            i = len(self.strings)
+            self.string_ids[s] = i
+            self.strings.append(s)
+        write_varint(self.out, i)
+
+    def tag(self, tag, node):
+        node_id = get_node_id(node)
+        if node_id is None:
+            self.out.append(tag)
+        else:
+            self.out.append(tag | NODE_ID)
+            write_varint(self.out, node_id)
+
+    def hole_names(self, hole):
+        self.string(hole.hole_name)
+        self.string(hole.family_name)
+
+    def nodes(self, nodes):
+        write_varint(self.out, len(nodes))
+        for node in nodes:
+            self.node(node)
+
+    # Defaults carrying a node id aren't left out, the id would be lost
+    def loop_shape(self, shape):
+        self.node(shape.loop_var)
+        loop_var = shape.loop_var.var
+        flags = 0
+        if (is_default_greater_eq(loop_var, shape.greater_eq) and
+            get_node_id(shape.greater_eq) is None):
+            flags |= DEFAULT_GREATER_EQ
+        if (is_default_less_eq(loop_var, shape.less_eq) and
+            get_node_id(shape.less_eq[0]) is None):
+            flags |= DEFAULT_LESS_EQ
+        if is_default_step(shape.step) and get_node_id(shape.step) is None:
+            flags |= DEFAULT_STEP
+        self.out.append(flags)
+        if not flags & DEFAULT_GREATER_EQ:
+            self.node(shape.greater_eq)
+        if not flags & DEFAULT_LESS_EQ:
+            self.nodes(shape.less_eq)
+        if not flags & DEFAULT_STEP:
+            self.node(shape.step)
+
+    def declaration(self, decl):
+        self.tag(DECLARATION, decl)
+        self.string(decl.name)
+        write_varint(self.out, decl.n_dimensions)
+        no_sizes = (len(decl.sizes) == decl.n_dimensions and
+                    all(size is None for size in decl.sizes))
+        flags = 0
+        if decl.is_local:
+            flags |= IS_LOCAL
+        if decl.ty is not None:
+            flags |= HAS_TYPE
+        if no_sizes:
+            flags |= NO_SIZES
+        self.out.append(flags)
+        if decl.ty is not None:
+            self.string(decl.ty)
+        if no_sizes:
+            return
+        write_varint(self.out, len(decl.sizes))
+        for size in decl.sizes:
+            if size is None:
+                self.out.append(NONE)
+            else:
+                self.node(size)
+
+    def node(self, node):
+        out = self.out
+        ty = type(node)
+        if ty == Access:
+            if type(node.var) == NameHole:
+                self.tag(NAME_HOLE_ACCESS, node)
+                self.hole_names(node.var)
+                self.nodes(node.indices)
+            elif len(node.indices) == 0:
+                self.tag(SCALAR, node)
+                self.string(node.var)
+            else:
+                self.tag(ACCESS, node)
+                self.string(node.var)
+                self.nodes(node.indices)
+        elif ty == Op:
+            if type(node.op) == OpHole:
+                self.tag(OP_HOLE_OP, node)
+                self.hole_names(node.op)
+            else:
+                self.tag(OP, node)
+                self.string(node.op)
+            self.nodes(node.args)
+        elif ty == Literal:
+            if node.ty == int:
+                self.tag(INT, node)
+                write_varint(out, zigzag(node.val))
+            elif node.ty == float:
+                self.tag(FLOAT, node)
+                out += float_struct.pack(node.val)
+            else:
+                raise RuntimeError(f'Unsupported literal type ({node.ty})')
+        elif ty == Hex:
+            self.tag(HEX, node)
+            self.string(node.str_val)
+        elif ty == Assignment:
+            self.tag(ASSIGNMENT, node)
+            self.node(node.lhs)
+            self.node(node.rhs)
+        elif ty == AbstractLoop:
+            self.tag(LOOP, node)
+            write_varint(out, len(node.loop_shapes))
+            for shape in node.loop_shapes:
+                self.loop_shape(shape)
+            self.nodes(node.body)
+        elif ty == NoOp:
+            self.tag(NO_OP, node)
+        elif ty == StatementHole:
+            out.append(STATEMENT_HOLE)
+            self.hole_names(node)
+        elif ty == ExpressionHole:
+            out.append(EXPRESSION_HOLE)
+            self.hole_names(node)
+        elif ty == Declaration:
+            self.declaration(node)
+        elif ty == Const:
+            self.tag(CONST, node)
+            self.string(node.name)
+        elif ty == Program:
+            self.tag(PROGRAM, node)
+            self.nodes(node.decls)
+            self.nodes(node.consts)
+            self.nodes(node.body)
+        else:
+            raise RuntimeError(f'Unsupported node type for serialization ({ty})')
+
+    # Encodes one node as a record. Only the strings that earlier
+    # records of this encoder haven't written are included.
+    def record(self, node):
+        self.out = bytearray()
+        self.node(node)
+        record = bytearray()
+        new_strings = self.strings[self.n_written_strings:]
+        write_varint(record, len(new_strings))
+        for s in new_strings:
+            encoded = s.encode('utf-8')
+            write_varint(record, len(encoded))
+            record += encoded
+        self.n_written_strings = len(self.strings)
+        record += self.out
+        return bytes(record)
+
+class Decoder:
+    def __init__(self):
+        self.strings = []
+        self.data = None
+        self.pos = 0
+
+    def record(self, data, pos=0):
+        self.data = data
+        n_strings, pos = read_varint(data, pos)
+        for _ in range(n_strings):
+            length, pos = read_varint(data, pos)
+            self.strings.append(str(data[pos:pos+length], 'utf-8'))
+            pos += length
+        self.pos = pos
+        node = self.node()
+        self.data = None
+        return node
+
+    # Most varints are a single byte
+    def varint(self):
+        b = self.data[self.pos]
+        if b < 0x80:
+            self.pos += 1
+            return b
+        result, self.pos = read_varint(self.data, self.pos)
+        return result
+
+    def string(self):
+        return self.strings[self.varint()]
+
+    def nodes(self):
+        return [self.node() for _ in range(self.varint())]
+
+    def loop_shape(self):
+        loop_var = self.node()
+        flags = self.data[self.pos]
+        self.pos += 1
+        if flags & DEFAULT_GREATER_EQ:
+            greater_eq = Access(greater_eq_const_name(loop_var.var))
+        else:
+            greater_eq = self.node()
+        if flags & DEFAULT_LESS_EQ:
+            less_eq = [Access(less_eq_const_name(loop_var.var))]
+        else:
+            less_eq = self.nodes()
+        if flags & DEFAULT_STEP:
+            step = Literal(int, 1)
+        else:
+            step = self.node()
+        return LoopShape(loop_var, greater_eq, less_eq, step)
+
+    def declaration(self, attributes):
+        name = self.string()
+        n_dimensions = self.varint()
+        flags = self.data[self.pos]
+        self.pos += 1
+        ty = self.string() if flags & HAS_TYPE else None
+        if flags & NO_SIZES:
+            sizes = None
+        else:
+            sizes = []
+            for _ in range(self.varint()):
+                if self.data[self.pos] == NONE:
+                    self.pos += 1
+                    sizes.append(None)
+                else:
+                    sizes.append(self.node())
+        return Declaration(name, n_dimensions, sizes,
+                           bool(flags & IS_LOCAL), ty, attributes)
+
+    def node(self):
+        byte = self.data[self.pos]
+        self.pos += 1
+        tag = byte & TAG_MASK
+        attributes = {'node_id': self.varint()} if byte & NODE_ID else None
+
+        if tag == SCALAR:
+            return Access(self.string(), None, attributes)
+        elif tag == ACCESS:
+            var = self.string()
+            return Access(var, self.nodes(), attributes)
+        elif tag == OP:
+            op = self.string()
+            return Op(op, self.nodes(), attributes)
+        elif tag == INT:
+            return Literal(int, unzigzag(self.varint()), attributes)
+        elif tag == FLOAT:
+            val, = float_struct.unpack_from(self.data, self.pos)
+            self.pos += float_struct.size
+            return Literal(float, val, attributes)
+        elif tag == ASSIGNMENT:
+            lhs = self.node()
+            rhs = self.node()
+            return Assignment(lhs, rhs, attributes)
+        elif tag == LOOP:
+            loop_shapes = [self.loop_shape() for _ in range(self.varint())]
+            return AbstractLoop(loop_shapes, self.nodes(), attributes)
+        elif tag == NAME_HOLE_ACCESS:
+            var = NameHole(self.string(), self.string())
+            return Access(var, self.nodes(), attributes)
+        elif tag == OP_HOLE_OP:
+            op = OpHole(self.string(), self.string())
+            return Op(op, self.nodes(), attributes)
+        elif tag == HEX:
+            return Hex(self.string(), attributes)
+        elif tag == NO_OP:
+            return NoOp(attributes)
+        elif tag == STATEMENT_HOLE:
+            return StatementHole(self.string(), self.string())
+        elif tag == EXPRESSION_HOLE:
+            return ExpressionHole(self.string(), self.string())
+        elif tag == DECLARATION:
+            return self.declaration(attributes)
+        elif tag == CONST:
+            return Const(self.string(), attributes)
+        elif tag == PROGRAM:
+            decls = self.nodes()
+            consts = self.nodes()
+            body = self.nodes()
+            return Program(decls, body, consts, attributes)
+        raise RuntimeError(f'Unknown node tag ({tag}) at offset {self.pos - 1}')
+
+def check_header(data, magic):
+    if bytes(data[:len(magic)]) != magic:
+        raise RuntimeError('Not a serialized pattern (bad magic)')
+    if len(data) <= len(magic):
+        raise RuntimeError('Truncated serialized pattern')
+    version = data[len(magic)]
+    if version != VERSION:
+        raise RuntimeError(f'Unsupported serialization version ({version})')
+    return len(magic) + 1
+
+def to_bytes(node):
+    return MAGIC + bytes([VERSION]) + Encoder().record(node)
+
+def from_bytes(data):
+    pos = check_header(data, MAGIC)
+    return Decoder().record(data, pos)
+
+# Multi-program files
+
+def write_programs(f, programs):
+    f.write(STREAM_MAGIC + bytes([VERSION]))
+    encoder = Encoder()
+    n_written = 0
+    for program in programs:
+        record = encoder.record(program)
+        length = bytearray()
+        write_varint(length, len(record))
+        f.write(length)
+        f.write(record)
+        n_written += 1
+    return n_written
+
+def save_programs(path, programs):
+    with open(path, 'wb') as f:
+        return write_programs(f, programs)
+
+# Yields the programs one by one, reading the file in chunks
+def iterate_programs(f, chunk_size=1 << 20):
+    check_header(f.read(len(STREAM_MAGIC) + 1), STREAM_MAGIC)
+    decoder = Decoder()
+    buffer = b''
+    pos = 0
+    eof = False
+    while True:
+        # A record is decoded once its length prefix and body are buffered
+        end = None
+        try:
+            length, start = read_varint(buffer, pos)
+            if start + length <= len(buffer):
+                end = start + length
+        except IndexError:
+            pass
+        if end is not None:
+            yield decoder.record(buffer[start:end])
+            pos = end
+            continue
+        if eof:
+            if pos < len(buffer):
+                raise RuntimeError('Truncated pattern stream')
+            return
+        chunk = f.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+def load_programs(path):
+    with open(path, 'rb') as f:
+        yield from iterate_programs(f)
@@ -0,0 +1,203 @@
+from pattern_ast import (Node, Replacer, Rule, Access, Literal, Op, LoopShape,
+                         Plus0, Times1, is_zero, is_one, is_binary_op, rewrite)
+from pattern_persistent import persistent_replace
+
+# Simplifications for the expressions that transformations build, like
+# ((i + 1) + 2) + 0 after unrolling twice or a_tile + (1 * 10 - 1) after
+# tiling.
+#
+# Only rewrites that are exact for both ints and floats are applied to
+# expressions in general: folding int literals (as C would evaluate
+# them) and removing + 0, - 0, * 1 and / 1. Array indices and loop
+# bounds are ints, so there affine sums are also reassociated into
+#   c1 * v1 + c2 * v2 + ... + c
+# with each variable once, in the order it first appears.
+
+def is_int_literal(node):
+    return type(node) == Literal and node.ty == int
+
+# C semantics: division rounds towards 0
+def c_div(a, b):
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+class FoldConstants(Rule):
+    node_types = (Op,)
+    def matches(self, node):
+        if node.op not in ['+', '-', '*', '/']:
+            return False
+        if not all(is_int_literal(arg) for arg in node.args):
+            return False
+        if len(node.args) == 1:
+            return node.op in ['+', '-']
+        if len(node.args) != 2:
+            return False
+        return node.op != '/' or node.args[1].val != 0
+    def rewrite(self, node):
+        if len(node.args) == 1:
+            val = node.args[0].val
+            return Literal(int, -val if node.op == '-' else val)
+        a, b = node.args[0].val, node.args[1].val
+        if node.op == '+':
+            return Literal(int, a + b)
+        if node.op == '-':
+            return Literal(int, a - b)
+        if node.op == '*':
+            return Literal(int, a * b)
+        return Literal(int, c_div(a, b))
+
+class Minus0(Rule):
+    node_types = (Op,)
+    def matches(self, node):
+        return is_binary_op(node, '-') and is_zero(node.args[1])
+    def rewrite(self, node):
+        return node.args[0]
+
+class Divide1(Rule):
+    node_types = (Op,)
+    def matches(self, node):
+        return is_binary_op(node, '/') and is_one(node.args[1])
+    def rewrite(self, node):
+        return node.args[0]
+
+# a + -3 => a - 3
+class AddNegative(Rule):
+    node_types = (Op,)
+    def matches(self, node):
+        return (is_binary_op(node, '+') and
+                is_int_literal(node.args[1]) and node.args[1].val < 0)
+    def rewrite(self, node):
+        return Op('-', [node.args[0], Literal(int, -node.args[1].val)], node.copy_attributes())
+
+# Returns ([(key, coeff, atom)], const) for an int expression, where the
+# atoms are scalar accesses (keyed by name) or subexpressions that
+# aren't affine (keyed by identity). Uses an explicit stack because
+# unrolled indices can be nested very deeply.
+def linearize(expr):
+    terms = {}
+    const = 0
+    stack = [(expr, 1)]
+    while stack:
+        node, k = stack.pop()
+        ty = type(node)
+        if ty == Literal and node.ty == int:
+            const += k * node.val
+        elif ty == Access and node.is_scalar() and type(node.var) == str:
+            add_term(terms, node.var, k, node)
+        elif ty == Op and len(node.args) == 2 and node.op in ['+', '-']:
+            sign = 1 if node.op == '+' else -1
+            stack.append((node.args[1], sign * k))
+            stack.append((node.args[0], k))
+        elif ty == Op and len(node.args) == 1 and node.op in ['+', '-']:
+            sign = 1 if node.op == '+' else -1
+            stack.append((node.args[0], sign * k))
+        elif ty == Op and is_binary_op(node, '*') and is_int_literal(node.args[0]):
+            stack.append((node.args[1], k * node.args[0].val))
+        elif ty == Op and is_binary_op(node, '*') and is_int_literal(node.args[1]):
+            stack.append((node.args[0], k * node.args[1].val))
+        else:
+            atom = simplify_atom(node)
+            add_term(terms, id(atom), k, atom)
+    return [(key, coeff, atom) for key, (coeff, atom) in terms.items() if coeff != 0], const
+
+def add_term(terms, key, k, atom):
+    if key in terms:
+        coeff, first = terms[key]
+        terms[key] = (coeff + k, first)
+    else:
+        terms[key] = (k, atom)
+
+# The arguments of an operation that isn't affine (i * j, A[i] / 2) are
+# still int expressions
+def simplify_atom(node):
+    if type(node) != Op or node.op not in ['+', '-', '*', '/', '%']:
+        return node
+    args = [simplify_int_expr(arg) for arg in node.args]
+    if all(a is b for a, b in zip(args, node.args)):
+        return node
+    return Op(node.op, args, node.copy_attributes())
+
+def build_affine(terms, const):
+    expr = None
+    for _, coeff, atom in terms:
+        term = atom if abs(coeff) == 1 else Op('*', [Literal(int, abs(coeff)), atom])
+        if expr is None:
+            expr = term if coeff > 0 else Op('-', [term])
+        else:
+            expr = Op('+' if coeff > 0 else '-', [expr, term])
+    if expr is None:
+        return Literal(int, const)
+    if const > 0:
+        return Op('+', [expr, Literal(int, const)])
+    if const < 0:
+        return Op('-', [expr, Literal(int, -const)])
+    return expr
+
+# Returns expr itself when it's already in normal form
+def simplify_int_expr(expr):
+    if not isinstance(expr, Node) or type(expr) in [Access, Literal]:
+        return expr
+    simplified = build_affine(*linearize(expr))
+    if simplified.is_syntactically_equal(expr):
+        return expr
+    return simplified
+
+# Simplifies the indices of accesses and the bounds of loop shapes. The
+# result of matches() is kept for the rewrite() that follows it.
+class AffineSimplifier(Rule):
+    node_types = (Access, LoopShape)
+    def __init__(self):
+        self.pending = None
+    def matches(self, node):
+        if type(node) == Access:
+            exprs = node.indices
+        else:
+            exprs = [node.greater_eq, node.step] + node.less_eq
+        simplified = [simplify_int_expr(expr) for expr in exprs]
+        if all(a is b for a, b in zip(simplified, exprs)):
+            return False
+        self.pending = (node, simplified)
+        return True
+    def rewrite(self, node):
+        pending_node, simplified = self.pending
+        assert(pending_node is node)
+        self.pending = None
+        if type(node) == Access:
+            simplified_access = Access(node.var, simplified, node.copy_attributes())
+            simplified_access.is_write = node.is_write
+            return simplified_access
+        return LoopShape(node.loop_var, simplified[0], simplified[2:], simplified[1])
+
+def simplifier_rules():
+    return [FoldConstants(), Plus0(), Minus0(), Times1(), Divide1(), AddNegative(),
+            AffineSimplifier()]
+
+# Simplifies a tree in place, see rewrite()
+def simplify(node, extra_rules=None):
+    rules = ([] if extra_rules is None else extra_rules) + simplifier_rules()
+    return rewrite(node, rules)
+
+# Applies the first of the rules that matches, so that a list of rules
+# can go through replace() or persistent_replace like a single replacer
+class RuleSet(Replacer):
+    def __init__(self, rules):
+        self.dispatch = {}
+        for rule in rules:
+            for ty in rule.node_types:
+                self.dispatch.setdefault(ty, []).append(rule)
+        self.matched = None
+    def should_skip(self, node):
+        return False
+    def should_replace(self, node):
+        for rule in self.dispatch.get(type(node), []):
+            if rule.matches(node):
+                self.matched = rule
+                return True
+        return False
+    def replace(self, node):
+        return self.matched.rewrite(node)
+
+# Returns a simplified tree sharing the unchanged parts with node, see
+# pattern_persistent.py
+def simplify_persistent(node):
+    return persistent_replace(node, RuleSet(simplifier_rules()), dfs=True)
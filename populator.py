@@ -1,5 +1,8 @@
 import random
+from fractions import Fraction
+from math import lcm
 from pattern_ast import Replacer, Const, Declaration, Node, replace, ExpressionHole, StatementHole, OpHole, NameHole
+from pattern_canonical import canonical_key
 
 def prod(arr):
     p = 1
@@ -41,16 +44,27 @@ class ChoiceRecorder:
         self.choices.append(i)
         return population[i]
 
+# Records the number of choices of every pick, in order, and always
+# picks the first one. Filling a skeleton with it gives the mixed-radix
+# space of its fills.
+class SpaceRecorder:
+    def __init__(self):
+        self.space = []
+    def choice(self, population):
+        self.space.append(len(population))
+        return population[0]
+
 def space_to_strides(space):
     strides = [1]
     for size in reversed(space):
         strides.append(size * strides[-1])
     strides.reverse()
     return strides
-    
-def int_to_point(i, space):
-    strides = space_to_strides(space)
-    if i >= strides[0]:
+
+def int_to_point(i, space, strides=None):
+    if strides is None:
+        strides = space_to_strides(space)
+    if i < 0 or i >= strides[0]:
         raise RuntimeError('integer too large to be represented by space')
 
     point = []
@@ -60,10 +74,10 @@ def int_to_point(i, space):
         i = i % dimension_size
     return point
 
-def point_to_int(p, space):
-    strides = space_to_strides(space)
+def point_to_int(p, space, strides=None):
+    if strides is None:
+        strides = space_to_strides(space)
     i = 0
-    print(strides)
     for v, dimension_size in zip(p, strides[1:]):
         i += v * dimension_size
     return i
@@ -71,42 +85,185 @@ def point_to_int(p, space):
 class ChoiceFactoryEnumerator:
     def __init__(self, space):
         self.space = space
+        self.strides = space_to_strides(space)
         self.current_position = 0
         self.n_enumerated = 0
-        self.space_size = prod(space)
+        self.space_size = self.strides[0]
     def enumerate(self):
         while self.n_enumerated < self.space_size:
-            current_point = int_to_point(self.current_position, self.space)
+            current_point = int_to_point(self.current_position, self.space, self.strides)
             yield FixedChoiceFactory(current_point)
             self.n_enumerated += 1
             self.current_position += 1
 
+# Passes on the first program of every group with the same canonical
+# form (see pattern_canonical.py), and counts the ones it skips
+class CanonicalFilter:
+    def __init__(self):
+        self.seen = set()
+        self.n_enumerated = 0
+        self.n_skipped = 0
+    def is_new(self, program):
+        self.n_enumerated += 1
+        key = canonical_key(program)
+        if key in self.seen:
+            self.n_skipped += 1
+            return False
+        self.seen.add(key)
+        return True
+    def n_unique(self):
+        return len(self.seen)
+    def __str__(self):
+        reduction = self.n_enumerated / max(self.n_unique(), 1)
+        return (f'{self.n_unique()} unique of {self.n_enumerated} programs, '
+                f'{self.n_skipped} duplicates skipped ({reduction:.2f}x smaller)')
+
+# Only the canonical representatives of programs, the first of each
+# group in enumeration order
+def canonical_only(programs, canonical_filter=None):
+    if canonical_filter is None:
+        canonical_filter = CanonicalFilter()
+    for program in programs:
+        if canonical_filter.is_new(program):
+            yield program
+
 def families_are_equal(node_family, mapping_family):
     return node_family == mapping_family
 
-# TODO: Store the choices made (probably as a list of integers).
-#       This is useful for naming generated programs and debugging purposes.
+# The choices of a family. Picking from a finite family removes the
+# chosen one and keeps the order of the rest, like list.remove, so the
+# same seed gives the same fills. With swap_remove, the last choice is
+# swapped into the place of the chosen one instead, so a pick is O(1)
+# but the order of the remaining choices (and so the fills) changes.
+# Choice functions are given the list of choices like before.
+class ChoicePool:
+    def __init__(self, choices, swap_remove=False):
+        self.choices = list(choices)
+        self.swap_remove = swap_remove
+        self.positions = {id(c): i for i, c in enumerate(self.choices)}
+        if len(self.positions) != len(self.choices):
+            # The same object is in the pool more than once (like
+            # interned op strings), so it has to be looked up by value
+            self.positions = None
+    def __len__(self):
+        return len(self.choices)
+    def position(self, chosen):
+        if self.positions is not None:
+            i = self.positions.get(id(chosen))
+            if i is not None and self.choices[i] is chosen:
+                return i
+        return self.choices.index(chosen)
+    def remove(self, chosen):
+        i = self.position(chosen)
+        if not self.swap_remove:
+            # The positions after i all shift, so they're looked up by
+            # value from now on
+            del self.choices[i]
+            self.positions = None
+            return
+        removed = self.choices[i]
+        last = self.choices.pop()
+        if i < len(self.choices):
+            self.choices[i] = last
+        if self.positions is not None:
+            del self.positions[id(removed)]
+            if last is not removed:
+                self.positions[id(last)] = i
+
+def integer_weights(weights):
+    weights = [Fraction(w) for w in weights]
+    denominator = lcm(*[w.denominator for w in weights])
+    return [int(w * denominator) for w in weights]
+
+# Walker's alias method for picking from a pool with weights in O(1).
+# The weights are made integers (exactly), and a pick is one uniform
+# draw from range(n * total), so the distribution is exact and any
+# choice function that picks uniformly can drive it (random.choice, a
+# seeded Random's choice).
+class AliasTable:
+    def __init__(self, weights):
+        weights = integer_weights(weights)
+        n = len(weights)
+        total = sum(weights)
+        if n == 0 or total <= 0 or any(w < 0 for w in weights):
+            raise RuntimeError(f'Invalid weights: {weights}')
+        self.total = total
+        self.draws = range(n * total)
+        # Every column holds total units, its own first and then the
+        # ones of its alias
+        self.threshold = [w * n for w in weights]
+        self.alias = list(range(n))
+        small = [i for i in range(n) if self.threshold[i] < total]
+        large = [i for i in range(n) if self.threshold[i] >= total]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.alias[s] = l
+            self.threshold[l] -= total - self.threshold[s]
+            if self.threshold[l] < total:
+                small.append(l)
+            else:
+                large.append(l)
+    def pick(self, choice_function):
+        column, unit = divmod(choice_function(self.draws), self.total)
+        if unit < self.threshold[column]:
+            return column
+        return self.alias[column]
+
+# Records the choices made as positions in the pools and the sizes of
+# the pools at the time, which is the point of the fill in the space of
+# all fills (see choice_index).
 class PopulateParameters:
     def __init__(self, default_choices=None, is_finite=False, choice_function=random.choice):
         self.available = {}
         self.choice_functions = {}
+        self.alias_tables = {}
         self.assigned = {}
         self.finite_families = set()
+        self.choices_made = []
+        self.space = []
+        self.is_replayable = True
         if default_choices is not None:
             self.add('_', default_choices, is_finite=is_finite, choice_function=choice_function)
 
-    def add(self, family_name, choices, is_finite=False, choice_function=random.choice):
+    def add(self, family_name, choices, is_finite=False, choice_function=random.choice,
+            weights=None, swap_remove=False):
         if (family_name in self.available):
             print(f'{family_name} already exists')
             exit(1)
-        self.set(family_name, choices, is_finite, choice_function)
+        self.set(family_name, choices, is_finite, choice_function, weights, swap_remove)
 
-    def set(self, family_name, choices, is_finite=False, choice_function=random.choice):
-        self.available[family_name] = list(choices)
+    # With weights, choice_function is used as the uniform source of
+    # the alias method (see AliasTable). Finite families can't have
+    # weights. swap_remove makes picks from a finite family O(1) but
+    # changes the fills (see ChoicePool).
+    def set(self, family_name, choices, is_finite=False, choice_function=random.choice,
+            weights=None, swap_remove=False):
+        self.available[family_name] = ChoicePool(choices, swap_remove)
         self.choice_functions[family_name] = choice_function
+        self.alias_tables.pop(family_name, None)
+        self.finite_families.discard(family_name)
+        if weights is not None:
+            if is_finite:
+                raise RuntimeError(f'Finite family {family_name} can\'t have weights')
+            if len(weights) != len(self.available[family_name]):
+                raise RuntimeError(f'Family {family_name} has {len(self.available[family_name])} '
+                                   f'choices but {len(weights)} weights')
+            self.alias_tables[family_name] = AliasTable(weights)
         if is_finite:
             self.finite_families.add(family_name)
 
+    def matching_family(self, family, matches):
+        # Only the family of the same name can be equal, no need to ask
+        # every family
+        if matches is families_are_equal:
+            return family if family in self.available else None
+        matching_family = None
+        for available_family in self.available:
+            if matches(family, available_family):
+                matching_family = available_family
+        return matching_family
+
     def populate(self, node, matches=None):
         if matches is None:
             matches = families_are_equal
@@ -116,31 +273,57 @@ class PopulateParameters:
         full_name = f'{name}:{family}'
 
         if name != '_' and full_name in self.assigned:
-            return self.assigned[full_name]
-
-        matching_family = None
-        for available_family in self.available:
-            if matches(family, available_family):
-                matching_family = available_family
+            return clone_choice(self.assigned[full_name])
 
+        matching_family = self.matching_family(family, matches)
         if matching_family is None:
             return node
 
-        if len(self.available[matching_family]) == 0:
+        pool = self.available[matching_family]
+        if len(pool) == 0:
             return node.clone()
 
         choice_function = self.choice_functions[matching_family]
-        chosen = choice_function(self.available[matching_family])
+        if matching_family in self.alias_tables:
+            position = self.alias_tables[matching_family].pick(choice_function)
+            chosen = pool.choices[position]
+        else:
+            chosen = choice_function(pool.choices)
+            position = self.position(pool, chosen)
+        self.choices_made.append(position)
+        self.space.append(len(pool))
         if name != '_':
             self.assigned[full_name] = chosen
         if matching_family in self.finite_families:
-            self.available[matching_family].remove(chosen)
+            pool.remove(chosen)
+
+        return clone_choice(chosen)
+
+    def position(self, pool, chosen):
+        try:
+            return pool.position(chosen)
+        except ValueError:
+            # The choice function made up a choice, which can't be
+            # replayed
+            self.is_replayable = False
+            return 0
+
+    # The choices made so far as one integer (the point in the
+    # mixed-radix space of the fills, see api.FillEnumeration), or None
+    # if they can't be replayed
+    def choice_index(self):
+        if not self.is_replayable:
+            return None
+        return point_to_int(self.choices_made, self.space)
 
-        # For OpHoles, they're replaced by strings (should have a better design, yeah)
-        # So the chosen op isn't a node and can't be cloned
-        if not isinstance(chosen, Node):
-            return chosen
-        return chosen.clone()
+# The choices may be shared between fills (see api.CompiledMapping), so
+# never hand out the chosen node itself.
+def clone_choice(chosen):
+    # For OpHoles, they're replaced by strings (should have a better design, yeah)
+    # So the chosen op isn't a node and can't be cloned
+    if not isinstance(chosen, Node):
+        return chosen
+    return chosen.clone()
 
 def populate_name(program, populate_function, matching_function=None):
     replacer = NamePopulator(populate_function, matching_function)
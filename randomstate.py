@@ -1,15 +1,30 @@
 import random
 import pickle
+from hashlib import sha256
 
 # Stores the random state to the path pointed to by pathlib.Path
-# If state is not given, use the current random state.
-def checkpoint(path, state=None):
+# If state is not given, use the current state of rng (a random.Random),
+# or of the random module if rng isn't given either.
+def checkpoint(path, state=None, rng=None):
     if state is None:
-        state = random.getstate()
+        state = random.getstate() if rng is None else rng.getstate()
     with path.open('wb') as f:
         pickle.dump(state, f)
 
-# Loads the random state to the path pointed to by pathlib.Path
-def restore(path):
+# Loads the random state to the path pointed to by pathlib.Path, into
+# rng if given or the random module otherwise
+def restore(path, rng=None):
     with path.open('rb') as f:
-        random.setstate(pickle.load(f))
+        state = pickle.load(f)
+    if rng is None:
+        random.setstate(state)
+    else:
+        rng.setstate(state)
+
+# The seed of the index-th of many streams derived from one seed (the
+# fills of api.Skeleton.fill_many, the attempts of
+# instance.create_instances). Every one has its own stream, so the
+# results don't depend on how they're split between workers.
+def derive_seed(seed, index):
+    digest = sha256(f'{seed}:{index}'.encode('utf8')).digest()
+    return int.from_bytes(digest[:8], 'little')
@@ -1,5 +1,6 @@
-from z3 import Int, Optimize, sat, unsat, Solver
-from pattern_ast import get_accesses, Op, Access, Literal, Node
+from z3 import Int, Optimize, sat, unsat, Solver, Or, is_int_value
+from pattern_ast import iterate_accesses, Op, Access, Literal, Node
+from pattern_affine import affine_form
 from loguru import logger
 
 from enum import Enum
@@ -46,12 +47,12 @@ def get_scalar_cvars(pattern):
         if access.is_scalar() and access.var not in cvars:
             cvars[access.var] = Int(access.var)
 
-    for access in get_accesses(pattern):
+    for access in pattern.access_index().accesses:
         maybe_add(access)
     for decl in pattern.decls:
         for size in decl.sizes:
             if size is not None:
-                for access in get_accesses(size):
+                for access in iterate_accesses(size):
                     maybe_add(access)
 
     return cvars
@@ -63,95 +64,171 @@ def get_int_cvars(pattern, types):
         if types.can_be(access.var, 'int') and name not in cvars:
             cvars[name] = Int(name)
 
-    for access in get_accesses(pattern):
+    for access in pattern.access_index().accesses:
         maybe_add(access)
     for decl in pattern.decls:
         for size in decl.sizes:
             if size is not None:
-                for access in get_accesses(size):
+                for access in iterate_accesses(size):
                     maybe_add(access)
 
     return cvars
 
-def affine_to_cexpr(affine, cvars):
-    if not affine.var:
-        return affine.offset
-    return affine.coeff * cvars[affine.var] + affine.offset
+# Encodes an AffineForm (see pattern_affine.py). Returns None when a
+# variable has no cvar, like expr_to_cexpr does.
+def affine_to_cexpr(form, cvars):
+    if not form.is_affine:
+        return expr_to_cexpr(form.expr, cvars)
+    cexpr = None
+    for var, coeff in form.coeffs.items():
+        if var not in cvars:
+            return None
+        term = cvars[var] if coeff == 1 else coeff * cvars[var]
+        cexpr = term if cexpr is None else cexpr + term
+    if cexpr is None:
+        return form.const
+    return cexpr + form.const if form.const != 0 else cexpr
+
+def index_to_cexpr(expr, cvars):
+    return affine_to_cexpr(affine_form(expr), cvars)
+
+# Answers a series of queries under the same constraints, which are
+# asserted once. Every query adds its own constraints in a push/pop
+# scope, so the solvers keep what they learned about the shared ones.
+# Constraints are only printed when a query fails.
+class SolverSession:
+    def __init__(self, constraints=None, l=None, timeout=10000):
+        self.l = logger if l is None else l
+        self.timeout = timeout
+        self.constraints = []
+        self.solver = Solver()
+        self.solver.set('timeout', timeout)
+        self.optimize = None
+        self.model = None
+        if constraints is not None:
+            self.add(constraints)
+
+    def add(self, constraints):
+        self.constraints += constraints
+        self.solver.add(constraints)
+        if self.optimize is not None:
+            self.optimize.assert_exprs(*constraints)
+
+    def get_optimize(self):
+        if self.optimize is None:
+            self.optimize = Optimize()
+            self.optimize.set('timeout', self.timeout)
+            self.optimize.assert_exprs(*self.constraints)
+        return self.optimize
+
+    def constraint_strs(self, extra):
+        return '\n'.join(map(str, self.constraints + extra))
+
+    # The model is kept in self.model when the status is sat
+    def check(self, extra=[]):
+        self.solver.push()
+        self.solver.add(extra)
+        status = self.solver.check()
+        self.model = self.solver.model() if status == sat else None
+        self.solver.pop()
+        return status
+
+    def is_sat(self, extra=[], print_model=False):
+        status = self.check(extra)
+        if print_model:
+            if status == sat:
+                logger.debug(f'Model:\n{self.model}')
+        return status == sat
+
+    def find_bound(self, expr, extra, is_max):
+        if type(expr) == int:
+            return expr
+        which = 'max' if is_max else 'min'
+
+        optimize = self.get_optimize()
+        optimize.push()
+        optimize.assert_exprs(*extra)
+        if is_max:
+            optimize.maximize(expr)
+        else:
+            optimize.minimize(expr)
+        status = optimize.check()
+        if status == sat:
+            val = optimize.model().eval(expr).as_long()
+        optimize.pop()
+        if status != sat:
+            self.l.warning(f'Unable to find {which} ({status}) for:\n' + self.constraint_strs(extra))
+            return None
+
+        # Make sure it's actually the max (min), since z3 has a bug
+        #   https://github.com/Z3Prover/z3/issues/4670
+        beyond = expr > val if is_max else expr < val
+        status = self.check(extra + [beyond])
+        if status != unsat:
+            self.l.error(f'Z3 bug\nFind {which} ({expr}) => {val} with status ({status}):\n' +
+                         self.constraint_strs(extra))
+            return None
+        return val
+
+    def find_max(self, expr, extra=[]):
+        return self.find_bound(expr, extra, True)
+
+    def find_min(self, expr, extra=[]):
+        return self.find_bound(expr, extra, False)
+
+    def find_min_max(self, expr, extra=[]):
+        return [self.find_min(expr, extra), self.find_max(expr, extra)]
+
+    # The min and max of every expr at once, with one Optimize in box
+    # mode (every objective on its own) and one check that no expr can
+    # go beyond its bounds. Equal exprs are optimized once. Returns None
+    # when the batch times out, is unbounded or doesn't check out, then
+    # find_min_max can go one by one.
+    def find_min_max_batch(self, exprs):
+        positions = {}
+        unique = []
+        for expr in exprs:
+            if type(expr) != int and expr.get_id() not in positions:
+                positions[expr.get_id()] = len(unique)
+                unique.append(expr)
+        if len(unique) == 0:
+            return [[expr, expr] for expr in exprs]
+
+        optimize = self.get_optimize()
+        optimize.push()
+        optimize.set(priority='box')
+        objectives = [(optimize.minimize(expr), optimize.maximize(expr)) for expr in unique]
+        status = optimize.check()
+        if status == sat:
+            values = [(low.value(), high.value()) for low, high in objectives]
+        optimize.pop()
+        optimize.set(priority='lex')
+        if status != sat:
+            self.l.debug(f'Unable to find min and max of {len(unique)} in a batch ({status})')
+            return None
+        if not all(is_int_value(v) for pair in values for v in pair):
+            self.l.debug('Unbounded min or max in a batch')
+            return None
+        min_maxes = [[low.as_long(), high.as_long()] for low, high in values]
+
+        # Same z3 bug as in find_bound
+        beyond = [Or(expr < min_val, expr > max_val)
+                  for expr, (min_val, max_val) in zip(unique, min_maxes)]
+        status = self.check([Or(beyond)])
+        if status != unsat:
+            self.l.debug(f'Batch of {len(unique)} min and max not verified ({status})')
+            return None
+        return [[expr, expr] if type(expr) == int else min_maxes[positions[expr.get_id()]]
+                for expr in exprs]
 
 def find_max(constraints, expr, l = None):
-    if l is None:
-        l = logger
-
-    if type(expr) == int:
-        return expr
-
-    constraint_strs = [f'{c}' for c in constraints]
-
-    max_optimize = Optimize()
-    max_optimize.set('timeout', 10000)
-    max_optimize.assert_exprs(*constraints)
-    max_optimize.maximize(expr)
-    status = max_optimize.check()
-    if status != sat:
-        l.warning(f'Unable to find max ({status}) for:\n' + '\n'.join(constraint_strs))
-        return None
-
-    max_val = max_optimize.model().eval(expr).as_long()
-
-    # Make sure it's actually the max, since z3 has a bug
-    #   https://github.com/Z3Prover/z3/issues/4670
-    solver = Solver()
-    solver.set('timeout', 10000)
-    solver.add(constraints + [expr > max_val])
-    status = solver.check()
-
-    if status != unsat:
-        l.error(f'Z3 bug\nFind max ({expr}) => {max_val} with status ({status}):\n' + '\n'.join(constraint_strs))
-        return None
-    return max_val
+    return SolverSession(constraints, l).find_max(expr)
 
 def find_min(constraints, expr, l = None):
-    if l is None:
-        l = logger
-
-    if type(expr) == int:
-        return expr
-
-    constraint_strs = [f'{c}' for c in constraints]
-
-    min_optimize = Optimize()
-    min_optimize.set('timeout', 10000)
-    min_optimize.assert_exprs(*constraints)
-    min_optimize.minimize(expr)
-    status = min_optimize.check()
-    if status != sat:
-        l.warning(f'Unable to find min ({status}) for:\n' + '\n'.join(constraint_strs))
-        return None
-
-    min_val = min_optimize.model().eval(expr).as_long()
-
-    # Make sure it's actually the min, since z3 has a bug
-    #   https://github.com/Z3Prover/z3/issues/4670
-    solver = Solver()
-    solver.set('timeout', 10000)
-    solver.add(constraints + [expr < min_val])
-    status = solver.check()
-
-    if status != unsat:
-        l.error(f'Z3 bug\nFind min ({expr}) => {min_val} with status ({status}):\n' + '\n'.join(constraint_strs))
-        return None
-    return min_val
+    return SolverSession(constraints, l).find_min(expr)
 
 def find_min_max(constraints, i):
-    return [f(constraints, i) for f in [find_min, find_max]]
+    return SolverSession(constraints).find_min_max(i)
 
 def is_sat(constraints, print_model=False):
-    solver = Solver()
-    solver.set('timeout', 10000)
-    solver.add(constraints)
-    status = solver.check()
-    if print_model:
-        if status == sat:
-            logger.debug(f'Model:\n{solver.model()}')
-
-    return status == sat
+    return SolverSession(constraints).is_sat(print_model=print_model)